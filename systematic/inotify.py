@@ -0,0 +1,251 @@
+"""
+Linux inotify file system event watcher
+
+Uses the inotify system calls from libc with ctypes. Check inotify_available()
+and fall back to polling if inotify can't be used.
+"""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Header of struct inotify_event: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 2**16
+
+
+class InotifyError(Exception):
+    pass
+
+
+def load_libc():
+    """
+    Return libc with inotify functions, or None if inotify is not available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+LIBC = load_libc()
+
+
+def inotify_available():
+    """
+    Check if inotify can be used
+    """
+    return LIBC is not None
+
+
+class InotifyEvent(object):
+    """
+    Inotify event for watched path. Name is name of file in a watched directory or empty.
+    """
+    __slots__ = ('path', 'mask', 'cookie', 'name')
+
+    def __init__(self, path, mask, cookie, name):
+        self.path = path
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+
+    def __repr__(self):
+        return '{0} {1:#x} {2}'.format(self.path, self.mask, self.name)
+
+    @property
+    def filename(self):
+        """
+        Path of file the event is about
+        """
+        return self.name and os.path.join(self.path, self.name) or self.path
+
+
+class InotifyWatcher(object):
+    """Inotify watcher
+
+    Watches paths for events in given masks with one non blocking inotify
+    file descriptor, which can also be used with select.
+
+    One watcher can be shared by readers of different files, to stay within
+    the per user limit of inotify instances: readers ask only for events of
+    their own files, and events read for files other readers have asked for
+    are kept until asked. Kept events of a file are coalesced to one event
+    per watch with combined masks, so they take memory per watched file, not
+    per write.
+
+    """
+    def __init__(self):
+        if LIBC is None:
+            raise InotifyError('inotify is not available')
+
+        self.fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError('Error initializing inotify: {0}'.format(os.strerror(ctypes.get_errno())))
+        self.watches = {}
+        self.paths = {}
+        self.pending = {}
+        self.interests = set()
+
+    def __repr__(self):
+        return 'inotify watching {0:d} paths'.format(len(self.paths))
+
+    def __del__(self):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        """
+        Close the inotify file descriptor, removing all watches
+        """
+        if getattr(self, 'fd', None) is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+        self.watches = {}
+        self.paths = {}
+        self.pending = {}
+        self.interests = set()
+
+    def add_watch(self, path, mask):
+        """
+        Watch path for events in mask
+        """
+        wd = LIBC.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise InotifyError('Error watching {0}: {1}'.format(path, os.strerror(ctypes.get_errno())))
+        self.watches[wd] = path
+        self.paths[path] = wd
+        self.interests.add(path)
+        return wd
+
+    def remove_watch(self, path):
+        """
+        Stop watching path
+        """
+        wd = self.paths.pop(path, None)
+        if wd is not None:
+            del self.watches[wd]
+            LIBC.inotify_rm_watch(self.fd, wd)
+        self.interests.discard(path)
+        self.pending.pop(path, None)
+
+    def read_events(self, timeout=None, paths=None):
+        """Read events
+
+        Return list of InotifyEvent objects, waiting at most timeout seconds
+        for events, or forever if timeout is None. Queue overflow is returned
+        as event with IN_Q_OVERFLOW mask and path None.
+
+        If paths is given, only events about those files are returned, either
+        from watches of the files or of their directories. Events about other
+        watched files, or files asked for in earlier calls, are kept for later
+        calls until the watch of the file is removed, and other events are
+        dropped. The list may be empty before timeout, if only events about
+        other files were read. Queue overflow is returned to the caller and
+        kept as overflow event of each other file asked for.
+
+        """
+        if paths is not None:
+            self.interests.update(paths)
+        events = self.__take_pending__(paths)
+        if events:
+            return events
+
+        try:
+            readable, writable, errors = select.select([self.fd], [], [], timeout)
+        except select.error, (ecode, emsg):
+            if ecode == errno.EINTR:
+                return []
+            raise InotifyError('Error waiting for inotify events: {0}'.format(emsg))
+        if not readable:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, EVENT_BUFFER_SIZE)
+            except OSError, (ecode, emsg):
+                if ecode in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise InotifyError('Error reading inotify events: {0}'.format(emsg))
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+
+                path = self.watches.get(wd, None)
+                if mask & IN_IGNORED:
+                    # Watch was removed, or watched path deleted
+                    if path is not None:
+                        del self.watches[wd]
+                        self.paths.pop(path, None)
+                if path is None and not mask & IN_Q_OVERFLOW:
+                    continue
+                events.append(InotifyEvent(path, mask, cookie, name))
+
+        if paths is None:
+            return events
+
+        matching = []
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                matching.append(event)
+                for path in self.interests:
+                    if path not in paths:
+                        self.__keep_event__(InotifyEvent(path, event.mask, 0, ''))
+            elif event.filename in paths:
+                matching.append(event)
+            elif event.filename in self.interests:
+                self.__keep_event__(event)
+        return matching
+
+    def __keep_event__(self, event):
+        """
+        Keep event for a later call, combining it with kept event of the same watch and name
+        """
+        events = self.pending.setdefault(event.filename, {})
+        kept = events.get(event.path, None)
+        if kept is None:
+            events[event.path] = InotifyEvent(event.path, event.mask, 0, event.name)
+        else:
+            kept.mask |= event.mask
+
+    def __take_pending__(self, paths=None):
+        """
+        Return and remove kept events about given files, or all kept events if paths is None
+        """
+        if paths is None:
+            paths = self.pending.keys()
+        events = []
+        for path in paths:
+            events.extend(self.pending.pop(path, {}).values())
+        return events
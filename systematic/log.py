@@ -5,18 +5,46 @@ Logging from scripts and parser for syslog files
 
 import os
 import sys
+import glob
+import time
 import fnmatch
 import re
+import calendar
+import heapq
+import mmap
+import operator
+import multiprocessing
 import urllib
 import bz2
 import gzip
+import zlib
 import threading
 import logging
 import logging.handlers
 
-from datetime import datetime, timedelta
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from subprocess import Popen, PIPE
+
+from systematic.logindex import LogTimeIndex, GzipCheckpointIndex, LogIndexError, \
+    DEFAULT_INDEX_DIRECTORY, DEFAULT_INDEX_INTERVAL, DEFAULT_GZIP_CHECKPOINT_SPAN
+from systematic.logcache import LogCacheError
+from systematic.logrules import LogRuleSet, literal_prefix
+from systematic.logtemplates import TemplateMiner
+from systematic.logstats import LogAggregation, TopKSummary, DEFAULT_AGGREGATE_INTERVAL, DEFAULT_MAX_GROUPS, \
+    DEFAULT_TOPK_EPSILON, DEFAULT_TOPK_DELTA
 from systematic.tail import TailReader, TailReaderError
+from systematic.inotify import InotifyWatcher, InotifyError, inotify_available, \
+    IN_MODIFY, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 
 DEFAULT_LOGFORMAT = '%(module)s %(levelname)s %(message)s'
 DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -58,6 +86,64 @@ SOURCE_FORMATS = [
     re.compile('^(?P<host>[^\s]+)\s+(?P<program>[^\[]+)$'),
 ]
 
+# Month abbreviations in syslog 'mon day time' timestamp prefix
+SYSLOG_MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+# Length of 'Mmm dd HH:MM:SS' timestamp prefix
+SYSLOG_TIMESTAMP_LENGTH = 15
+# Number of distinct timestamp prefixes memoized by SyslogTimeParser
+DEFAULT_TIMESTAMP_CACHE_SIZE = 8
+# Array typecode for 64 bit integer columns in ColumnarLogFile
+try:
+    array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:
+    INT64_TYPECODE = 'l'
+
+# Magic bytes of compressed log file formats
+COMPRESSION_MAGIC = (
+    ('gzip', '\x1f\x8b'),
+    ('bzip2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd'),
+)
+# External decompressor commands by format, in order of preference
+EXTERNAL_DECOMPRESSORS = {
+    'gzip': (('pigz', '-dc'), ('gzip', '-dc')),
+    'bzip2': (('lbzip2', '-dc'), ('pbzip2', '-dc'), ('bzip2', '-dc')),
+    'xz': (('xz', '-T0', '-dc'), ),
+    'zstd': (('zstd', '-dc'), ),
+}
+
+# Size of byte ranges parsed by worker processes in LogFile.parallel_load
+DEFAULT_PARALLEL_CHUNK_SIZE = 2**26
+
+# Size of blocks read by the bulk line reader
+DEFAULT_READ_BLOCK_SIZE = 2**20
+
+# Limit of files LogFileCollection keeps open, and size of blocks read per file when merging files
+DEFAULT_MAX_OPEN_FILES = 64
+DEFAULT_MERGE_READ_BLOCK_SIZE = 2**16
+
+# Seconds between polls and between rescans of the pattern when following files
+DEFAULT_LIVE_POLL_INTERVAL = 1.0
+DEFAULT_LIVE_RESCAN_INTERVAL = 60
+
+# Entry fields indexed with LogFile.index_fields, tuples index value combinations
+DEFAULT_INDEX_FIELDS = ('host', 'program', 'pid', ('host', 'program'))
+
+# Size of the head of consumed data checked by LogFile.refresh to detect truncated and rewritten files
+REFRESH_CHECKSUM_SIZE = 2**12
+
+# Region size scanned linearly and backtracking window for LogFile.seek_time
+SEEK_SCAN_SIZE = 2**13
+DEFAULT_SEEK_BACKTRACK = 2**16
+
+# Size of CompactLogEntry object without message in bytes on 64 bit CPython 2.7
+COMPACT_LOG_ENTRY_SIZE = 136
+
 
 class LoggerError(Exception):
     """
@@ -337,44 +423,537 @@ class LogFileError(Exception):
     pass
 
 
-class LogEntry(object):
+def iter_line_blocks(fd, block_size=DEFAULT_READ_BLOCK_SIZE):
+    """Iterate blocks of lines
+
+    Read fd in blocks of block_size bytes and yield lists of lines split from
+    each block, without line endings. A line split between blocks is yielded
+    with the next block.
+
     """
-    Generic syslog logfile entry
+    remainder = ''
+    while True:
+        data = fd.read(block_size)
+        if not data:
+            break
+
+        lines = data.split('\n')
+        if remainder:
+            lines[0] = remainder + lines[0]
+        remainder = lines.pop()
+        if lines:
+            yield lines
+
+    if remainder:
+        yield [remainder]
+
+
+class LogLineReader(object):
+    """Resumable log file line reader
+
+    Reads lines of a LogFile in blocks of block_size bytes like
+    iter_line_blocks, keeping the reading state in the reader. The file can be
+    closed between blocks with close(), and is reopened and positioned to the
+    offset where reading stopped when the next block is read, so many files
+    can be read in turns with a bounded number of open files.
+
+    If read_callback is set, it is called with the reader after each block is
+    read from the file.
+
+    With follow=True end of file is not final: a partial last line is kept
+    until it is completed, and reading continues when the file grows.
+
+    Open files given as LogFile path, like sys.stdin, are read one line at a
+    time, so reading does not block waiting for a full block.
+
     """
-    def __init__(self, logfile, line, year, source_formats):
-        line = line.rstrip()
+    def __init__(self, logfile, fd=None, offset=0, block_size=DEFAULT_READ_BLOCK_SIZE, read_callback=None, follow=False):
         self.logfile = logfile
-        self.line = line
-        self.message_fields = {}
+        self.fd = fd
+        self.offset = offset
+        self.block_size = block_size
+        self.read_callback = read_callback
+        self.follow = follow
+        self.mtime = None
+        self.compression = None
+        self.remainder = ''
+        self.eof = False
 
-        self.version = None
-        self.host = None
-        self.program = None
-        self.pid = None
+    def __repr__(self):
+        return '{0} offset {1:d}'.format(self.logfile.path, self.offset)
 
-        try:
-            mon, day, time, line = line.split(None, 3)
-        except ValueError:
-            raise LogFileError('Error splitting log line: {0}'.format(self.line))
+    def __iter__(self):
+        while True:
+            lines = self.read_lines()
+            if not lines:
+                return
+            for line in lines:
+                yield line
+
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    @property
+    def seekable(self):
+        """
+        True if the file can be reopened at offset without decompressing it from the start
+        """
+        if self.compression is None:
+            return True
+        index = self.compression == 'gzip' and self.logfile.__current_gzip_index__() or None
+        return index is not None and index.covers(self.offset)
+
+    def open(self):
+        """Open file
+
+        Open the file positioned to the offset where reading stopped. The gzip
+        index is used if a current one is saved, but it is not built here.
+
+        """
+        fd, mtime = self.logfile.__open__()
+        if self.mtime is None:
+            self.mtime = mtime
+        if isinstance(self.logfile.path, basestring):
+            self.compression = detect_compression(self.logfile.path)
+        if self.offset > 0:
+            try:
+                fd = self.logfile.__seek_uncompressed__(fd, self.offset, build_index=False)
+            except (IOError, OSError), (ecode, emsg):
+                raise LogFileError('Error seeking file {0}: {1}'.format(self.logfile.path, emsg))
+        self.fd = fd
+
+    def close(self):
+        """
+        Close the file, it is opened again when next block is read
+        """
+        if self.fd is not None and self.fd is not self.logfile.path:
+            self.fd.close()
+        self.fd = None
+
+    def read_lines(self):
+        """Read lines
+
+        Return list of lines from next block of the file, without line
+        endings, or empty list at end of file. A line split between blocks is
+        returned with the next block.
+
+        """
+        while not self.eof:
+            if self.fd is None:
+                self.open()
+
+            try:
+                if self.fd is self.logfile.path:
+                    data = self.fd.readline()
+                else:
+                    data = self.fd.read(self.block_size)
+            except (IOError, OSError), (ecode, emsg):
+                raise LogFileError('Error reading file {0}: {1}'.format(self.logfile.path, emsg))
+            if self.read_callback is not None:
+                self.read_callback(self)
+
+            if not data:
+                if self.follow:
+                    break
+                self.eof = True
+                if self.remainder:
+                    lines = [self.remainder]
+                    self.remainder = ''
+                    return lines
+                break
+
+            self.offset += len(data)
+            lines = data.split('\n')
+            if self.remainder:
+                lines[0] = self.remainder + lines[0]
+            self.remainder = lines.pop()
+            if lines:
+                return lines
+
+        return []
 
+
+def detect_compression(path):
+    """Detect compression
+
+    Return compression format name from COMPRESSION_MAGIC for given file
+    based on magic bytes, or None for uncompressed files.
+
+    """
+    try:
+        with open(path, 'rb') as fd:
+            magic = fd.read(8)
+    except IOError, (ecode, emsg):
+        raise LogFileError('Error opening logfile {0}: {1}'.format(path, emsg))
+
+    for compression, value in COMPRESSION_MAGIC:
+        if magic.startswith(value):
+            return compression
+    return None
+
+
+def find_command(name):
+    """
+    Return path to command on PATH or None
+    """
+    for directory in os.getenv('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class DecompressorPipe(object):
+    """External decompressor pipe
+
+    Read only file object reading output of an external decompressor
+    command like 'pigz -dc path', so decompression runs in another process
+    while lines are parsed. Only forward seeks are supported.
+
+    """
+    def __init__(self, command, path):
+        self.command = command
+        self.path = path
+        self.position = 0
         try:
-            self.time = datetime.strptime('{0} {1} {2} {3}'.format(year, mon, day, time), '%Y %b %d %H:%M:%S')
-        except ValueError:
-            raise LogFileError('Error parsing entry time from line: {0}'.format(self.line))
+            self.process = Popen(list(command) + [path], stdout=PIPE, close_fds=True)
+        except OSError, (ecode, emsg):
+            raise LogFileError('Error running {0}: {1}'.format(' '.join(command), emsg))
+        self.stdout = self.process.stdout
+
+    def __iter__(self):
+        return self
+
+    def __check_exit__(self):
+        if self.process.wait() != 0:
+            raise LogFileError('Error decompressing {0} with {1}'.format(self.path, self.command[0]))
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def readline(self):
+        line = self.stdout.readline()
+        if line == '':
+            self.__check_exit__()
+        self.position += len(line)
+        return line
+
+    def read(self, size=-1):
+        data = self.stdout.read(size)
+        if data == '':
+            self.__check_exit__()
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        if offset < self.position:
+            raise LogFileError('Decompressor pipe can not seek backwards')
+        while self.position < offset:
+            if self.read(min(offset - self.position, 2**16)) == '':
+                break
+
+    def close(self):
+        if self.process is None:
+            return
+        self.stdout.close()
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        self.process.wait()
+        self.process = None
+
+
+def open_decompressor_pipe(compression, path):
+    """Open decompressor pipe
+
+    Return DecompressorPipe for first available command for the compression
+    format in EXTERNAL_DECOMPRESSORS, or None if no command is available.
+
+    """
+    for command in EXTERNAL_DECOMPRESSORS.get(compression, ()):
+        command_path = find_command(command[0])
+        if command_path is not None:
+            return DecompressorPipe((command_path, ) + command[1:], path)
+    return None
+
+
+class SyslogTimeParser(object):
+    """Syslog timestamp parser
+
+    Parses the 'mon day time' prefix of syslog lines with fixed offset slicing
+    and a month lookup table instead of datetime.strptime.
+
+    Consecutive log lines nearly always share the same second resolution
+    prefix, so the cache_size most recently used (year, prefix) values are
+    memoized in a LRU cache and the same datetime object is returned for them.
+
+    """
+    def __init__(self, cache_size=DEFAULT_TIMESTAMP_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__last = (None, None)
+
+    def __parse_prefix__(self, year, mon, day, time):
+        """Parse timestamp fields
+
+        Parse timestamp from split fields. Falls back to strptime for
+        month names not in SYSLOG_MONTHS.
+
+        """
+        month = SYSLOG_MONTHS.get(mon, None)
+        if month is None or len(time) != 8 or time[2:3] != ':' or time[5:6] != ':':
+            return datetime.strptime('{0} {1} {2} {3}'.format(year, mon, day, time), '%Y %b %d %H:%M:%S')
+        return datetime(year, month, int(day), int(time[:2]), int(time[3:5]), int(time[6:]))
+
+    def parse(self, year, mon, day, time):
+        """Parse timestamp
+
+        Return datetime for given year and syslog month, day and time fields.
+
+        Raises ValueError if the fields can't be parsed.
+
+        """
+        key = (year, mon, day, time)
+        last_key, value = self.__last
+        if key == last_key:
+            return value
 
         try:
-            self.source, self.message = [x.strip() for x in line.split(':', 1)]
-            for fmt in source_formats:
-                m = fmt.match(self.source)
-                if m:
-                    for k, v in m.groupdict().items():
-                        setattr(self, k, v)
-                    break
+            # Move to end of the LRU order
+            value = self.__cache.pop(key)
+        except KeyError:
+            value = self.__parse_prefix__(year, mon, day, time)
+            if len(self.__cache) >= self.cache_size:
+                self.__cache.popitem(last=False)
+        self.__cache[key] = value
+
+        self.__last = (key, value)
+        return value
+
+    def parse_line(self, line, year):
+        """Parse timestamp from line
+
+        Returns tuple (time, remainder) where remainder is the part of line
+        after the timestamp prefix.
+
+        Raises LogFileError if line can't be split or timestamp can't be parsed.
+
+        """
+        if line[3:4] == ' ' and line[6:7] == ' ' and line[15:16] == ' ':
+            mon, day, time, remainder = line[:3], line[4:6], line[7:15], line[16:].lstrip()
+            if remainder == '':
+                raise LogFileError('Error splitting log line: {0}'.format(line))
+        else:
+            try:
+                mon, day, time, remainder = line.split(None, 3)
+            except ValueError:
+                raise LogFileError('Error splitting log line: {0}'.format(line))
 
+        try:
+            return self.parse(year, mon, day, time), remainder
         except ValueError:
-            # Lines like '--- last message repeated 2 times ---'
-            self.source = None
-            self.message = line
+            raise LogFileError('Error parsing entry time from line: {0}'.format(line))
+
+
+# Shared timestamp parser for entries created without a LogFile
+DEFAULT_TIME_PARSER = SyslogTimeParser()
+
+
+class SourceFormats(list):
+    """Compiled syslog source formats
+
+    List of source format regexps with a single pass matcher. Consecutive
+    formats with same flags are merged to one alternation regexp with
+    renamed groups, so matching a source runs at most one regexp.
+
+    Formats are pre-classified by first character: formats starting with
+    a literal '<' are only tried for sources starting with '<'. Order of
+    formats is preserved, so the first matching format wins as before.
+
+    """
+    def __init__(self, formats=SOURCE_FORMATS):
+        list.__init__(self, [isinstance(fmt, basestring) and re.compile(fmt) or fmt for fmt in formats])
+        self.__matchers = {
+            True: self.__merge_formats__(self),
+            False: self.__merge_formats__([fmt for fmt in self if not self.__requires_bracket__(fmt)]),
+        }
+
+    def __requires_bracket__(self, fmt):
+        return fmt.pattern[:2] == '^<' or fmt.pattern[:1] == '<'
+
+    def __mergeable__(self, fmt):
+        return re.search(r'\\[1-9]|\(\?P=', fmt.pattern) is None
+
+    def __merge_formats__(self, formats):
+        """Merge formats
+
+        Returns list of (regexp, alternatives, markers) tuples. Alternatives is
+        None for formats which could not be merged, otherwise a dictionary
+        mapping each group name of merged regexp to (groups, fields) of its
+        source format. Markers lists the marker group names of alternatives in
+        order.
+
+        """
+        runs = []
+        for fmt in formats:
+            if runs and runs[-1][0] == fmt.flags and self.__mergeable__(fmt) and self.__mergeable__(runs[-1][1][-1]):
+                # Python re module supports at most 100 groups per regexp
+                if sum(x.groups + 1 for x in runs[-1][1]) + fmt.groups + 1 < 100:
+                    runs[-1][1].append(fmt)
+                    continue
+            runs.append((fmt.flags, [fmt]))
+
+        matchers = []
+        for flags, run in runs:
+            if len(run) == 1:
+                matchers.append((run[0], None, None))
+                continue
+
+            patterns = []
+            alternatives = {}
+            markers = []
+            for index, fmt in enumerate(run):
+                # Empty marker group makes sure every alternative has a named group
+                marker = '_f{0:d}'.format(index)
+                markers.append(marker)
+                fields = tuple(fmt.groupindex.keys())
+                groups = tuple('{0}_{1}'.format(marker, name) for name in fields)
+                for group in (marker, ) + groups:
+                    alternatives[group] = (groups, fields)
+                pattern = re.sub(r'\(\?P<([^>]+)>', r'(?P<{0}_\1>'.format(marker), fmt.pattern)
+                patterns.append('(?P<{0}>)(?:{1})'.format(marker, pattern))
+            matchers.append((re.compile('|'.join(patterns), flags), alternatives, markers))
+
+        return matchers
+
+    def match_fields(self, source):
+        """Match source fields
+
+        Returns list of (field, value) tuples for first format matching given
+        source, or None if no format matches.
+
+        """
+        for regexp, alternatives, markers in self.__matchers[source[:1] == '<']:
+            m = regexp.match(source)
+            if m is None:
+                continue
+
+            if alternatives is None:
+                return m.groupdict().items()
+
+            # Last matched group belongs to the matching alternative, unless
+            # it is unnamed: then look for the matched marker group
+            name = m.lastgroup
+            if name is None:
+                name = next(marker for marker in markers if m.group(marker) is not None)
+            groups, fields = alternatives[name]
+            if len(groups) == 1:
+                return [(fields[0], m.group(groups[0]))]
+            return zip(fields, m.group(*groups))
+
+        return None
+
+    def match(self, source):
+        """Match source
+
+        Returns dictionary of groups for first format matching given source,
+        or None if no format matches.
+
+        """
+        fields = self.match_fields(source)
+        if fields is None:
+            return None
+        return dict(fields)
+
+
+# Cache of SourceFormats compiled by compile_source_formats
+COMPILED_SOURCE_FORMATS = {}
+
+def compile_source_formats(formats):
+    """Compile source formats
+
+    Return SourceFormats for given list of source format regexps. Compiled
+    formats are cached, so repeated calls with same formats are cheap.
+
+    """
+    if isinstance(formats, SourceFormats):
+        return formats
+
+    key = tuple(isinstance(fmt, basestring) and (fmt, 0) or (fmt.pattern, fmt.flags) for fmt in formats)
+    try:
+        return COMPILED_SOURCE_FORMATS[key]
+    except KeyError:
+        COMPILED_SOURCE_FORMATS[key] = SourceFormats(formats)
+        return COMPILED_SOURCE_FORMATS[key]
+
+
+def parse_syslog_line(logfile, line, year, source_formats):
+    """Parse syslog line
+
+    Parse syslog line to (time, source, message, fields) tuple, where fields
+    is a list of (field, value) tuples from matching source format or None.
+
+    Timestamp is parsed with time_parser of logfile if available.
+
+    """
+    time_parser = getattr(logfile, 'time_parser', None)
+    if time_parser is None:
+        time_parser = DEFAULT_TIME_PARSER
+    time, line = time_parser.parse_line(line, year)
+
+    if not isinstance(source_formats, SourceFormats):
+        source_formats = compile_source_formats(source_formats)
+
+    try:
+        source, message = [x.strip() for x in line.split(':', 1)]
+    except ValueError:
+        # Lines like '--- last message repeated 2 times ---'
+        return time, None, line, None
+
+    return time, source, message, source_formats.match_fields(source)
+
+
+def format_source(host, program, pid):
+    """Format source
+
+    Format syslog entry source field from host, program and pid
+
+    """
+    if host is None and program is None:
+        return None
+    return '{0}{1}{2}'.format(
+        host is not None and '{0} '.format(host) or '',
+        program is not None and program or '',
+        pid is not None and '[{0}]'.format(pid) or '',
+    )
+
+
+def adopt_entry(entry, logfile):
+    """Adopt entry
+
+    Set logfile back reference of an unpickled entry, if entry type has one
+
+    """
+    try:
+        entry.logfile = logfile
+    except AttributeError:
+        pass
+
+
+class BaseLogEntry(object):
+    """
+    Common methods for syslog logfile entries
+    """
+    __slots__ = ()
 
     def __repr__(self):
         return '{0} {1}{2}{3}'.format(
@@ -384,6 +963,24 @@ class LogEntry(object):
             self.message
         )
 
+    def __getstate__(self):
+        """Pickle state
+
+        Entries are pickled without the logfile back reference
+
+        """
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for attr in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, attr):
+                    state[attr] = getattr(self, attr)
+        state.pop('logfile', None)
+        return state
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def append(self, message):
         self.message = '{0}\n{1}'.format(self.message, message.rstrip())
 
@@ -391,24 +988,201 @@ class LogEntry(object):
         self.message_fields.update(data)
 
 
-class LogFile(list):
+class LogEntry(BaseLogEntry):
+    """
+    Generic syslog logfile entry
+    """
+    def __init__(self, logfile, line, year, source_formats):
+        line = line.rstrip()
+        self.logfile = logfile
+        self.line = line
+        self.message_fields = {}
+
+        self.version = None
+        self.host = None
+        self.program = None
+        self.pid = None
+
+        self.time, self.source, self.message, fields = parse_syslog_line(logfile, line, year, source_formats)
+        if fields is not None:
+            for k, v in fields:
+                setattr(self, k, v)
+
+    @classmethod
+    def from_fields(cls, logfile, time, host, program, pid, message):
+        """Create entry from fields
+
+        Create entry from already parsed fields without a raw line
+
+        """
+        entry = cls.__new__(cls)
+        entry.logfile = logfile
+        entry.line = None
+        entry.message_fields = {}
+        entry.version = None
+        entry.time = time
+        entry.host = host
+        entry.program = program
+        entry.pid = pid
+        entry.source = format_source(host, program, pid)
+        entry.message = message
+        return entry
+
+
+class CompactLogEntry(BaseLogEntry):
+    """Memory compact syslog logfile entry
+
+    Syslog entry with __slots__ instead of __dict__ and no reference to the
+    logfile. Host, program, pid and other source fields are interned, so each
+    distinct value is stored only once. The raw line is only kept if
+    store_line is True, and source is rebuilt from host, program and pid. The
+    raw source is only kept when it can't be rebuilt exactly from them.
+
+    Source format groups other than the slotted fields are stored to
+    message_fields, which is created on first access.
+
+    With 64 bit CPython 2.7 an entry takes COMPACT_LOG_ENTRY_SIZE (136) bytes
+    plus its message string, compared to about 1.6 kB for a LogEntry with its
+    __dict__, line, source and message_fields. Use entry_memory_usage() to
+    check the figure for parsed entries.
+
+    """
+    __slots__ = ('time', 'host', 'program', 'pid', 'version', 'facility', 'level', 'message', 'line', '_source', '_message_fields')
+    logfile = None
+    store_line = False
+
+    def __init__(self, logfile, line, year, source_formats):
+        line = line.rstrip()
+        self.line = self.store_line and line or None
+        self._message_fields = None
+
+        self.version = None
+        self.facility = None
+        self.level = None
+        self.host = None
+        self.program = None
+        self.pid = None
+
+        self.time, source, self.message, fields = parse_syslog_line(logfile, line, year, source_formats)
+        if fields is not None:
+            for k, v in fields:
+                if k in self.__slots__:
+                    setattr(self, k, v is not None and intern(v) or None)
+                else:
+                    self.message_fields[k] = v
+
+        if source is not None and source != format_source(self.host, self.program, self.pid):
+            self._source = intern(source)
+        else:
+            self._source = None
+
+    @classmethod
+    def from_fields(cls, logfile, time, host, program, pid, message):
+        """Create entry from fields
+
+        Create entry from already parsed fields without a raw line
+
+        """
+        entry = cls.__new__(cls)
+        entry.line = None
+        entry._source = None
+        entry._message_fields = None
+        entry.version = None
+        entry.facility = None
+        entry.level = None
+        entry.time = time
+        entry.host = host
+        entry.program = program
+        entry.pid = pid
+        entry.message = message
+        return entry
+
+    @property
+    def source(self):
+        if self._source is not None:
+            return self._source
+        return format_source(self.host, self.program, self.pid)
+
+    @property
+    def message_fields(self):
+        if self._message_fields is None:
+            self._message_fields = {}
+        return self._message_fields
+
+
+def entry_memory_usage(entry):
+    """Entry memory usage
+
+    Return approximate number of bytes used by given log entry, counting the
+    entry and the per-entry objects it refers to. Interned strings and time
+    values shared between entries are not counted.
+
     """
-    Generic syslog file parser
+    size = sys.getsizeof(entry)
+    if hasattr(entry, '__dict__'):
+        size += sys.getsizeof(entry.__dict__)
+        values = entry.__dict__
+    else:
+        values = dict((k, getattr(entry, k, None)) for k in entry.__slots__)
+
+    for attr in ('line', 'source', 'message', 'message_fields', '_message_fields'):
+        if values.get(attr, None) is not None:
+            size += sys.getsizeof(values[attr])
+
+    return size
+
+
+class LogFile(list):
+    """Generic syslog file parser
+
+    With streaming=True the filters parse entries one at a time and only keep
+    matching entries, so memory use does not grow with file size. The iter_*
+    generators never store entries.
+
+    If parse_cache is set to a LogParseCache, reload() loads entries of files
+    which have not changed from the cache instead of parsing them.
+
+    If index_fields is set, for example to DEFAULT_INDEX_FIELDS, loaded
+    entries are indexed by the values of these fields while parsing and
+    filter_host, filter_program and filter_fields look up matching entries
+    from the index instead of scanning all entries.
+
+    With memory_map, streamed message filters on uncompressed files scan the
+    memory mapped file for the literal prefix of the regexp and only parse
+    entries containing it.
+
     """
     lineloader = LogEntry
-    def __init__(self, path, source_formats=SOURCE_FORMATS):
+    index_directory = DEFAULT_INDEX_DIRECTORY
+    index_interval = DEFAULT_INDEX_INTERVAL
+    gzip_checkpoint_span = DEFAULT_GZIP_CHECKPOINT_SPAN
+    external_decompressors = False
+    read_block_size = DEFAULT_READ_BLOCK_SIZE
+    memory_map = True
+    parse_cache = None
+    index_fields = None
+    def __init__(self, path, source_formats=SOURCE_FORMATS, streaming=False):
         if isinstance(path, basestring):
             self.path = os.path.expanduser(os.path.expandvars(path))
         else:
             self.path = path
 
-        self.source_formats = source_formats
+        self.source_formats = compile_source_formats(source_formats)
+        self.streaming = streaming
+        self.time_parser = SyslogTimeParser()
+        self.time_index = None
+        self.gzip_index = None
         self.mtime = None
 
         self.iterators = {}
         self.register_iterator('default')
 
         self.__loaded = False
+        self.__line_reader = None
+        self.__read_index = 0
+        self.__consumed = None
+        self.field_index = None
+        self.__indexed = 0
         self.fd = None
 
     def __repr__(self):
@@ -417,6 +1191,17 @@ class LogFile(list):
     def __iter__(self):
         return self
 
+    @property
+    def is_open(self):
+        return self.fd is not None
+
+    @property
+    def seekable(self):
+        """
+        True if the file can be closed and reopened at the offset where reading stopped cheaply
+        """
+        return self.__line_reader is None or self.__line_reader.seekable
+
     def register_iterator(self, name):
         if name in self.iterators:
             raise LogFileError('Iterator name already registered: {0}'.format(name))
@@ -451,72 +1236,74 @@ class LogFile(list):
                 self.iterators[name] = 0
 
     def __open_logfile__(self, path):
-        """Try opening log file
+        """Open log file
 
-        Try opening logfile in gz, bz2 and raw text formats
+        Open logfile in raw text, gz, bz2, xz or zstd format, detected from
+        magic bytes. With external_decompressors, compressed files are read
+        from an external decompressor pipe if one is available. Formats
+        without a python module are always read from a decompressor pipe.
 
         """
         if not os.path.isfile(path):
             raise LogFileError('No such file: {0}'.format(path))
 
+        compression = detect_compression(path)
         try:
-            fd = gzip.GzipFile(path)
-            fd.readline()
-            fd.seek(0)
-            return fd
+            if compression is None:
+                return open(path, 'r')
+
+            if self.external_decompressors:
+                fd = open_decompressor_pipe(compression, path)
+                if fd is not None:
+                    return fd
+
+            if compression == 'gzip':
+                return gzip.GzipFile(path)
+            if compression == 'bzip2':
+                return bz2.BZ2File(path)
+            if compression == 'xz' and lzma is not None:
+                return lzma.LZMAFile(path)
+
         except IOError, emsg:
-            pass
+            raise LogFileError('Error opening logfile {0}: {1}'.format(path, emsg))
 
-        try:
-            fd = bz2.BZ2File(path)
-            fd.readline()
-            fd.seek(0)
-            return fd
-        except IOError:
-            pass
+        fd = open_decompressor_pipe(compression, path)
+        if fd is None:
+            raise LogFileError('No decompressor available for {0} file {1}'.format(compression, path))
+        return fd
 
-        try:
-            fd = open(path, 'r')
-            fd.readline()
-            fd.seek(0)
-            return fd
-        except IOError:
-            pass
+    def __open__(self):
+        """Open log file
+
+        Returns tuple (fd, mtime) for self.path, which may be a path or an open file
+
+        """
+        if isinstance(self.path, file):
+            return self.path, datetime.now()
 
-        raise LogFileError('Error opening logfile {0}'.format(path))
+        try:
+            fd = self.__open_logfile__(self.path)
+            return fd, datetime.fromtimestamp(os.stat(self.path).st_mtime)
+        except OSError, (ecode, emsg):
+            raise LogFileError('Error opening {0}: {1}'.format(self.path, emsg))
 
     def next_iterator_match(self, iterator, callback=None):
         if iterator not in self.iterators:
             raise LogFileError('Unknown iterator: {0}'.format(iterator))
 
         if not self.__loaded:
-            if self.fd == None:
-                if isinstance(self.path, file):
-                    self.fd = self.path
-                    self.mtime = datetime.now()
-                else:
-                    try:
-                        self.fd = self.__open_logfile__(self.path)
-                        self.mtime = datetime.fromtimestamp(os.stat(self.path).st_mtime)
-                    except OSError, (ecode, emsg):
-                        raise LogFileError('Error opening {0}: {1}'.format(self.path, emsg))
+            if self.fd is None and self.__line_reader is None:
+                self.fd, self.mtime = self.__open__()
 
             while True:
-                if self.get_iterator(iterator) < len(self)-1:
-                    try:
-                        entry = self[self.get_iterator(iterator)]
-                    except IndexError:
+                index = self.get_iterator(iterator)
+                while index >= len(self):
+                    if not self.read_block():
                         self.reset_iterator(iterator)
                         raise StopIteration
 
-                else:
-                    entry = self.readline()
-
-                if entry is None:
-                    self.reset_iterator(iterator)
-                    raise StopIteration
-
-                self.update_iterator(iterator, len(self)-1)
+                entry = self[index]
+                self.update_iterator(iterator, index + 1)
                 if callback is not None:
                     if callback(entry):
                         return entry
@@ -551,47 +1338,1215 @@ class LogFile(list):
         """
         return self.next_iterator_match(iterator='default')
 
-    def readline(self):
+    def __append_continuation__(self, line):
+        """Append continuation line
+
+        Append continuation line of multiline log entry to last entry
+
         """
-        Parse entry from logfile
+        self[-1].append(line)
+
+    def __remove_last_entry__(self):
+        """Remove last entry
+
+        Remove last loaded entry to parse it again
+
+        """
+        self.__delitem__(-1)
+
+    def __clear_entries__(self):
+        """Clear entries
+
+        Remove all loaded entries
+
+        """
+        self.__delslice__(0, len(self))
+
+    def __clear_field_index__(self):
+        """
+        Clear field index
+        """
+        self.field_index = None
+        self.__indexed = 0
+
+    def __index_entries__(self, entries, start):
+        """Index entries
+
+        Add given entries appended at position start to the field index. If
+        the index is not up to date, it is updated later when used.
+
+        """
+        if self.index_fields is None or start != self.__indexed:
+            return
+
+        if self.field_index is None:
+            self.field_index = dict((field, {}) for field in self.index_fields)
+
+        for field, index in self.field_index.items():
+            if isinstance(field, tuple):
+                getter = operator.attrgetter(*field)
+            else:
+                getter = operator.attrgetter(field)
+            for position, entry in enumerate(entries, start):
+                value = getter(entry)
+                try:
+                    index[value].append(position)
+                except KeyError:
+                    index[value] = array(INT64_TYPECODE, [position])
+
+        self.__indexed = start + len(entries)
+
+    def __unindex_last_entry__(self):
+        """
+        Remove last entry from the field index
+        """
+        if self.field_index is None or self.__indexed != len(self):
+            return
+
+        entry = self[-1]
+        for field, index in self.field_index.items():
+            if isinstance(field, tuple):
+                value = operator.attrgetter(*field)(entry)
+            else:
+                value = operator.attrgetter(field)(entry)
+            index[value].pop()
+            if not index[value]:
+                del index[value]
+        self.__indexed -= 1
+
+    def get_field_index(self):
+        """Get field index
+
+        Return field index dictionary for index_fields, with dictionary of
+        entry positions by value for each field, or None if index_fields is
+        not set. Entries not yet indexed are indexed first.
+
+        """
+        if self.index_fields is None:
+            return None
+
+        if self.field_index is not None and sorted(self.field_index.keys()) != sorted(self.index_fields):
+            self.__clear_field_index__()
+        if self.field_index is None or self.__indexed < len(self):
+            self.__index_entries__(self[self.__indexed:len(self)], self.__indexed)
+        return self.field_index
+
+    def load_entries(self, entries, mtime=None):
+        """Load parsed entries
+
+        Replace entries with given already parsed entries, for example entries
+        parsed in another process, and mark the file loaded.
+
+        """
+        self.__clear_entries__()
+        self.__clear_field_index__()
+        for entry in entries:
+            adopt_entry(entry, self)
+            self.append(entry)
+
+        if mtime is not None:
+            self.mtime = mtime
+        self.__loaded = True
+        self.__consumed = None
+
+    def read_block(self):
+        """Read block of entries
+
+        Read next block of lines from the file, parse the lines to entries in
+        one batch and append the entries. Continuation lines are appended to
+        the previous entry, also across block boundaries.
+
+        Returns number of entries parsed, 0 when end of file was reached.
+
+        """
+        if self.__line_reader is None:
+            if self.fd is None:
+                raise LogFileError('File was not loaded')
+            self.__line_reader = LogLineReader(self, self.fd, block_size=self.read_block_size)
+
+        lineloader = self.lineloader
+        year = self.mtime.year
+        source_formats = self.source_formats
+        count = len(self)
+        while True:
+            lines = self.__line_reader.read_lines()
+            self.fd = self.__line_reader.fd
+            if lines:
+                entries = []
+                for line in lines:
+                    # Multiline log entry
+                    if line[:1] in (' ', '\t'):
+                        if entries:
+                            entries[-1].append(line)
+                            continue
+                        if len(self):
+                            self.__append_continuation__(line)
+                            continue
+                    entries.append(lineloader(self, line, year=year, source_formats=source_formats))
+
+                if entries:
+                    self.extend(entries)
+                    self.__index_entries__(entries, len(self) - len(entries))
+                    return len(self) - count
+                continue
+
+            self.__loaded = True
+            if isinstance(self.fd, file) and self.fd is not self.path:
+                # Open file keeps the inode reserved, so refresh() can detect rotation
+                self.__consume_path__(os.fstat(self.fd.fileno()), self.fd.tell())
+            else:
+                # Compressed files are reloaded by refresh(), don't keep decoder buffers
+                self.close()
+            return 0
+
+    def close(self):
+        """Close file
+
+        Close the file opened for reading entries. If the file was not fully
+        read, it is reopened and reading continues from the same offset when
+        more entries are needed.
+
+        """
+        if self.__line_reader is not None:
+            self.__line_reader.close()
+            if self.__loaded:
+                self.__line_reader = None
+        elif self.fd is not None and self.fd is not self.path:
+            self.fd.close()
+        self.fd = None
+
+    def readline(self):
+        """Parse entry from logfile
+
+        Return next entry read from the file, or None at end of file. Entries
+        already loaded by reload() are not returned again.
+
+        """
+        while self.__read_index >= len(self):
+            if not self.read_block():
+                return None
+
+        entry = self[self.__read_index]
+        self.__read_index += 1
+        return entry
+
+    def reload(self):
+        """Reload file
+
+        Reload file, clearing existing entries. Use refresh() to only parse
+        entries appended to the file.
+
+        """
+        self.__clear_entries__()
+        self.__clear_field_index__()
+        self.__loaded = False
+        self.__read_index = 0
+        self.__consumed = None
+        for name in self.iterators:
+            self.reset_iterator(name)
+
+        self.close()
+        self.__line_reader = None
+
+        if not self.__load_cached_entries__():
+            if self.fd is None:
+                self.fd, self.mtime = self.__open__()
+
+            while self.read_block():
+                pass
+
+            self.__save_cached_entries__()
+
+        self.__read_index = len(self)
+
+    def __last_entry_offset__(self, fd, offset):
+        """Last entry offset
+
+        Return offset of the start of the last entry ending at given offset
+
+        """
+        size = SEEK_SCAN_SIZE
+        while True:
+            start = max(0, offset - size)
+            fd.seek(start)
+            data = fd.read(offset - start)
+            position = len(data)
+            while True:
+                index = data.rfind('\n', 0, position)
+                if index < 0 and start > 0:
+                    break
+                if index < 0 or data[index + 1:index + 2] not in (' ', '\t'):
+                    return start + index + 1
+                position = index
+            size *= 2
+
+    def refresh(self):
+        """Refresh file
+
+        Parse entries appended to an uncompressed file since it was loaded and
+        append them to loaded entries. If the last line was not complete, the
+        last entry is parsed again. Registered iterators stay valid and
+        continue with the new entries.
+
+        The file is fully reloaded if it was truncated or rotated, or if it is
+        not an uncompressed file. Files truncated in place and grown past the
+        consumed offset again are detected by a checksum of the head of the
+        consumed data.
+
+        Returns number of new entries.
+
+        """
+        count = len(self)
+        if not self.__loaded and (self.fd is not None or self.__line_reader is not None):
+            while self.read_block():
+                pass
+            return len(self) - count
+
+        if self.__consumed is None:
+            self.reload()
+            return len(self)
+
+        device, inode, offset, checksum = self.__consumed
+        try:
+            st = os.stat(self.path)
+        except OSError, (ecode, emsg):
+            raise LogFileError('Error running stat on {0}: {1}'.format(self.path, emsg))
+
+        if (st.st_dev, st.st_ino) != (device, inode) or st.st_size < offset:
+            self.reload()
+            return len(self)
+
+        if st.st_size == offset and datetime.fromtimestamp(st.st_mtime) == self.mtime:
+            return 0
+
+        # Truncated in place and written past the consumed offset again
+        if checksum is None or self.__head_checksum__(device, inode, offset) != checksum:
+            self.reload()
+            return len(self)
+
+        if st.st_size == offset:
+            self.mtime = datetime.fromtimestamp(st.st_mtime)
+            return 0
+
+        try:
+            if self.fd is None:
+                self.fd = open(self.path, 'r')
+
+            if offset > 0:
+                self.fd.seek(offset - 1)
+                if self.fd.read(1) != '\n':
+                    offset = self.__last_entry_offset__(self.fd, offset)
+                    self.__unindex_last_entry__()
+                    self.__remove_last_entry__()
+            self.fd.seek(offset)
+
+        except (IOError, OSError), (ecode, emsg):
+            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+
+        self.mtime = datetime.fromtimestamp(st.st_mtime)
+        self.__line_reader = LogLineReader(self, self.fd, offset, self.read_block_size)
+        self.__loaded = False
+        while self.read_block():
+            pass
+        return len(self) - count
+
+    def __head_checksum__(self, device, inode, offset):
+        """Head checksum
+
+        Return checksum of the first REFRESH_CHECKSUM_SIZE bytes of data
+        consumed up to offset from the uncompressed file, or None if the path
+        is not the file with given device and inode anymore.
+
+        The file is opened again, because the read buffer of an open file
+        may still contain data replaced in the file.
+
+        """
+        try:
+            with open(self.path, 'r') as fd:
+                st = os.fstat(fd.fileno())
+                if (st.st_dev, st.st_ino) != (device, inode):
+                    return None
+                return zlib.crc32(fd.read(min(offset, REFRESH_CHECKSUM_SIZE)))
+        except (IOError, OSError), (ecode, emsg):
+            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+
+    def __consume_path__(self, st, offset):
+        """
+        Mark file with given stat consumed up to offset
+        """
+        self.__consumed = (st.st_dev, st.st_ino, offset, self.__head_checksum__(st.st_dev, st.st_ino, offset))
+
+    def __load_cached_entries__(self):
+        """Load cached entries
+
+        Load entries from parse_cache if it has entries for the file. Returns
+        True if entries were loaded.
+
+        """
+        if self.parse_cache is None or not isinstance(self.path, basestring):
+            return False
+
+        try:
+            st = os.stat(self.path)
+            entries = self.parse_cache.load(self.path, self.lineloader, self.source_formats)
+        except OSError, (ecode, emsg):
+            raise LogFileError('Error running stat on {0}: {1}'.format(self.path, emsg))
+        except LogCacheError, emsg:
+            raise LogFileError(emsg)
+        if entries is None:
+            return False
+
+        self.load_entries(entries, datetime.fromtimestamp(st.st_mtime))
+        self.__consume_path__(st, st.st_size)
+        return True
+
+    def __save_cached_entries__(self):
+        """
+        Save loaded entries to parse_cache
+        """
+        if self.parse_cache is None or not isinstance(self.path, basestring):
+            return
+
+        try:
+            self.parse_cache.save(self.path, self.lineloader, self.source_formats,
+                (self[index] for index in xrange(len(self)))
+            )
+        except LogCacheError, emsg:
+            raise LogFileError(emsg)
+
+    def __iter_lines_entries__(self, lines, year):
+        """Iterate entries from lines
+
+        Generator yielding entries parsed from given iterable of lines, with
+        continuation lines appended to the previous entry
+
+        """
+        entry = None
+        for line in lines:
+            # Multiline log entry
+            if entry is not None and line[:1] in [' ', '\t']:
+                entry.append(line)
+                continue
+
+            if entry is not None:
+                yield entry
+            entry = self.lineloader(self, line,
+                year=year,
+                source_formats=self.source_formats
+            )
+
+        if entry is not None:
+            yield entry
+
+    def __align_offset__(self, fd, offset):
+        """Align offset to entry start
+
+        Return offset of first line starting at or after given offset which is
+        not a continuation line of the previous entry.
+
+        """
+        if offset == 0:
+            return 0
+
+        fd.seek(offset - 1)
+        fd.readline()
+        while True:
+            position = fd.tell()
+            if fd.readline()[:1] not in [' ', '\t']:
+                return position
+
+    def parse_range(self, start, end, year):
+        """Parse byte range
+
+        Return list of entries parsed from given byte range of an uncompressed
+        file. Range must start at the start of an entry.
+
+        """
+        fd = open(self.path, 'r')
+        try:
+            fd.seek(start)
+            lines = fd.read(end - start).split('\n')
+        except IOError, (ecode, emsg):
+            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+        finally:
+            fd.close()
+
+        if lines[-1] == '':
+            lines.pop()
+        return list(self.__iter_lines_entries__(lines, year))
+
+    def parallel_load(self, processes=None, chunk_size=DEFAULT_PARALLEL_CHUNK_SIZE):
+        """Load file in parallel
+
+        Split an uncompressed file to byte ranges of about chunk_size bytes,
+        aligned to entry starts so continuation lines stay with their entry,
+        parse the ranges in a multiprocessing pool and load the entries in
+        order. The result is identical to sequential reload().
+
+        Compressed files and open file objects are loaded sequentially.
+
+        """
+        fd, mtime = self.__open__()
+        try:
+            if not isinstance(fd, file) or fd is self.path:
+                return self.reload()
+
+            st = os.fstat(fd.fileno())
+            size = st.st_size
+            offsets = [0]
+            for offset in xrange(chunk_size, size, chunk_size):
+                offset = self.__align_offset__(fd, offset)
+                if offset > offsets[-1] and offset < size:
+                    offsets.append(offset)
+            offsets.append(size)
+
+        finally:
+            if fd is not self.path:
+                fd.close()
+
+        results = map_parallel(parallel_range_worker, [
+            (type(self), self.path, list(self.source_formats), mtime.year, start, end)
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ], processes)
+        self.load_entries((entry for entries in results for entry in entries), mtime)
+        self.__consume_path__(st, size)
+
+    def iter_entries(self, reader=None):
+        """Iterate entries
+
+        Generator parsing and yielding entries one at a time from the file,
+        without storing them. If the file is already fully loaded, loaded
+        entries are yielded instead.
+
+        The file is opened separately from self.fd, so this does not affect
+        registered iterators. If reader is given, lines are read with given
+        LogLineReader for the file, which may be closed between blocks to limit
+        open files.
+
+        """
+        if self.__loaded:
+            for index in xrange(len(self)):
+                yield self[index]
+            return
+
+        if reader is None:
+            reader = LogLineReader(self, block_size=self.read_block_size)
+
+        try:
+            if reader.mtime is None:
+                reader.open()
+            for entry in self.__iter_lines_entries__(reader, reader.mtime.year):
+                yield entry
+
+        finally:
+            reader.close()
+
+    def __parse_time__(self, line, year):
+        """Parse entry time
+
+        Return time of entry starting with given line, or None if the line
+        can't be parsed. Used to build time indexes.
+
+        """
+        try:
+            return self.time_parser.parse_line(line.rstrip(), year)[0]
+        except LogFileError:
+            return None
+
+    def get_time_index(self):
+        """Time offset index
+
+        Return LogTimeIndex for the file. Saved index is loaded from
+        index_directory (or <path>.timeindex next to the file if it is None)
+        and built or extended if the file has changed. If the index can't be
+        saved it is only kept in memory.
+
+        """
+        if not isinstance(self.path, basestring):
+            raise LogFileError('Time index requires a file path')
+
+        if self.time_index is None:
+            self.time_index = LogTimeIndex(self.path, self.index_directory, self.index_interval)
+            self.time_index.load()
+
+        try:
+            if self.time_index.is_current():
+                return self.time_index
+        except LogIndexError, emsg:
+            raise LogFileError(emsg)
+
+        fd, mtime = self.__open__()
+        try:
+            if self.time_index.update(fd, lambda line: self.__parse_time__(line, mtime.year)):
+                try:
+                    self.time_index.save()
+                except LogIndexError:
+                    pass
+        except LogIndexError, emsg:
+            raise LogFileError(emsg)
+        finally:
+            fd.close()
+
+        return self.time_index
+
+    def __scan_time__(self, fd, offset, value, year, limit=None):
+        """Scan for time
+
+        Read entries from offset, which must be an entry start, and return
+        offset of first entry with time at or after value. Returns limit if
+        no such entry is found before limit, or end of file.
+
+        """
+        fd.seek(offset)
+        while limit is None or offset < limit:
+            line = fd.readline()
+            if line == '':
+                break
+            if line[:1] not in [' ', '\t']:
+                entry_time = self.__parse_time__(line, year)
+                if entry_time is not None and entry_time >= value:
+                    return offset
+            offset += len(line)
+        return limit is not None and limit or offset
+
+    def __time_at__(self, fd, offset, year, limit):
+        """Time at offset
+
+        Return time of first parseable entry from offset before limit, or None
+
+        """
+        fd.seek(offset)
+        while offset < limit:
+            line = fd.readline()
+            if line == '':
+                break
+            if line[:1] not in [' ', '\t']:
+                entry_time = self.__parse_time__(line, year)
+                if entry_time is not None:
+                    return entry_time
+            offset += len(line)
+        return None
+
+    def seek_time(self, value, backtrack=DEFAULT_SEEK_BACKTRACK):
+        """Seek to time
+
+        Return byte offset of first entry at or after given time, without an
+        index. For uncompressed files the offset is found by bisecting byte
+        offsets, resyncing each probe to the next entry start and parsing just
+        the timestamp, so only O(log n) reads are needed. Files are assumed
+        to be nearly sorted: after bisecting, up to backtrack bytes before the
+        found offset are scanned for earlier positioned entries at or after
+        the time. Compressed files are scanned linearly.
+
+        """
+        if not isinstance(self.path, basestring):
+            raise LogFileError('Seeking requires a file path')
+
+        fd, mtime = self.__open__()
+        try:
+            year = mtime.year
+            if not isinstance(fd, file):
+                return self.__scan_time__(fd, 0, value, year)
+
+            low = 0
+            high = os.fstat(fd.fileno()).st_size
+            while high - low > SEEK_SCAN_SIZE:
+                middle = self.__align_offset__(fd, (low + high) // 2)
+                if middle >= high:
+                    break
+                entry_time = self.__time_at__(fd, middle, year, high)
+                if entry_time is not None and entry_time < value:
+                    low = middle
+                else:
+                    high = middle
+
+            offset = self.__scan_time__(fd, low, value, year)
+            if backtrack and offset > 0:
+                offset = self.__scan_time__(fd, self.__align_offset__(fd, max(0, offset - backtrack)), value, year, offset)
+            return offset
+
+        except (IOError, OSError), (ecode, emsg):
+            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+
+        finally:
+            fd.close()
+
+    def get_gzip_index(self):
+        """Gzip checkpoint index
+
+        Return GzipCheckpointIndex for a gzip compressed file, stored next to
+        the time index. Saved index is loaded or built if the file has
+        changed. Raises LogFileError if the index can't be built.
+
+        """
+        if not isinstance(self.path, basestring):
+            raise LogFileError('Gzip index requires a file path')
+
+        try:
+            if self.gzip_index is None:
+                self.gzip_index = GzipCheckpointIndex(self.path, self.index_directory, self.gzip_checkpoint_span)
+                self.gzip_index.load()
+
+            if self.gzip_index.update():
+                try:
+                    self.gzip_index.save()
+                except LogIndexError:
+                    pass
+
+        except LogIndexError, emsg:
+            raise LogFileError(emsg)
+
+        return self.gzip_index
+
+    def __current_gzip_index__(self):
+        """
+        Return saved gzip index if it matches the file, without building it
+        """
+        if not isinstance(self.path, basestring):
+            return None
+
+        try:
+            if self.gzip_index is None:
+                index = GzipCheckpointIndex(self.path, self.index_directory, self.gzip_checkpoint_span)
+                if not index.load():
+                    return None
+                self.gzip_index = index
+            if self.gzip_index.is_current():
+                return self.gzip_index
+        except LogIndexError:
+            pass
+        return None
+
+    def __seek_uncompressed__(self, fd, offset, build_index=True):
+        """Seek to uncompressed offset
+
+        Return fd positioned at given offset. Gzip files are reopened from
+        nearest gzip index checkpoint, if the index can be used. Without
+        build_index only a saved current index is used, and the file is
+        otherwise decompressed up to offset.
+
+        """
+        if offset > 0 and detect_compression(self.path) == 'gzip':
+            try:
+                index = build_index and self.get_gzip_index() or self.__current_gzip_index__()
+                if index is None:
+                    raise LogIndexError('No current gzip index')
+                reader = index.open(offset)
+                fd.close()
+                return reader
+            except LogFileError:
+                pass
+            except LogIndexError:
+                pass
+
+        fd.seek(offset)
+        return fd
+
+    def iter_time_range(self, start=None, end=None, use_index=True, seek=True):
+        """Iterate entries in time range
+
+        Generator yielding entries with start <= time < end. With use_index
+        the time index is used to seek to the region of the file containing
+        the range and to skip the file if it has no entries in the range.
+        For gzip files decompression starts from the nearest checkpoint of
+        the gzip index. Without index, seek uses seek_time() to find the
+        region of the range in nearly sorted files.
+
+        """
+        if not isinstance(self.path, basestring) or self.__loaded or not (use_index or seek):
+            for entry in self.iter_entries():
+                if (start is None or entry.time >= start) and (end is None or entry.time < end):
+                    yield entry
+            return
+
+        if use_index:
+            time_index = self.get_time_index()
+            if not time_index.overlaps(start, end):
+                return
+            start_offset, end_offset = time_index.seek_range(start, end)
+
+        else:
+            start_offset = start is not None and self.seek_time(start) or 0
+            end_offset = None
+            if end is not None:
+                end_offset = self.seek_time(end) + DEFAULT_SEEK_BACKTRACK
+
+        fd, mtime = self.__open__()
+        try:
+            fd = self.__seek_uncompressed__(fd, start_offset)
+            for entry in self.__iter_lines_entries__(self.__iter_region__(fd, start_offset, end_offset), mtime.year):
+                if (start is None or entry.time >= start) and (end is None or entry.time < end):
+                    yield entry
+
+        except (IOError, OSError), (ecode, emsg):
+            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+
+        finally:
+            fd.close()
+
+    def __iter_region__(self, fd, offset, end_offset):
+        """Iterate region lines
+
+        Generator yielding lines from fd positioned at offset until the first
+        entry starting at or after end_offset. Continuation lines are yielded
+        also after end_offset, so end_offset does not need to be aligned to an
+        entry start and fd is only read forward.
+
+        """
+        for line in fd:
+            if end_offset is not None and offset >= end_offset and line[:1] not in [' ', '\t']:
+                break
+            offset += len(line)
+            yield line
+
+    def __iter_mapped_candidates__(self, literal):
+        """Iterate memory mapped candidate entries
+
+        Generator scanning the memory mapped file for given literal and
+        yielding entries whose first line contains it. Lines of other entries
+        are never copied from the mapping or parsed.
+
+        """
+        fd = open(self.path, 'r')
+        try:
+            size = os.fstat(fd.fileno()).st_size
+            if size == 0:
+                return
+            year = datetime.fromtimestamp(os.fstat(fd.fileno()).st_mtime).year
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, mmap.error), (ecode, emsg):
+            raise LogFileError('Error mapping file {0}: {1}'.format(self.path, emsg))
+        finally:
+            fd.close()
+
+        try:
+            position = 0
+            while True:
+                index = mapped.find(literal, position)
+                if index < 0:
+                    break
+
+                start = mapped.rfind('\n', 0, index) + 1
+                end = mapped.find('\n', index)
+                if end < 0:
+                    end = size
+
+                # Messages start on the first line of an entry
+                if start > 0 and mapped[start] in (' ', '\t'):
+                    position = end + 1
+                    continue
+
+                while end + 1 < size and mapped[end + 1] in (' ', '\t'):
+                    end = mapped.find('\n', end + 1)
+                    if end < 0:
+                        end = size
+
+                for entry in self.__iter_lines_entries__(mapped[start:end].split('\n'), year):
+                    yield entry
+                position = end + 1
+
+        finally:
+            mapped.close()
+
+    def __iter_message_candidates__(self, message_regexp):
+        """Iterate message filter candidates
+
+        Iterate entries which may match given compiled message regexp. With
+        memory_map, entries of an uncompressed file which is not loaded are
+        prefiltered by the literal prefix of the regexp in the mapped file.
+
+        """
+        if self.memory_map and not self.__loaded and isinstance(self.path, basestring):
+            literal = literal_prefix(message_regexp)
+            if literal and detect_compression(self.path) is None:
+                return self.__iter_mapped_candidates__(literal)
+        return self.iter_entries()
+
+    def iter_host(self, host):
+        """Iterate by host name
+
+        Generator yielding streamed log entries matching given host name
+
+        """
+        for entry in self.iter_entries():
+            if entry.host == host:
+                yield entry
+
+    def iter_program(self, program):
+        """Iterate by program name
+
+        Generator yielding streamed log entries matching given program name
+
+        """
+        for entry in self.iter_entries():
+            if entry.program == program:
+                yield entry
+
+    def iter_message(self, message_regexp):
+        """Iterate by message regexp
+
+        Generator yielding streamed log entries matching given regexp in
+        message field
+
+        """
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        for entry in self.__iter_message_candidates__(message_regexp):
+            if message_regexp.match(entry.message):
+                yield entry
+
+    def iter_match_message(self, message_regexp):
+        """Iterate message regexp matches
+
+        Generator yielding dictionary of matching regexp keys for streamed
+        entries matching given regexp in message field
+
+        """
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        for entry in self.__iter_message_candidates__(message_regexp):
+            m = message_regexp.match(entry.message)
+            if m:
+                yield m.groupdict()
+
+    def iter_match_rules(self, rules):
+        """Iterate rule matches
+
+        Generator yielding (rule name, entry, groupdict) tuples for streamed
+        entries matching rules in given LogRuleSet, or dictionary or list of
+        (name, regexp) tuples, with one pass over the entries.
+
+        """
+        if not isinstance(rules, LogRuleSet):
+            rules = LogRuleSet(rules)
+        return rules.iter_matches(self.iter_entries())
+
+    def filter_host(self, host):
+        """Filter by host name
+
+        Return log entries matching given host name
+
+        """
+        if self.streaming:
+            return list(self.iter_host(host))
+
+        if self.index_fields is not None:
+            return self.filter_fields(host=host)
+
+        if len(self) == 0:
+            self.reload()
+        return [x for x in self if x.host == host]
+
+    def filter_program(self, program):
+        """Filter by program name
+
+        Return log entries matching given program name
+
+        """
+        if self.streaming:
+            return list(self.iter_program(program))
+
+        if self.index_fields is not None:
+            return self.filter_fields(program=program)
+
+        if len(self) == 0:
+            self.reload()
+        return [x for x in self if x.program == program]
+
+    def __lookup_positions__(self, fields):
+        """Lookup positions
+
+        Return tuple (positions, names) with the smallest list of entry
+        positions in the field index for given field values and the names of
+        the fields it matches, or (None, ()) if no indexed field applies.
+
+        """
+        index = self.get_field_index()
+        if index is None:
+            return None, ()
+
+        best = (None, ())
+        for field, values in index.items():
+            names = isinstance(field, tuple) and field or (field, )
+            if not all(name in fields for name in names):
+                continue
+            if len(names) > 1:
+                positions = values.get(tuple(fields[name] for name in names), ())
+            else:
+                positions = values.get(fields[field], ())
+            if best[0] is None or len(positions) < len(best[0]):
+                best = (positions, names)
+        return best
+
+    def filter_fields(self, **fields):
+        """Filter by field values
+
+        Return log entries matching all given field values, for example
+        filter_fields(host='myhost', program='sshd'). With index_fields the
+        entries are looked up from the field index, so the cost depends on
+        number of matches instead of number of entries.
+
+        """
+        if self.streaming:
+            return [x for x in self.iter_entries() if all(getattr(x, k, None) == v for k, v in fields.items())]
+
+        if len(self) == 0:
+            self.reload()
+        elif not self.__loaded and (self.fd is not None or self.__line_reader is not None):
+            # Partially iterated file, load the remaining entries
+            while self.read_block():
+                pass
+
+        positions, names = self.__lookup_positions__(fields)
+        if positions is None:
+            positions = xrange(len(self))
+
+        remaining = [(k, v) for k, v in fields.items() if k not in names]
+        if not remaining:
+            return [self[position] for position in positions]
+
+        matches = []
+        for position in positions:
+            entry = self[position]
+            if all(getattr(entry, k, None) == v for k, v in remaining):
+                matches.append(entry)
+        return matches
+
+    def filter_message(self, message_regexp):
+        """Filter by message regexp
+
+        Filter log entries matching given regexp in message field
+
+        """
+        if self.streaming:
+            return list(self.iter_message(message_regexp))
+
+        if len(self) == 0:
+            self.reload()
+
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        return [x for x in self if message_regexp.match(x.message)]
+
+    def match_message(self, message_regexp):
+        """
+
+        Return dictionary of matching regexp keys for lines matching given regexp
+         in message field
+
+        """
+        if self.streaming:
+            return list(self.iter_match_message(message_regexp))
+
+        if len(self) == 0:
+            self.reload()
+
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        matches = []
+        for x in self:
+            m = message_regexp.match(x.message)
+            if not m:
+                continue
+            matches.append(m.groupdict())
+        return matches
+
+    def match_rules(self, rules):
+        """Match rules
+
+        Return dictionary of lists of (entry, groupdict) tuples by rule name
+        for rules in given LogRuleSet, or dictionary or list of (name, regexp)
+        tuples, with one pass over the entries.
+
+        """
+        if not isinstance(rules, LogRuleSet):
+            rules = LogRuleSet(rules)
+
+        if not self.streaming and len(self) == 0:
+            self.reload()
+        return rules.match(self.iter_entries())
+
+    def aggregate(self, interval=DEFAULT_AGGREGATE_INTERVAL, keys=('host', ), message_regexp=None,
+                  max_groups=DEFAULT_MAX_GROUPS):
+        """Aggregate entries
+
+        Return LogAggregation with counts of entries by time bucket of interval
+        seconds and given keys, computed in one pass over streamed entries, or
+        loaded entries if the file is loaded. Keys are entry attributes or
+        names of groups in message_regexp.
+
+        """
+        return LogAggregation(interval, keys, message_regexp, max_groups).update(self.iter_entries())
+
+    def heavy_hitters(self, key='program', epsilon=DEFAULT_TOPK_EPSILON, delta=DEFAULT_TOPK_DELTA):
+        """Heavy hitters
+
+        Return TopKSummary of most frequent values of key, an entry attribute
+        name or callable like logstats.message_template, computed in one pass
+        over streamed entries with memory bounded by epsilon
+
+        """
+        return TopKSummary(key, epsilon, delta).update(self.iter_entries())
+
+    def mine_templates(self, miner=None):
+        """Mine message templates
+
+        Add messages to given TemplateMiner, or a new one, in one pass over
+        streamed entries, or loaded entries if the file is loaded. Returns the
+        miner.
+
+        """
+        if miner is None:
+            miner = TemplateMiner()
+        return miner.update(self.iter_entries())
+
+
+class CompactLogFile(LogFile):
+    """
+    Syslog file parser storing entries as CompactLogEntry objects
+    """
+    lineloader = CompactLogEntry
+
+
+class ColumnDictionary(list):
+    """Dictionary encoded column values
+
+    List of distinct values with lookup of integer code for each value.
+    None is encoded as -1.
+
+    """
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        try:
+            return self.codes[value]
+        except KeyError:
+            code = len(self)
+            self.codes[value] = code
+            self.append(value)
+            return code
+
+    def decode(self, code):
+        if code < 0:
+            return None
+        return self[code]
+
+
+class ColumnarLogFile(LogFile):
+    """Columnar syslog file parser
+
+    Syslog file parser storing entries in column arrays instead of a list of
+    entry objects. Times are stored as int64 naive epoch seconds, host,
+    program and pid as dictionary encoded int codes and messages as offsets
+    to one shared text buffer.
+
+    Entries are built with lineloader.from_fields() when accessed by index
+    or returned from filters. Only time, host, program, pid and message are
+    stored: source format fields like version and message_fields are not
+    kept. Entries are not stored in the list itself, so list methods other
+    than indexing and len() do not see them.
+
+    """
+    def __init__(self, path, source_formats=SOURCE_FORMATS, streaming=False):
+        self.times = array(INT64_TYPECODE)
+        self.hosts = array('i')
+        self.programs = array('i')
+        self.pids = array('i')
+        self.message_offsets = array(INT64_TYPECODE, [0])
+        self.message_buffer = bytearray()
+        self.host_values = ColumnDictionary()
+        self.program_values = ColumnDictionary()
+        self.pid_values = ColumnDictionary()
+        self.__last_time = (None, None)
+        super(ColumnarLogFile, self).__init__(path, source_formats, streaming)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__build_entry__(i) for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('list index out of range')
+        return self.__build_entry__(index)
+
+    def __getslice__(self, start, stop):
+        return self.__getitem__(slice(start, stop))
+
+    def __encode_time__(self, value):
+        last_value, epoch = self.__last_time
+        if value is not last_value:
+            epoch = calendar.timegm(value.timetuple())
+            self.__last_time = (value, epoch)
+        return epoch
+
+    def __build_entry__(self, index):
+        return self.lineloader.from_fields(self,
+            datetime.utcfromtimestamp(self.times[index]),
+            self.host_values.decode(self.hosts[index]),
+            self.program_values.decode(self.programs[index]),
+            self.pid_values.decode(self.pids[index]),
+            self.message(index),
+        )
+
+    def __append_continuation__(self, line):
+        self.message_buffer.extend('\n{0}'.format(line.rstrip()))
+        self.message_offsets[-1] = len(self.message_buffer)
+
+    def __remove_last_entry__(self):
+        for column in (self.times, self.hosts, self.programs, self.pids, self.message_offsets):
+            column.pop()
+        del self.message_buffer[self.message_offsets[-1]:]
+
+    def __clear_entries__(self):
+        for column in (self.times, self.hosts, self.programs, self.pids):
+            del column[:]
+        del self.message_offsets[1:]
+        del self.message_buffer[:]
+
+    def append(self, entry):
+        """Append entry
+
+        Store given entry to the columns
+
         """
-        if self.fd is None:
-            raise LogFileError('File was not loaded')
-        try:
-            l = self.fd.readline()
-            if l == '':
-                self.__loaded = True
-                return None
+        self.times.append(self.__encode_time__(entry.time))
+        self.hosts.append(self.host_values.encode(entry.host))
+        self.programs.append(self.program_values.encode(entry.program))
+        self.pids.append(self.pid_values.encode(entry.pid))
+        self.message_buffer.extend(entry.message)
+        self.message_offsets.append(len(self.message_buffer))
 
-            # Multiline log entry
-            if l[:1] in [' ', '\t'] and len(self):
-                self[-1].append(l)
-                return self.readline()
+    def extend(self, entries):
+        """Extend entries
 
-            else:
-                entry = self.lineloader(self, l,
-                    year=self.mtime.year,
-                    source_formats=self.source_formats
-                )
-                self.append(entry)
-                return entry
+        Store given entries to the columns
 
-        except OSError, (ecode, emsg):
-            raise LogFileError('Error reading file {0}: {1}'.format(self.path, emsg))
+        """
+        for entry in entries:
+            self.append(entry)
 
-    def reload(self):
-        """Reload file
+    def message(self, index):
+        """Message by index
 
-        Reload file, clearing existing entries
+        Return message text for given row index
 
         """
-        self.__delslice__(0, len(self))
-        self.__loaded = False
-        while True:
-            try:
-                entry = self.next()
-            except StopIteration:
-                break
+        return str(self.message_buffer[self.message_offsets[index]:self.message_offsets[index+1]])
+
+    def __match_codes__(self, column, code):
+        if code is None:
+            return []
+        return [self.__build_entry__(i) for i, value in enumerate(column) if value == code]
 
     def filter_host(self, host):
         """Filter by host name
@@ -599,9 +2554,12 @@ class LogFile(list):
         Return log entries matching given host name
 
         """
+        if self.streaming or self.index_fields is not None:
+            return super(ColumnarLogFile, self).filter_host(host)
+
         if len(self) == 0:
             self.reload()
-        return [x for x in self if x.host == host]
+        return self.__match_codes__(self.hosts, self.host_values.codes.get(host, None))
 
     def filter_program(self, program):
         """Filter by program name
@@ -609,9 +2567,12 @@ class LogFile(list):
         Return log entries matching given program name
 
         """
+        if self.streaming or self.index_fields is not None:
+            return super(ColumnarLogFile, self).filter_program(program)
+
         if len(self) == 0:
             self.reload()
-        return [x for x in self if x.program == program]
+        return self.__match_codes__(self.programs, self.program_values.codes.get(program, None))
 
     def filter_message(self, message_regexp):
         """Filter by message regexp
@@ -619,13 +2580,16 @@ class LogFile(list):
         Filter log entries matching given regexp in message field
 
         """
+        if self.streaming:
+            return super(ColumnarLogFile, self).filter_message(message_regexp)
+
         if len(self) == 0:
             self.reload()
 
         if isinstance(message_regexp, basestring):
             message_regexp = re.compile(message_regexp)
 
-        return [x for x in self if message_regexp.match(x.message)]
+        return [self.__build_entry__(i) for i in xrange(len(self)) if message_regexp.match(self.message(i))]
 
     def match_message(self, message_regexp):
         """
@@ -634,6 +2598,9 @@ class LogFile(list):
          in message field
 
         """
+        if self.streaming:
+            return super(ColumnarLogFile, self).match_message(message_regexp)
+
         if len(self) == 0:
             self.reload()
 
@@ -641,14 +2608,73 @@ class LogFile(list):
             message_regexp = re.compile(message_regexp)
 
         matches = []
-        for x in self:
-            m = message_regexp.match(x.message)
-            if not m:
-                continue
-            matches.append(m.groupdict())
+        for i in xrange(len(self)):
+            m = message_regexp.match(self.message(i))
+            if m:
+                matches.append(m.groupdict())
         return matches
 
 
+def map_parallel(worker, args, processes=None):
+    """Map arguments in worker processes
+
+    Run worker for each argument in a multiprocessing pool with given number
+    of processes, one task per argument, and return results in order.
+    Default is one worker per CPU.
+
+    """
+    if not args:
+        return []
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    pool = multiprocessing.Pool(min(processes, len(args)))
+    try:
+        return pool.map(worker, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parallel_range_worker(args):
+    """Parallel range worker
+
+    Parse byte range of a logfile in worker process and return the entries.
+
+    """
+    loader, path, source_formats, year, start, end = args
+    return loader(path, source_formats=source_formats).parse_range(start, end, year)
+
+
+def parallel_load_worker(args):
+    """Parallel load worker
+
+    Load logfile in worker process. Returns tuple (mtime, entries).
+
+    """
+    loader, path, source_formats, external_decompressors, parse_cache = args
+    parser = loader(path, source_formats=source_formats)
+    parser.external_decompressors = external_decompressors
+    parser.parse_cache = parse_cache
+    parser.reload()
+    return parser.mtime, [parser[index] for index in xrange(len(parser))]
+
+
+def parallel_filter_worker(args):
+    """Parallel filter worker
+
+    Call filter method with streaming logfile in worker process and return
+    the results.
+
+    """
+    loader, path, source_formats, external_decompressors, method, method_args = args
+    parser = loader(path, source_formats=source_formats)
+    parser.streaming = True
+    parser.external_decompressors = external_decompressors
+    return getattr(parser, method)(*method_args)
+
+
 class LogFileCollection(object):
     """Process multiple logfiles
 
@@ -658,13 +2684,42 @@ class LogFileCollection(object):
 
     Files are sorted by modification timestamp and name.
 
+    With streaming=True the filters parse entries one at a time and only keep
+    matching entries. The iter_* generators never store entries.
+
+    Attributes listed in parser_options override the setting of each loaded
+    file when they are not None: external_decompressors to use external
+    decompressor pipes for compressed files, parse_cache to cache parsed
+    entries and index_fields to index loaded entries by field values.
+
+    Files are opened only when read and closed when exhausted. At most
+    max_open_files files are kept open: when more files are read in turns,
+    like by iter_merged, least recently used files are closed and reopened at
+    the same offset when read again. iter_merged reads blocks of
+    merge_read_block_size bytes per file, so memory use does not grow with the
+    number of files either.
+
+    Compressed files can't be reopened at an offset without decompressing them
+    again from the start, which would make reading many files in turns
+    quadratic in file size. They are not closed to keep within max_open_files,
+    unless they are gzip files with a current saved gzip index, so more than
+    max_open_files files stay open when many compressed files are merged.
+
     """
     loader = LogFile
-    def __init__(self, logfiles, source_formats=SOURCE_FORMATS):
-        self.source_formats = source_formats
+    parser_options = ('external_decompressors', 'parse_cache', 'index_fields')
+    external_decompressors = None
+    parse_cache = None
+    index_fields = None
+    max_open_files = DEFAULT_MAX_OPEN_FILES
+    merge_read_block_size = DEFAULT_MERGE_READ_BLOCK_SIZE
+    def __init__(self, logfiles, source_formats=SOURCE_FORMATS, streaming=False):
+        self.source_formats = compile_source_formats(source_formats)
+        self.streaming = streaming
         self.logfiles = []
         self.__iter_index = None
         self.__iter_entry = None
+        self.__open_files = OrderedDict()
 
         stats = {}
         for path in logfiles:
@@ -689,9 +2744,25 @@ class LogFileCollection(object):
                 self.loader(path, source_formats=self.source_formats) for path in stats[ts]
             )
 
+        # Loaders don't need to accept the streaming argument
+        if self.streaming:
+            for parser in self.logfiles:
+                parser.streaming = True
+
+        for attr in self.parser_options:
+            if getattr(self, attr) is not None:
+                for parser in self.logfiles:
+                    setattr(parser, attr, getattr(self, attr))
+
     def __repr__(self):
         return 'collection of {0:d} logfiles'.format(len(self.logfiles))
 
+    def __setattr__(self, attr, value):
+        super(LogFileCollection, self).__setattr__(attr, value)
+        if attr in self.parser_options and value is not None:
+            for parser in getattr(self, 'logfiles', ()):
+                setattr(parser, attr, value)
+
     def __iter__(self):
         return self
 
@@ -703,28 +2774,233 @@ class LogFileCollection(object):
             self.__iter_index = 0
             self.__iter_entry = self.logfiles[0]
 
-        try:
-            logentry = self.__iter_entry.next()
-
-        except StopIteration, emsg:
-            if self.__iter_index < len(self.logfiles) - 1:
-                self.__iter_index += 1
-                self.__iter_entry = self.logfiles[self.__iter_index]
+        while True:
+            try:
+                logentry = self.__iter_entry.next()
+                break
 
-                try:
-                    logentry = self.__iter_entry.next()
-                except StopIteration:
+            except StopIteration:
+                self.__release_file__(self.__iter_entry)
+                if self.__iter_index < len(self.logfiles) - 1:
+                    self.__iter_index += 1
+                    self.__iter_entry = self.logfiles[self.__iter_index]
+                else:
                     self.__iter_index = None
                     self.__iter_entry = None
                     raise StopIteration
 
-            else:
-                self.__iter_index = None
-                self.__iter_entry = None
-                raise StopIteration
-
+        if id(self.__iter_entry) not in self.__open_files:
+            self.__use_file__(self.__iter_entry)
         return logentry
 
+    def __use_file__(self, logfile):
+        """Use file
+
+        Mark given LogFile or LogLineReader as most recently used open file,
+        and close least recently used files when more than max_open_files are
+        open. Closed files continue from the same offset when read again.
+        Only seekable files are closed.
+
+        """
+        self.__open_files.pop(id(logfile), None)
+        if not logfile.is_open:
+            return
+
+        self.__open_files[id(logfile)] = logfile
+        if len(self.__open_files) <= max(self.max_open_files, 1):
+            return
+
+        # Files which would be decompressed again from the start are not closed
+        for key, lru in self.__open_files.items():
+            if key != id(logfile) and lru.seekable:
+                del self.__open_files[key]
+                lru.close()
+                if len(self.__open_files) <= max(self.max_open_files, 1):
+                    break
+
+    def __release_file__(self, logfile):
+        """
+        Close given exhausted LogFile or LogLineReader
+        """
+        self.__open_files.pop(id(logfile), None)
+        logfile.close()
+
+    @property
+    def open_files(self):
+        """
+        Return number of files currently open for reading by the collection
+        """
+        return len([logfile for logfile in self.__open_files.values() if logfile.is_open])
+
+    def parallel_load(self, processes=None):
+        """Load logfiles in parallel
+
+        Parse all logfiles in a multiprocessing pool with given number of
+        worker processes, one task per file, and load the entries to the
+        logfiles in this collection. Default is one worker per CPU.
+
+        """
+        results = map_parallel(parallel_load_worker,
+            [(type(parser), parser.path, list(self.source_formats), parser.external_decompressors, parser.parse_cache)
+                for parser in self.logfiles],
+            processes
+        )
+        for parser, (mtime, entries) in zip(self.logfiles, results):
+            parser.load_entries(entries, mtime)
+
+    def parallel_filter(self, method, args=(), processes=None, merge=False):
+        """Filter logfiles in parallel
+
+        Call given LogFile filter method (filter_host, filter_program,
+        filter_message or match_message) with args for each logfile in a
+        multiprocessing pool, streaming entries in the workers.
+
+        Results are returned in logfile order, or merged by entry time if
+        merge is True. match_message results can't be merged by time.
+
+        """
+        results = map_parallel(parallel_filter_worker,
+            [(type(parser), parser.path, list(self.source_formats), parser.external_decompressors, method, tuple(args))
+                for parser in self.logfiles],
+            processes
+        )
+
+        if method == 'match_message':
+            if merge:
+                raise LogFileError('match_message results can not be merged by time')
+            return [match for matches in results for match in matches]
+
+        for parser, entries in zip(self.logfiles, results):
+            for entry in entries:
+                adopt_entry(entry, parser)
+
+        if merge:
+            return [entry for time, index, position, entry in heapq.merge(*[
+                [(entry.time, index, position, entry) for position, entry in enumerate(entries)]
+                for index, entries in enumerate(results)
+            ])]
+
+        return [entry for entries in results for entry in entries]
+
+    def iter_entries(self):
+        """Iterate entries
+
+        Generator yielding entries from all logfiles with LogFile.iter_entries
+
+        """
+        for parser in self.logfiles:
+            for entry in parser.iter_entries():
+                yield entry
+
+    def iter_merged(self, start=None, end=None):
+        """Iterate entries in time order
+
+        Generator merging streamed entries from all logfiles in global
+        timestamp order with a heap, holding one pending entry per file. At
+        most max_open_files files are open at a time.
+
+        If start or end datetime is given, only entries with start <= time < end
+        are returned. Files modified before start are skipped without reading,
+        and each file is closed when an entry at or after end is seen, since
+        entries within a file are in time order.
+
+        """
+        heap = []
+
+        def push(index, entries):
+            for entry in entries:
+                if start is not None and entry.time < start:
+                    continue
+                if end is not None and entry.time >= end:
+                    entries.close()
+                    return
+                heapq.heappush(heap, (entry.time, index, entry, entries))
+                return
+
+        for index, parser in enumerate(self.logfiles):
+            if start is not None and isinstance(parser.path, basestring):
+                try:
+                    if datetime.fromtimestamp(os.stat(parser.path).st_mtime) < start:
+                        continue
+                except OSError, (ecode, emsg):
+                    raise LogFileError('Error running stat on {0}: {1}'.format(parser.path, emsg))
+            reader = LogLineReader(parser, block_size=self.merge_read_block_size, read_callback=self.__use_file__)
+            push(index, self.__iter_reader_entries__(parser, reader))
+
+        while heap:
+            time, index, entry, entries = heapq.heappop(heap)
+            yield entry
+            push(index, entries)
+
+    def __iter_reader_entries__(self, parser, reader):
+        """
+        Generator yielding entries of parser read with reader, releasing the reader when done
+        """
+        try:
+            for entry in parser.iter_entries(reader):
+                yield entry
+        finally:
+            self.__release_file__(reader)
+
+    def iter_time_range(self, start=None, end=None, use_index=True, seek=True):
+        """Iterate entries in time range
+
+        Generator yielding entries with start <= time < end from all logfiles
+        with LogFile.iter_time_range. With use_index files with no entries in
+        the range are skipped based on their time index.
+
+        """
+        for parser in self.logfiles:
+            for entry in parser.iter_time_range(start, end, use_index, seek):
+                yield entry
+
+    def iter_host(self, host):
+        """Iterate by host
+
+        Generator yielding entries from all logfiles with LogFile.iter_host
+
+        """
+        for parser in self.logfiles:
+            for entry in parser.iter_host(host):
+                yield entry
+
+    def iter_program(self, program):
+        """Iterate by program
+
+        Generator yielding entries from all logfiles with LogFile.iter_program
+
+        """
+        for parser in self.logfiles:
+            for entry in parser.iter_program(program):
+                yield entry
+
+    def iter_message(self, message_regexp):
+        """Iterate by message regexp
+
+        Generator yielding entries from all logfiles with LogFile.iter_message
+
+        """
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        for parser in self.logfiles:
+            for entry in parser.iter_message(message_regexp):
+                yield entry
+
+    def iter_match_message(self, message_regexp):
+        """Iterate message regexp matches
+
+        Generator yielding regexp match dictionaries from all logfiles with
+        LogFile.iter_match_message
+
+        """
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        for parser in self.logfiles:
+            for match in parser.iter_match_message(message_regexp):
+                yield match
+
     def filter_host(self, host):
         """Filter by host
 
@@ -747,6 +3023,17 @@ class LogFileCollection(object):
             matches.extend(parser.filter_program(program))
         return matches
 
+    def filter_fields(self, **fields):
+        """Filter by field values
+
+        Filter all loaded logfiles by matching field values with LogFile.filter_fields
+
+        """
+        matches = []
+        for parser in self.logfiles:
+            matches.extend(parser.filter_fields(**fields))
+        return matches
+
     def filter_message(self, message_regexp):
         """Filter messages by regexp
 
@@ -775,18 +3062,421 @@ class LogFileCollection(object):
             matches.extend(parser.match_message(message_regexp))
         return matches
 
+    def iter_match_rules(self, rules):
+        """Iterate rule matches
+
+        Generator yielding (rule name, entry, groupdict) tuples from all
+        logfiles with LogFile.iter_match_rules
+
+        """
+        if not isinstance(rules, LogRuleSet):
+            rules = LogRuleSet(rules)
+
+        for parser in self.logfiles:
+            for match in parser.iter_match_rules(rules):
+                yield match
+
+    def match_rules(self, rules):
+        """Match rules
+
+        Match all loaded logfiles with LogFile.match_rules. Returns dictionary
+        of lists of (entry, groupdict) tuples by rule name.
+
+        """
+        if not isinstance(rules, LogRuleSet):
+            rules = LogRuleSet(rules)
+
+        matches = dict((name, []) for name in rules.names)
+        for parser in self.logfiles:
+            for name, parser_matches in parser.match_rules(rules).items():
+                matches[name].extend(parser_matches)
+        return matches
+
+    def aggregate(self, interval=DEFAULT_AGGREGATE_INTERVAL, keys=('host', ), message_regexp=None,
+                  max_groups=DEFAULT_MAX_GROUPS):
+        """Aggregate entries
+
+        Return LogAggregation with counts of entries in all logfiles, see
+        LogFile.aggregate
+
+        """
+        aggregation = LogAggregation(interval, keys, message_regexp, max_groups)
+        for parser in self.logfiles:
+            aggregation.update(parser.iter_entries())
+        return aggregation
+
+    def heavy_hitters(self, key='program', epsilon=DEFAULT_TOPK_EPSILON, delta=DEFAULT_TOPK_DELTA, processes=None):
+        """Heavy hitters
+
+        Return TopKSummary of most frequent values of key in all logfiles, see
+        LogFile.heavy_hitters. If processes is not None, logfiles are
+        summarized in a multiprocessing pool and the summaries merged.
+
+        """
+        summary = TopKSummary(key, epsilon, delta)
+        if processes is None:
+            for parser in self.logfiles:
+                summary.update(parser.iter_entries())
+            return summary
+
+        for result in map_parallel(parallel_filter_worker,
+                [(type(parser), parser.path, list(self.source_formats), parser.external_decompressors,
+                    'heavy_hitters', (key, epsilon, delta)) for parser in self.logfiles],
+                processes):
+            summary.merge(result)
+        return summary
+
+    def mine_templates(self, miner=None):
+        """Mine message templates
+
+        Add messages in all logfiles to given TemplateMiner, or a new one, see
+        LogFile.mine_templates
+
+        """
+        if miner is None:
+            miner = TemplateMiner()
+        for parser in self.logfiles:
+            parser.mine_templates(miner)
+        return miner
+
+
+class CompactLogFileCollection(LogFileCollection):
+    """
+    Process multiple logfiles with CompactLogFile parsers
+    """
+    loader = CompactLogFile
+
+
+class ColumnarLogFileCollection(LogFileCollection):
+    """
+    Process multiple logfiles with ColumnarLogFile parsers
+    """
+    loader = ColumnarLogFile
+
+
+class LiveLogFileCollection(LogFileCollection):
+    """Live log file collection
+
+    Collection of log files matching a glob pattern, like
+    /var/log/remote/*/syslog*, which follows the files in one thread. follow()
+    yields entries as they are appended to the files and from new files
+    matching the pattern.
+
+    Files are tracked by device and inode, so a file renamed by log rotation
+    continues from the offset already read instead of being read again, and
+    truncated files are read from the start. Compressed files appearing after
+    the collection was created contain already rotated data and are not read.
+
+    Changes are waited for with inotify watches on the directories of the
+    pattern when available and use_inotify is True. Otherwise files are
+    checked every poll_interval seconds. The pattern is also rescanned every
+    rescan_interval seconds to find new directories.
+
+    """
+    poll_interval = DEFAULT_LIVE_POLL_INTERVAL
+    rescan_interval = DEFAULT_LIVE_RESCAN_INTERVAL
+    use_inotify = True
+    watch_mask = IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    def __init__(self, pattern, source_formats=SOURCE_FORMATS, seek_to_end=False):
+        """
+        Follow files matching pattern, from the end of existing files if seek_to_end is True
+        """
+        self.pattern = os.path.expanduser(os.path.expandvars(pattern))
+        super(LiveLogFileCollection, self).__init__(
+            [path for path in glob.glob(self.pattern) if os.path.isfile(path)],
+            source_formats,
+            streaming=True,
+        )
+        self.__readers = OrderedDict()
+        self.__paths = {}
+        self.__finished = set()
+        self.__compressed = set()
+        self.__last_entries = {}
+        for parser in self.logfiles:
+            self.__add_file__(parser, seek_to_end)
+
+    def __repr__(self):
+        return 'live collection of {0:d} logfiles matching {1}'.format(len(self.logfiles), self.pattern)
+
+    def __add_file__(self, parser, seek_to_end=False):
+        """Add file
+
+        Start following file of parser from start, or from end of file if
+        seek_to_end is True. Returns the device and inode key of the file.
+
+        """
+        try:
+            st = os.stat(parser.path)
+        except OSError:
+            return None
+
+        key = (st.st_dev, st.st_ino)
+        if key in self.__readers or key in self.__finished:
+            return key
+
+        if detect_compression(parser.path) is not None:
+            if seek_to_end:
+                self.__finished.add(key)
+                return key
+            self.__compressed.add(key)
+
+        self.__readers[key] = LogLineReader(parser,
+            offset=seek_to_end and st.st_size or 0,
+            block_size=parser.read_block_size,
+            read_callback=self.__use_file__,
+            follow=True,
+        )
+        self.__paths[parser.path] = key
+        return key
+
+    def __remove_file__(self, key):
+        """
+        Stop following file
+        """
+        reader = self.__readers.pop(key)
+        self.__release_file__(reader)
+        self.__compressed.discard(key)
+        self.__last_entries.pop(key, None)
+        if self.__paths.get(reader.logfile.path) == key:
+            del self.__paths[reader.logfile.path]
+        self.logfiles = [parser for parser in self.logfiles if parser is not reader.logfile]
+
+    def __rescan__(self):
+        """Rescan files
+
+        Find files matching the pattern. New files are followed from start,
+        and renamed files continue from the offset already read.
+
+        Returns tuple (changed, removed) with lists of keys of files with
+        unread data and keys of files which no longer match the pattern.
+
+        """
+        found = OrderedDict()
+        for path in sorted(glob.glob(self.pattern)):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if os.path.isfile(path):
+                found[(st.st_dev, st.st_ino)] = (path, st.st_size)
+
+        changed = []
+        for key, (path, size) in found.items():
+            reader = self.__readers.get(key, None)
+            if reader is None:
+                if key in self.__finished:
+                    continue
+                parser = self.loader(path, source_formats=self.source_formats)
+                parser.streaming = True
+                for attr in self.parser_options:
+                    if getattr(self, attr) is not None:
+                        setattr(parser, attr, getattr(self, attr))
+
+                # Compressed files appearing later are compressed rotated files
+                if detect_compression(path) is not None:
+                    self.__finished.add(key)
+                    continue
+                self.logfiles.append(parser)
+                self.__add_file__(parser)
+                changed.append(key)
+                continue
+
+            if reader.logfile.path != path:
+                if self.__paths.get(reader.logfile.path) == key:
+                    del self.__paths[reader.logfile.path]
+                reader.logfile.path = path
+            self.__paths[path] = key
+            if size != reader.offset:
+                changed.append(key)
+
+        self.__finished &= set(found.keys())
+        removed = [key for key in self.__readers.keys() if key not in found]
+        return changed, removed
+
+    def __iter_new_entries__(self, key):
+        """
+        Generator yielding entries parsed from data appended to file with key
+        """
+        reader = self.__readers[key]
+        parser = reader.logfile
+        try:
+            if not reader.is_open:
+                # Closed file may have been replaced by another file after rotation
+                st = os.stat(parser.path)
+                if (st.st_dev, st.st_ino) != key:
+                    return
+            elif isinstance(reader.fd, file):
+                st = os.fstat(reader.fd.fileno())
+            else:
+                st = None
+
+            if st is not None and key not in self.__compressed and st.st_size < reader.offset:
+                # Truncated file is read from the start
+                reader.close()
+                reader.offset = 0
+                reader.remainder = ''
+        except OSError:
+            return
+
+        # Entries are from the year the file was last modified, like in LogFile
+        year = st is not None and datetime.fromtimestamp(st.st_mtime).year or reader.mtime.year
+        while True:
+            lines = reader.read_lines()
+            if not lines:
+                break
+
+            for line in lines:
+                entry = self.__last_entries.get(key, None)
+                if line[:1] in (' ', '\t') and entry is not None:
+                    entry.append(line)
+                    continue
+
+                entry = parser.lineloader(parser, line, year=year, source_formats=parser.source_formats)
+                self.__last_entries[key] = entry
+                yield entry
+
+        # Compressed files don't grow
+        if key in self.__compressed:
+            self.__finished.add(key)
+            self.__remove_file__(key)
+
+    def __watch_directories__(self, watcher):
+        """
+        Watch directories matching the pattern for changes to files in them
+        """
+        directories = set(path for path in glob.glob(os.path.dirname(self.pattern) or '.') if os.path.isdir(path))
+        for path in directories:
+            if path not in watcher.paths:
+                try:
+                    watcher.add_watch(path, self.watch_mask)
+                except InotifyError:
+                    pass
+        for path in watcher.paths.keys():
+            if path not in directories:
+                watcher.remove_watch(path)
+
+    def follow(self, timeout=None):
+        """Follow files
+
+        Generator yielding entries not yet read from the files, and then
+        entries appended to the files and entries of new files as they
+        appear. Entries are yielded when their first line is read and
+        continuation lines are appended to them later.
+
+        If timeout is not None, returns when no entries were read in timeout
+        seconds.
+
+        """
+        watcher = None
+        if self.use_inotify and inotify_available():
+            try:
+                watcher = InotifyWatcher()
+                self.__watch_directories__(watcher)
+            except InotifyError:
+                watcher = None
+
+        try:
+            # Files may have changed while not following, rescan first
+            pending = set(self.__readers.keys())
+            last_entry = time.time()
+            last_scan = 0
+            while True:
+                removed = []
+                if watcher is None or time.time() - last_scan >= self.rescan_interval:
+                    changed, removed = self.__rescan__()
+                    pending.update(changed)
+                    pending.update(removed)
+                    last_scan = time.time()
+                    if watcher is not None:
+                        self.__watch_directories__(watcher)
+
+                for key in [key for key in self.__readers.keys() if key in pending]:
+                    for entry in self.__iter_new_entries__(key):
+                        last_entry = time.time()
+                        yield entry
+                for key in removed:
+                    if key in self.__readers:
+                        self.__remove_file__(key)
+                pending = set()
+
+                now = time.time()
+                if timeout is not None and now - last_entry >= timeout:
+                    return
+                wait = watcher is None and self.poll_interval or self.rescan_interval - (now - last_scan)
+                if timeout is not None:
+                    wait = min(wait, timeout - (now - last_entry))
+
+                if watcher is None:
+                    time.sleep(max(wait, 0))
+                    continue
+
+                for event in watcher.read_events(max(wait, 0)):
+                    if event.mask & IN_MODIFY and event.filename in self.__paths:
+                        pending.add(self.__paths[event.filename])
+                    elif event.mask & IN_Q_OVERFLOW or fnmatch.fnmatch(event.filename, self.pattern):
+                        # Rescan now to find new, rotated and removed files
+                        last_scan = 0
+
+        finally:
+            if watcher is not None:
+                watcher.close()
+
 
 class LogfileTailReader(TailReader):
     """Logfile tail reader
 
-    Tail reader returning LogFile entries
+    Tail reader returning LogFile entries. Continuation lines are appended to
+    the previously returned entry.
 
     """
-    def __init__(self, path=None, fd=None, source_formats=SOURCE_FORMATS, lineparser=LogEntry):
-        super(LogfileTailReader, self).__init__(wpath, fd)
-        self.source_formats = source_formats
+    def __init__(self, path=None, fd=None, source_formats=SOURCE_FORMATS, lineparser=LogEntry, watcher=None):
+        super(LogfileTailReader, self).__init__(path, fd, watcher)
+        self.source_formats = compile_source_formats(source_formats)
         self.lineparser = lineparser
+        self.time_parser = SyslogTimeParser()
+        self.entry = None
 
     def __format_line__(self, line):
-         return self.lineparser(line[:-1], self.year, source_formats=self.source_formats)
+        if line[:1] in (' ', '\t') and self.entry is not None:
+            self.entry.append(line)
+            return None
+
+        self.entry = self.lineparser(self, line, self.year, source_formats=self.source_formats)
+        return self.entry
+
+    def readline(self):
+        """Read entry
+
+        Read next entry from the file, blocking until one is available
+
+        """
+        while True:
+            entry = super(LogfileTailReader, self).readline()
+            if entry is not None:
+                return entry
+
+    def iter_match_rules(self, rules):
+        """Iterate rule matches
+
+        Generator yielding (rule name, entry, groupdict) tuples for entries
+        matching rules in given LogRuleSet, or dictionary or list of (name,
+        regexp) tuples, as they are appended to the file. Entries are matched
+        before their continuation lines are read.
+
+        """
+        if not isinstance(rules, LogRuleSet):
+            rules = LogRuleSet(rules)
+        return rules.iter_matches(self)
+
+    def iter_templates(self, miner=None):
+        """Iterate message templates
 
+        Generator adding messages to given TemplateMiner, or a new one, as
+        entries are appended to the file and yielding (template, entry)
+        tuples. Templates are mined from the first line of messages, before
+        continuation lines are read.
+
+        """
+        if miner is None:
+            miner = TemplateMiner()
+        return miner.iter_update(self)
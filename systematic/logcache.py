@@ -0,0 +1,267 @@
+"""
+Persistent cache of parsed log file entries
+"""
+
+import os
+import gc
+import json
+import zlib
+import marshal
+import time
+import hashlib
+import calendar
+
+from datetime import datetime
+
+DEFAULT_CACHE_DIRECTORY = os.path.expanduser('~/.cache/systematic/logcache')
+DEFAULT_CACHE_SIZE = 2**30
+DEFAULT_CACHE_MIN_AGE = 3600
+CACHE_FILE_VERSION = 1
+CACHE_FILE_SUFFIX = '.entries'
+
+
+class LogCacheError(Exception):
+    pass
+
+
+def encode_entries(entries):
+    """Encode entries
+
+    Encode entries to compressed column oriented marshal data. Entries are
+    grouped by their set of attributes and each attribute is stored as one
+    column, with entry times as epoch seconds.
+
+    Raises ValueError if entries contain values marshal can't store.
+
+    """
+    groups = {}
+    order = []
+    for entry in entries:
+        state = entry.__getstate__()
+        value = state.get('time', None)
+        if value is not None:
+            if not isinstance(value, datetime) or value.tzinfo is not None:
+                raise ValueError('Unsupported entry time {0!r}'.format(value))
+            epoch = calendar.timegm(value.timetuple())
+            state['time'] = value.microsecond and epoch + value.microsecond / 1e6 or epoch
+
+        keys = tuple(sorted(state.keys()))
+        try:
+            index, columns = groups[keys]
+        except KeyError:
+            index, columns = groups[keys] = (len(groups), tuple([] for key in keys))
+        for column, key in zip(columns, keys):
+            column.append(state[key])
+        order.append(index)
+
+    groups = sorted((index, keys, columns) for keys, (index, columns) in groups.items())
+    return zlib.compress(marshal.dumps((order, [(keys, columns) for index, keys, columns in groups]), 2), 1)
+
+
+def decode_entries(entry_class, data):
+    """Decode entries
+
+    Decode entries of given class from encode_entries() data. Entries are
+    created without calling __init__ and have no logfile reference.
+
+    """
+    times = {}
+    entry = entry_class.__new__(entry_class)
+    has_dict = hasattr(entry, '__dict__')
+
+    # Cyclic garbage collection passes make creating many objects quadratic
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        order, groups = marshal.loads(zlib.decompress(data))
+        decoded = []
+        for keys, columns in groups:
+            columns = list(columns)
+            if 'time' in keys:
+                index = keys.index('time')
+                column = []
+                for value in columns[index]:
+                    try:
+                        column.append(times[value])
+                    except KeyError:
+                        times[value] = value is not None and datetime.utcfromtimestamp(value) or None
+                        column.append(times[value])
+                columns[index] = column
+
+            count = len(columns and columns[0] or ())
+            if has_dict:
+                group = []
+                for row in zip(*columns):
+                    entry = entry_class.__new__(entry_class)
+                    entry.__dict__ = dict(zip(keys, row))
+                    group.append(entry)
+            else:
+                group = [entry_class.__new__(entry_class) for index in xrange(count)]
+                for key, column in zip(keys, columns):
+                    for entry, value in zip(group, column):
+                        setattr(entry, key, value)
+            decoded.append(iter(group))
+
+        return [next(decoded[index]) for index in order]
+
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class LogParseCache(object):
+    """Persistent cache of parsed log file entries
+
+    Cache of parsed entries stored as files in directory. Cached entries are
+    keyed by device, inode, size and mtime of the log file, the entry class and
+    the source formats used for parsing, so a cached file is never valid for a
+    modified log file.
+
+    Files modified less than min_age seconds ago are not cached. When total
+    size of cache files exceeds max_size, least recently used files are
+    removed.
+
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size=DEFAULT_CACHE_SIZE, min_age=DEFAULT_CACHE_MIN_AGE):
+        self.directory = directory
+        self.max_size = max_size
+        self.min_age = min_age
+
+    def __repr__(self):
+        return self.directory
+
+    def cache_key(self, path, entry_class, source_formats):
+        """Cache key
+
+        Return cache key fields for given log file, entry class and source
+        formats, or None if the file is too recently modified to cache.
+
+        """
+        try:
+            st = os.stat(path)
+        except OSError, (ecode, emsg):
+            raise LogCacheError('Error running stat on {0}: {1}'.format(path, emsg))
+
+        if self.min_age is not None and st.st_mtime > time.time() - self.min_age:
+            return None
+
+        return [
+            st.st_dev, st.st_ino, st.st_size, int(st.st_mtime),
+            '{0}.{1}'.format(entry_class.__module__, entry_class.__name__),
+            [getattr(fmt, 'pattern', fmt) for fmt in source_formats],
+        ]
+
+    def cache_path(self, key):
+        """
+        Return path to cache file for cache key
+        """
+        return os.path.join(self.directory, '{0}{1}'.format(hashlib.sha1(json.dumps(key)).hexdigest(), CACHE_FILE_SUFFIX))
+
+    def load(self, path, entry_class, source_formats):
+        """Load cached entries
+
+        Return list of cached entries for given log file, or None if there are
+        no valid cached entries.
+
+        """
+        key = self.cache_key(path, entry_class, source_formats)
+        if key is None:
+            return None
+
+        cache_path = self.cache_path(key)
+        try:
+            with open(cache_path, 'rb') as fd:
+                version, cached_key, data = marshal.load(fd)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+        if version != CACHE_FILE_VERSION or key != cached_key:
+            return None
+
+        try:
+            entries = decode_entries(entry_class, data)
+        except (zlib.error, EOFError, ValueError, TypeError, StopIteration):
+            return None
+
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        return entries
+
+    def save(self, path, entry_class, source_formats, entries):
+        """Save entries to cache
+
+        Save parsed entries for given log file and evict least recently used
+        cache files. Returns False if the entries were not cached.
+
+        """
+        key = self.cache_key(path, entry_class, source_formats)
+        if key is None:
+            return False
+
+        try:
+            data = encode_entries(entries)
+        except ValueError:
+            return False
+
+        cache_path = self.cache_path(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmp_path = '{0}.tmp'.format(cache_path)
+            with open(tmp_path, 'wb') as fd:
+                marshal.dump((CACHE_FILE_VERSION, key, data), fd, 2)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError), (ecode, emsg):
+            raise LogCacheError('Error writing cache {0}: {1}'.format(cache_path, emsg))
+
+        self.evict()
+        return True
+
+    def cache_files(self):
+        """
+        Return list of (atime, size, path) for cache files, oldest first
+        """
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return files
+
+        for name in names:
+            if not name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+        return sorted(files)
+
+    def evict(self):
+        """
+        Remove least recently used cache files until cache fits to max_size
+        """
+        files = self.cache_files()
+        total = sum(size for atime, size, path in files)
+        for atime, size, path in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError, (ecode, emsg):
+                raise LogCacheError('Error removing cache file {0}: {1}'.format(path, emsg))
+            total -= size
+
+    def clear(self):
+        """
+        Remove all cache files
+        """
+        for atime, size, path in self.cache_files():
+            try:
+                os.unlink(path)
+            except OSError, (ecode, emsg):
+                raise LogCacheError('Error removing cache file {0}: {1}'.format(path, emsg))
+
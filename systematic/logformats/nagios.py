@@ -15,9 +15,15 @@ RE_ICINGA_LOG = [
 
 
 class IcingaLogEntry(LogEntry):
-    def __init__(self, line, year, source_formats):
+    def __init__(self, logfile, line, year, source_formats):
         line = line.strip()
+        self.logfile = logfile
         self.line = line
+        self.message_fields = {}
+
+        self.host = None
+        self.program = None
+        self.pid = None
 
         self.time = None
         for parser in RE_ICINGA_LOG:
@@ -42,3 +48,9 @@ class IcingaLogEntry(LogEntry):
 class IcingaLog(LogFile):
     lineloader = IcingaLogEntry
 
+    def __parse_time__(self, line, year):
+        try:
+            return self.lineloader(self, line, year, self.source_formats).time
+        except LogFileError:
+            return None
+
@@ -0,0 +1,634 @@
+"""
+Persistent time to byte offset indexes for log files
+"""
+
+import os
+import json
+import zlib
+import bisect
+import base64
+import ctypes
+import ctypes.util
+import hashlib
+import calendar
+
+from datetime import datetime
+
+DEFAULT_INDEX_DIRECTORY = os.path.expanduser('~/.cache/systematic/logindex')
+DEFAULT_INDEX_INTERVAL = 2**20
+DEFAULT_GZIP_CHECKPOINT_SPAN = 2**22
+INDEX_FILE_VERSION = 1
+
+# Bytes at the start of indexed data checked before extending a time index
+INDEX_CHECKSUM_SIZE = 2**12
+
+# zlib constants used by gzip checkpoint index
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BLOCK = 5
+GZIP_WINDOW_SIZE = 2**15
+GZIP_READ_SIZE = 2**16
+
+
+class LogIndexError(Exception):
+    pass
+
+
+def datetime_to_epoch(value):
+    """
+    Return naive datetime as epoch seconds without timezone conversion
+    """
+    return calendar.timegm(value.timetuple())
+
+
+def epoch_to_datetime(value):
+    """
+    Return naive datetime for epoch seconds from datetime_to_epoch
+    """
+    return datetime.utcfromtimestamp(value)
+
+
+class LogFileIndex(object):
+    """Persistent index for a log file
+
+    Base class for indexes valid for one (path, device, inode, size, mtime)
+    fingerprint of a log file. Index is saved to <path><suffix> next to the
+    log file, or to a file named by path checksum in given directory.
+
+    Subclasses list persisted attributes in fields and reset them in clear().
+
+    """
+    suffix = '.index'
+    fields = ()
+
+    def __init__(self, path, directory=DEFAULT_INDEX_DIRECTORY, interval=DEFAULT_INDEX_INTERVAL):
+        self.path = os.path.realpath(path)
+        self.directory = directory
+        self.interval = interval
+        self.clear()
+
+    @property
+    def index_path(self):
+        if self.directory is None:
+            return '{0}{1}'.format(self.path, self.suffix)
+        return os.path.join(self.directory, '{0}{1}'.format(hashlib.sha1(self.path).hexdigest(), self.suffix))
+
+    def clear(self):
+        """
+        Clear index contents
+        """
+        self.fingerprint = None
+
+    def stat_fingerprint(self):
+        """
+        Return (device, inode, size, mtime) for the log file
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError, (ecode, emsg):
+            raise LogIndexError('Error running stat on {0}: {1}'.format(self.path, emsg))
+        return [st.st_dev, st.st_ino, st.st_size, int(st.st_mtime)]
+
+    def load(self):
+        """Load index
+
+        Load saved index file. Returns False if there is no valid index file.
+
+        """
+        self.clear()
+        try:
+            with open(self.index_path, 'r') as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            return False
+
+        if data.get('version') != INDEX_FILE_VERSION or data.get('path') != self.path or data.get('interval') != self.interval:
+            return False
+
+        try:
+            for field in ('fingerprint', ) + self.fields:
+                setattr(self, field, data[field])
+        except KeyError:
+            self.clear()
+            return False
+
+        return True
+
+    def save(self):
+        """
+        Save index file
+        """
+        data = {
+            'version': INDEX_FILE_VERSION,
+            'path': self.path,
+            'interval': self.interval,
+        }
+        for field in ('fingerprint', ) + self.fields:
+            data[field] = getattr(self, field)
+
+        directory = os.path.dirname(self.index_path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp_path = '{0}.tmp'.format(self.index_path)
+            with open(tmp_path, 'w') as fd:
+                json.dump(data, fd)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError), (ecode, emsg):
+            raise LogIndexError('Error writing index {0}: {1}'.format(self.index_path, emsg))
+
+    def is_current(self, fingerprint=None):
+        """
+        Check if index matches current log file fingerprint
+        """
+        if fingerprint is None:
+            fingerprint = self.stat_fingerprint()
+        return self.fingerprint is not None and self.fingerprint == fingerprint
+
+
+class LogTimeIndex(LogFileIndex):
+    """Time offset index for a log file
+
+    Sparse (time, byte offset) checkpoints for one log file. A checkpoint is
+    recorded at the start of an entry every interval bytes. For compressed
+    files offsets are offsets in the uncompressed data.
+
+    Each checkpoint stores the latest entry time before the offset and the
+    earliest entry time at or after the offset. Both are monotonic even if
+    lines are slightly out of order, so bisecting them always finds safe
+    offsets for a time range.
+
+    Checksum of the first INDEX_CHECKSUM_SIZE bytes of indexed data is stored
+    with the index, so a file truncated in place and rewritten past the
+    indexed size is indexed again instead of extending stale checkpoints.
+
+    """
+    suffix = '.timeindex'
+    fields = ('indexed_size', 'head_checksum', 'offsets', 'max_before', 'min_after', 'first_time', 'last_time')
+
+    def __repr__(self):
+        return '{0} {1:d} checkpoints'.format(self.path, len(self.offsets))
+
+    def clear(self):
+        """
+        Clear index contents
+        """
+        super(LogTimeIndex, self).clear()
+        self.indexed_size = 0
+        self.head_checksum = None
+        self.offsets = []
+        self.max_before = []
+        self.min_after = []
+        self.first_time = None
+        self.last_time = None
+
+    def can_extend(self, fingerprint):
+        """
+        Check if index can be extended to cover data appended to the log file
+        """
+        return self.fingerprint is not None and \
+            self.fingerprint[:2] == fingerprint[:2] and \
+            self.indexed_size <= fingerprint[2] and \
+            self.indexed_size >= INDEX_CHECKSUM_SIZE and \
+            self.head_checksum is not None
+
+    def __read_head_checksum__(self, fd):
+        """
+        Return checksum of first INDEX_CHECKSUM_SIZE bytes read from start of open log file
+        """
+        try:
+            fd.seek(0)
+            return zlib.crc32(fd.read(INDEX_CHECKSUM_SIZE)) & 0xffffffff
+        except IOError, (ecode, emsg):
+            raise LogIndexError('Error reading {0}: {1}'.format(self.path, emsg))
+
+    def update(self, fd, parse_time):
+        """Update index
+
+        Build index from given open log file, or extend it from indexed_size
+        if the file has only grown since last update. parse_time is called
+        for each line which is not a continuation line and must return entry
+        datetime, or None for lines it can't parse.
+
+        Returns True if index was modified.
+
+        """
+        fingerprint = self.stat_fingerprint()
+        if self.is_current(fingerprint):
+            return False
+
+        if self.can_extend(fingerprint) and self.__read_head_checksum__(fd) == self.head_checksum:
+            offset = self.indexed_size
+        else:
+            self.clear()
+            offset = 0
+        head = offset == 0 and [] or None
+
+        try:
+            fd.seek(offset)
+        except IOError, (ecode, emsg):
+            raise LogIndexError('Error reading {0}: {1}'.format(self.path, emsg))
+
+        if self.offsets:
+            last_checkpoint = self.offsets[-1]
+        else:
+            last_checkpoint = None
+        segment_min = None
+        times_max = self.last_time
+        for line in fd:
+            line_offset = offset
+            offset += len(line)
+            if head is not None and line_offset < INDEX_CHECKSUM_SIZE:
+                head.append(line)
+            if line[:1] in [' ', '\t']:
+                continue
+
+            value = parse_time(line)
+            if value is None:
+                continue
+            value = datetime_to_epoch(value)
+
+            if last_checkpoint is None or line_offset >= last_checkpoint + self.interval:
+                self.__close_segment__(segment_min)
+                segment_min = None
+                self.offsets.append(line_offset)
+                self.max_before.append(times_max)
+                self.min_after.append(None)
+                last_checkpoint = line_offset
+
+            if segment_min is None or value < segment_min:
+                segment_min = value
+            if times_max is None or value > times_max:
+                times_max = value
+            if self.first_time is None or value < self.first_time:
+                self.first_time = value
+
+        self.__close_segment__(segment_min)
+        self.last_time = times_max
+        self.indexed_size = offset
+        if head is not None:
+            self.head_checksum = zlib.crc32(''.join(head)[:INDEX_CHECKSUM_SIZE]) & 0xffffffff
+        self.fingerprint = fingerprint
+        return True
+
+    def __close_segment__(self, segment_min):
+        """
+        Update suffix minimum times with minimum of last indexed segment
+        """
+        if segment_min is None:
+            return
+        for index in xrange(len(self.min_after) - 1, -1, -1):
+            if self.min_after[index] is not None and self.min_after[index] <= segment_min:
+                break
+            self.min_after[index] = segment_min
+
+    def overlaps(self, start=None, end=None):
+        """
+        Check if log file may contain entries with start <= time < end
+        """
+        if self.first_time is None:
+            return False
+        if start is not None and self.last_time < datetime_to_epoch(start):
+            return False
+        if end is not None and self.first_time >= datetime_to_epoch(end):
+            return False
+        return True
+
+    def seek_range(self, start=None, end=None):
+        """Offsets for time range
+
+        Return tuple (start_offset, end_offset) of the region which contains
+        all entries with start <= time < end. end_offset is None if the
+        region extends to end of file.
+
+        """
+        start_offset = 0
+        if start is not None and self.offsets:
+            # Last checkpoint where all earlier entries are before start
+            index = bisect.bisect_left(self.max_before, datetime_to_epoch(start), lo=1) - 1
+            start_offset = self.offsets[max(index, 0)]
+
+        end_offset = None
+        if end is not None and self.offsets:
+            # First checkpoint where all later entries are at or after end
+            index = bisect.bisect_left(self.min_after, datetime_to_epoch(end))
+            if index < len(self.offsets):
+                end_offset = self.offsets[index]
+
+        return start_offset, end_offset
+
+
+class ZStream(ctypes.Structure):
+    """
+    zlib z_stream structure
+    """
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+class Inflater(object):
+    """Raw zlib inflate stream
+
+    Wrapper for zlib inflate functions not available in zlib module, loaded
+    with ctypes. Raises LogIndexError if zlib library can't be loaded.
+
+    """
+    __library = None
+
+    def __init__(self, window_bits):
+        self.zlib = self.load_library()
+        self.stream = ZStream()
+        version = self.zlib.zlibVersion()
+        if self.zlib.inflateInit2_(ctypes.byref(self.stream), window_bits, version, ctypes.sizeof(ZStream)) != Z_OK:
+            raise LogIndexError('Error initializing zlib inflate')
+
+    def __del__(self):
+        self.close()
+
+    @classmethod
+    def load_library(cls):
+        if cls.__library is None:
+            path = ctypes.util.find_library('z')
+            if path is None:
+                raise LogIndexError('zlib library not found')
+            try:
+                library = ctypes.CDLL(path)
+            except OSError, emsg:
+                raise LogIndexError('Error loading zlib: {0}'.format(emsg))
+            library.zlibVersion.restype = ctypes.c_char_p
+            cls.__library = library
+        return cls.__library
+
+    def close(self):
+        if self.stream is not None:
+            self.zlib.inflateEnd(ctypes.byref(self.stream))
+            self.stream = None
+
+    def prime(self, bits, value):
+        if self.zlib.inflatePrime(ctypes.byref(self.stream), bits, value) != Z_OK:
+            raise LogIndexError('Error priming zlib inflate')
+
+    def set_dictionary(self, window):
+        if self.zlib.inflateSetDictionary(ctypes.byref(self.stream), window, len(window)) != Z_OK:
+            raise LogIndexError('Error setting zlib inflate dictionary')
+
+    def inflate(self, flush):
+        value = self.zlib.inflate(ctypes.byref(self.stream), flush)
+        if value == Z_NEED_DICT or value < 0:
+            raise LogIndexError('Error decompressing data: {0}'.format(self.stream.msg))
+        return value
+
+
+class GzipCheckpointIndex(LogFileIndex):
+    """Random access checkpoint index for gzip files
+
+    zran style index of a gzip file: at deflate block boundaries about
+    every interval bytes of uncompressed output, the compressed offset, bit
+    offset and last 32 kB of uncompressed output are stored. Decompression
+    can then start from the nearest checkpoint before an uncompressed offset
+    instead of the start of the file.
+
+    Only the first gzip member is indexed, so the index can't be used for
+    files with multiple members or trailing data. Requires the zlib library,
+    loaded with ctypes.
+
+    """
+    suffix = '.gzindex'
+    fields = ('points', 'uncompressed_size', 'compressed_size')
+
+    def __init__(self, path, directory=DEFAULT_INDEX_DIRECTORY, interval=DEFAULT_GZIP_CHECKPOINT_SPAN):
+        super(GzipCheckpointIndex, self).__init__(path, directory, interval)
+
+    def __repr__(self):
+        return '{0} {1:d} checkpoints'.format(self.path, len(self.points))
+
+    def clear(self):
+        """
+        Clear index contents
+        """
+        super(GzipCheckpointIndex, self).clear()
+        self.points = []
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+
+    def load(self):
+        if not super(GzipCheckpointIndex, self).load():
+            return False
+        self.points = [
+            (bits, compressed, uncompressed, zlib.decompress(base64.b64decode(window)))
+            for bits, compressed, uncompressed, window in self.points
+        ]
+        return True
+
+    def save(self):
+        points = self.points
+        self.points = [
+            (bits, compressed, uncompressed, base64.b64encode(zlib.compress(window)))
+            for bits, compressed, uncompressed, window in points
+        ]
+        try:
+            super(GzipCheckpointIndex, self).save()
+        finally:
+            self.points = points
+
+    def update(self):
+        """Update index
+
+        Build index by decompressing the whole file, unless index is current.
+        Returns True if index was modified.
+
+        """
+        fingerprint = self.stat_fingerprint()
+        if self.is_current(fingerprint):
+            return False
+
+        self.clear()
+        inflater = Inflater(47)
+        stream = inflater.stream
+        window = ctypes.create_string_buffer(GZIP_WINDOW_SIZE)
+        data = ctypes.create_string_buffer(GZIP_READ_SIZE)
+        compressed = uncompressed = 0
+        last = None
+        value = Z_OK
+
+        try:
+            with open(self.path, 'rb') as fd:
+                while value != Z_STREAM_END:
+                    chunk = fd.read(GZIP_READ_SIZE)
+                    if chunk == '':
+                        raise LogIndexError('Unexpected end of file: {0}'.format(self.path))
+                    ctypes.memmove(data, chunk, len(chunk))
+                    stream.next_in = ctypes.addressof(data)
+                    stream.avail_in = len(chunk)
+
+                    while stream.avail_in > 0:
+                        if stream.avail_out == 0:
+                            stream.avail_out = GZIP_WINDOW_SIZE
+                            stream.next_out = ctypes.addressof(window)
+
+                        compressed += stream.avail_in
+                        uncompressed += stream.avail_out
+                        value = inflater.inflate(Z_BLOCK)
+                        compressed -= stream.avail_in
+                        uncompressed -= stream.avail_out
+                        if value == Z_STREAM_END:
+                            break
+
+                        # At end of a deflate block which is not the last block
+                        if stream.data_type & 128 and not stream.data_type & 64:
+                            if last is None or uncompressed - last > self.interval:
+                                position = GZIP_WINDOW_SIZE - stream.avail_out
+                                self.points.append((
+                                    stream.data_type & 7,
+                                    compressed,
+                                    uncompressed,
+                                    window.raw[position:] + window.raw[:position],
+                                ))
+                                last = uncompressed
+
+        except IOError, (ecode, emsg):
+            raise LogIndexError('Error reading {0}: {1}'.format(self.path, emsg))
+
+        finally:
+            inflater.close()
+
+        self.uncompressed_size = uncompressed
+        self.compressed_size = compressed
+        self.fingerprint = fingerprint
+        return True
+
+    def covers(self, offset):
+        """
+        Check if uncompressed offset is in the indexed data of a single member gzip file
+        """
+        return self.fingerprint is not None and self.compressed_size == self.fingerprint[2] and \
+            offset < self.uncompressed_size
+
+    def open(self, offset=0):
+        """Open reader
+
+        Return GzipCheckpointReader positioned at given uncompressed offset
+
+        """
+        if not self.points:
+            raise LogIndexError('Index is empty: {0}'.format(self.path))
+        if not self.covers(offset):
+            raise LogIndexError('Offset {0:d} is not covered by index: {1}'.format(offset, self.path))
+        index = bisect.bisect_right([point[2] for point in self.points], offset) - 1
+        return GzipCheckpointReader(self.path, self.points[max(index, 0)], offset)
+
+
+class GzipCheckpointReader(object):
+    """Gzip checkpoint reader
+
+    Read only file object decompressing a gzip file from a checkpoint of
+    GzipCheckpointIndex, positioned at given uncompressed offset.
+
+    """
+    def __init__(self, path, point, offset):
+        bits, compressed, uncompressed, window = point
+        self.path = path
+        self.fd = open(path, 'rb')
+        self.inflater = Inflater(-15)
+        self.input = ctypes.create_string_buffer(GZIP_READ_SIZE)
+        self.output = ctypes.create_string_buffer(GZIP_READ_SIZE)
+        self.buffer = ''
+        self.buffer_offset = 0
+        self.finished = False
+
+        try:
+            if bits:
+                self.fd.seek(compressed - 1)
+                self.inflater.prime(bits, ord(self.fd.read(1)) >> (8 - bits))
+            else:
+                self.fd.seek(compressed)
+            self.inflater.set_dictionary(window)
+        except IOError, (ecode, emsg):
+            raise LogIndexError('Error reading {0}: {1}'.format(path, emsg))
+
+        self.position = uncompressed
+        while self.position < offset:
+            data = self.read(min(offset - self.position, GZIP_READ_SIZE))
+            if data == '':
+                break
+
+    def __iter__(self):
+        return self
+
+    def __decompress__(self):
+        """
+        Decompress next block of data to self.buffer
+        """
+        stream = self.inflater.stream
+        while not self.finished:
+            if stream.avail_in == 0:
+                chunk = self.fd.read(GZIP_READ_SIZE)
+                if chunk == '':
+                    self.finished = True
+                    break
+                ctypes.memmove(self.input, chunk, len(chunk))
+                stream.next_in = ctypes.addressof(self.input)
+                stream.avail_in = len(chunk)
+
+            stream.next_out = ctypes.addressof(self.output)
+            stream.avail_out = GZIP_READ_SIZE
+            value = self.inflater.inflate(0)
+            size = GZIP_READ_SIZE - stream.avail_out
+            if value == Z_STREAM_END:
+                self.finished = True
+            if size:
+                self.buffer = self.buffer[self.buffer_offset:] + self.output.raw[:size]
+                self.buffer_offset = 0
+                return
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) - self.buffer_offset < size):
+            self.__decompress__()
+        if size < 0:
+            size = len(self.buffer) - self.buffer_offset
+        data = self.buffer[self.buffer_offset:self.buffer_offset + size]
+        self.buffer_offset += len(data)
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        index = self.buffer.find('\n', self.buffer_offset)
+        while index < 0 and not self.finished:
+            searched = len(self.buffer) - self.buffer_offset
+            self.__decompress__()
+            index = self.buffer.find('\n', self.buffer_offset + searched)
+        if index < 0:
+            return self.read()
+        return self.read(index + 1 - self.buffer_offset)
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.inflater is not None:
+            self.inflater.close()
+            self.inflater = None
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
@@ -0,0 +1,325 @@
+"""
+Multi-rule message matching for log entries
+"""
+
+import re
+import sre_parse
+import sre_constants
+
+from collections import deque
+
+
+class LogRuleError(Exception):
+    pass
+
+
+def parse_literal_pattern(regexp):
+    """Parse literal pattern
+
+    Return sre_parse tree of given compiled regexp for finding literals, or
+    None if literals can't be used: case insensitive and unicode patterns
+    have no literals.
+
+    """
+    if not isinstance(regexp.pattern, str) or regexp.flags & re.IGNORECASE:
+        return None
+
+    try:
+        return sre_parse.parse(regexp.pattern, regexp.flags)
+    except sre_constants.error:
+        return None
+
+
+def literal_runs(parsed, top=True):
+    """Literal runs
+
+    Return list of (prefix, run) tuples for runs of consecutive literal
+    characters in required parts of parsed regexp. Prefix is True for the
+    run every match starts with. Alternatives, optional parts and character
+    classes end a run.
+
+    """
+    runs = []
+    run = []
+    prefix = top
+    for index in xrange(len(parsed)):
+        op, value = parsed[index]
+        if op == sre_constants.LITERAL and value < 256:
+            run.append(chr(value))
+            continue
+
+        if prefix and not run and op == sre_constants.AT and value == sre_constants.AT_BEGINNING:
+            continue
+
+        if run:
+            runs.append((prefix, ''.join(run)))
+            run = []
+        prefix = False
+
+        if op == sre_constants.SUBPATTERN:
+            runs.extend(literal_runs(value[-1], False))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and value[0] >= 1:
+            runs.extend(literal_runs(value[2], False))
+
+    if run:
+        runs.append((prefix, ''.join(run)))
+    return runs
+
+
+def required_literals(regexp):
+    """Required literals
+
+    Return list of literal strings which every match of given compiled regexp
+    contains. Case insensitive and unicode patterns have no required
+    literals.
+
+    """
+    parsed = parse_literal_pattern(regexp)
+    if parsed is None:
+        return []
+    return sorted(set(run for prefix, run in literal_runs(parsed)))
+
+
+def required_literal(regexp):
+    """Required literal
+
+    Return the longest literal string which every match of given compiled
+    regexp contains, or empty string if there is none.
+
+    """
+    return max(required_literals(regexp) or [''], key=len)
+
+
+def literal_prefix(regexp):
+    """Literal prefix of regexp
+
+    Return literal string every match of given compiled regexp starts with,
+    up to the first newline, or empty string if the regexp has no literal
+    prefix. Case insensitive and unicode patterns have no literal prefix.
+
+    """
+    parsed = parse_literal_pattern(regexp)
+    if parsed is None:
+        return ''
+    for prefix, run in literal_runs(parsed):
+        if prefix:
+            return run.split('\n', 1)[0]
+    return ''
+
+
+class LiteralMatcher(object):
+    """Multiple literal string matcher
+
+    Aho-Corasick automaton finding all of a set of literal strings in a text
+    with one pass over the text. The automaton is built as a DFA with one
+    transition dictionary per state, so scanning a character is one
+    dictionary lookup.
+
+    """
+    def __init__(self, literals):
+        self.literals = []
+        self.transitions = [{}]
+        self.outputs = [()]
+        for literal in literals:
+            self.add(literal)
+        self.__build__()
+
+    def __repr__(self):
+        return '{0:d} literals {1:d} states'.format(len(self.literals), len(self.transitions))
+
+    def add(self, literal):
+        """
+        Add literal to the trie of literals
+        """
+        if not literal:
+            raise LogRuleError('Empty literal')
+
+        state = 0
+        for char in literal:
+            try:
+                state = self.transitions[state][char]
+            except KeyError:
+                self.transitions[state][char] = len(self.transitions)
+                state = len(self.transitions)
+                self.transitions.append({})
+                self.outputs.append(())
+        self.outputs[state] = (len(self.literals), )
+        self.literals.append(literal)
+
+    def __build__(self):
+        """
+        Add failure transitions to make the trie a DFA
+        """
+        goto = [dict(transitions) for transitions in self.transitions]
+        fail = [0] * len(goto)
+        queue = deque()
+        for char, state in goto[0].items():
+            queue.append(state)
+
+        # Breadth first: failure state of each state is processed before it
+        while queue:
+            state = queue.popleft()
+            self.outputs[state] = self.outputs[state] + self.outputs[fail[state]]
+            transitions = dict(self.transitions[fail[state]])
+            transitions.update(goto[state])
+            self.transitions[state] = transitions
+            for char, target in goto[state].items():
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[target] = goto[fallback].get(char, 0)
+                queue.append(target)
+
+    def search(self, text):
+        """Search literals
+
+        Return set of indexes of literals found in text
+
+        """
+        found = set()
+        transitions = self.transitions
+        outputs = self.outputs
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return found
+
+
+class LogRule(object):
+    """Message matching rule
+
+    Named message regexp. Rule matches entries with regexp.match, or with
+    regexp.search if search is True.
+
+    """
+    def __init__(self, name, regexp, search=False):
+        self.name = name
+        if isinstance(regexp, basestring):
+            try:
+                regexp = re.compile(regexp)
+            except re.error, emsg:
+                raise LogRuleError('Error compiling rule {0}: {1}'.format(name, emsg))
+        self.regexp = regexp
+        self.search = search
+        self.literals = required_literals(regexp)
+        self.__match = search and regexp.search or regexp.match
+
+    def __repr__(self):
+        return '{0} {1}'.format(self.name, self.regexp.pattern)
+
+    def match(self, message):
+        """
+        Return regexp match object for message or None
+        """
+        return self.__match(message)
+
+
+class LogRuleSet(list):
+    """Set of message matching rules
+
+    Set of named message regexps evaluated together. Regexps are compiled
+    once, and the literal strings each rule requires are extracted. One scan
+    of a message with LiteralMatcher finds which literals it contains, so only
+    rules whose literals were all found and rules without any literals are
+    evaluated.
+
+    Rules are given as dictionary or list of (name, regexp) tuples. Rules
+    match messages with regexp.match like LogFile.match_message, or with
+    regexp.search if search is True.
+
+    """
+    def __init__(self, rules=(), search=False):
+        self.search = search
+        self.matcher = None
+        if isinstance(rules, dict):
+            rules = sorted(rules.items())
+        for name, regexp in rules:
+            self.add_rule(name, regexp)
+
+    def __repr__(self):
+        return '{0:d} rules'.format(len(self))
+
+    def add_rule(self, name, regexp, search=None):
+        """Add rule
+
+        Add named rule for given regexp. Rule names must be unique.
+
+        """
+        if name in self.names:
+            raise LogRuleError('Duplicate rule name: {0}'.format(name))
+        if search is None:
+            search = self.search
+        self.append(LogRule(name, regexp, search))
+        self.matcher = None
+
+    @property
+    def names(self):
+        return [rule.name for rule in self]
+
+    def __build_matcher__(self):
+        """
+        Build literal matcher for rule literals
+        """
+        literals = sorted(set(literal for rule in self for literal in rule.literals))
+        self.matcher = LiteralMatcher(literals)
+        literal_indexes = dict((literal, index) for index, literal in enumerate(literals))
+        self.literal_rules = [[] for literal in literals]
+        self.unfiltered_rules = []
+        for index, rule in enumerate(self):
+            for literal in rule.literals:
+                self.literal_rules[literal_indexes[literal]].append(index)
+            if not rule.literals:
+                self.unfiltered_rules.append(index)
+
+    def match_message(self, message):
+        """Match message
+
+        Return list of (rule name, groupdict) tuples for rules matching given
+        message, in rule order.
+
+        """
+        if self.matcher is None:
+            self.__build_matcher__()
+
+        found = {}
+        for literal in self.matcher.search(message):
+            for index in self.literal_rules[literal]:
+                found[index] = found.get(index, 0) + 1
+
+        rules = list(self.unfiltered_rules)
+        rules.extend(index for index, count in found.items() if count == len(self[index].literals))
+        if len(rules) > 1:
+            rules.sort()
+
+        matches = []
+        for index in rules:
+            rule = self[index]
+            m = rule.match(message)
+            if m:
+                matches.append((rule.name, m.groupdict()))
+        return matches
+
+    def iter_matches(self, entries):
+        """Iterate matches
+
+        Generator yielding (rule name, entry, groupdict) tuples for given
+        iterable of entries with one pass over the entries.
+
+        """
+        for entry in entries:
+            for name, groups in self.match_message(entry.message):
+                yield name, entry, groups
+
+    def match(self, entries):
+        """Match entries
+
+        Return dictionary of lists of (entry, groupdict) tuples by rule name
+        for given iterable of entries, with one pass over the entries.
+
+        """
+        matches = dict((rule.name, []) for rule in self)
+        for name, entry, groups in self.iter_matches(entries):
+            matches[name].append((entry, groups))
+        return matches
@@ -0,0 +1,495 @@
+"""
+Streaming statistics for log entries
+"""
+
+import re
+import math
+import struct
+import hashlib
+import heapq
+import calendar
+
+from array import array
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_AGGREGATE_INTERVAL = 60
+DEFAULT_MAX_GROUPS = 2**16
+
+# Limit of dense time buckets returned from LogAggregation
+DEFAULT_MAX_BUCKETS = 2**20
+
+# Key value used for groups over max_groups
+OTHER_GROUP = '<other>'
+
+DEFAULT_TOPK_EPSILON = 0.001
+DEFAULT_TOPK_DELTA = 0.01
+
+# Variable message tokens masked by message_template
+MESSAGE_VARIABLE_PATTERNS = (
+    re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'),
+    re.compile(r'\b(?:0x)?[0-9a-fA-F]*\d[0-9a-fA-F]*\b'),
+)
+MESSAGE_VARIABLE = '<*>'
+
+
+class LogStatsError(Exception):
+    pass
+
+
+class LogAggregation(object):
+    """Group by counts of log entries
+
+    Counts entries by time bucket of interval seconds and group of key
+    values in a single pass over streamed entries, without storing entries.
+    Set interval to None to count without time buckets.
+
+    Keys are entry attribute names like host, program and pid, or names of
+    groups in message_regexp. If message_regexp is given, only entries with
+    message matching it are counted.
+
+    Memory use is bounded by max_groups: entries for groups seen after
+    max_groups distinct groups are counted to a group with all key values set
+    to OTHER_GROUP.
+
+    Counts are stored sparsely, but buckets(), series() and as_arrays() return
+    every time bucket from the first to the last counted bucket. The span is
+    limited to max_buckets buckets, so a single entry with a wrong year does
+    not make them allocate millions of empty buckets: LogStatsError is raised
+    instead.
+
+    """
+    max_buckets = DEFAULT_MAX_BUCKETS
+    def __init__(self, interval=DEFAULT_AGGREGATE_INTERVAL, keys=('host', ), message_regexp=None,
+                 max_groups=DEFAULT_MAX_GROUPS):
+        if isinstance(keys, basestring):
+            keys = (keys, )
+        if isinstance(message_regexp, basestring):
+            message_regexp = re.compile(message_regexp)
+
+        self.interval = interval
+        self.keys = tuple(keys)
+        self.message_regexp = message_regexp
+        self.max_groups = max_groups
+        self.counts = {}
+        self.group_keys = set()
+        self.total = 0
+
+        capture_keys = message_regexp is not None and message_regexp.groupindex or {}
+        self.__capture_keys = [key in capture_keys for key in self.keys]
+        self.__other = tuple(OTHER_GROUP for key in self.keys)
+        self.__last_time = (None, None)
+
+    def __repr__(self):
+        return '{0:d} entries in {1:d} groups'.format(self.total, len(self.group_keys))
+
+    def __bucket__(self, value):
+        """
+        Return epoch seconds of start of time bucket for entry time
+        """
+        last_value, bucket = self.__last_time
+        if value is not last_value:
+            if value is None or self.interval is None:
+                bucket = None
+            else:
+                epoch = calendar.timegm(value.timetuple())
+                bucket = epoch - epoch % self.interval
+            self.__last_time = (value, bucket)
+        return bucket
+
+    def add(self, entry):
+        """Add entry
+
+        Count given entry. Returns True if entry was counted.
+
+        """
+        groups = None
+        if self.message_regexp is not None:
+            m = self.message_regexp.match(entry.message)
+            if not m:
+                return False
+            groups = m.groupdict()
+
+        group = []
+        for key, capture in zip(self.keys, self.__capture_keys):
+            if capture:
+                group.append(groups[key])
+            else:
+                group.append(getattr(entry, key, None))
+        group = tuple(group)
+        if group not in self.group_keys:
+            if len(self.group_keys) >= self.max_groups:
+                group = self.__other
+            self.group_keys.add(group)
+
+        key = (self.__bucket__(entry.time), group)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        return True
+
+    def update(self, entries):
+        """Update counts
+
+        Count given iterable of entries
+
+        """
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def merge(self, other):
+        """Merge aggregations
+
+        Add counts from another aggregation with same interval and keys, for
+        example computed from another file in parallel
+
+        """
+        if other.interval != self.interval or other.keys != self.keys:
+            raise LogStatsError('Can not merge aggregations with different interval or keys')
+
+        for (bucket, group), count in other.counts.items():
+            if group not in self.group_keys:
+                if len(self.group_keys) >= self.max_groups:
+                    group = self.__other
+                self.group_keys.add(group)
+            key = (bucket, group)
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+        return self
+
+    def bucket_epochs(self):
+        """Time bucket epochs
+
+        Return list of time bucket epoch seconds from first to last bucket, or
+        [None] if interval is None. Entries without time are not included in
+        time buckets.
+
+        Raises LogStatsError if there are more than max_buckets buckets.
+
+        """
+        if self.interval is None:
+            return [None]
+
+        epochs = [bucket for bucket, group in self.counts.keys() if bucket is not None]
+        if not epochs:
+            return []
+
+        first = min(epochs)
+        last = max(epochs)
+        if (last - first) // self.interval + 1 > self.max_buckets:
+            raise LogStatsError('Time range {0} - {1} has more than {2:d} buckets'.format(
+                datetime.utcfromtimestamp(first), datetime.utcfromtimestamp(last), self.max_buckets
+            ))
+        return range(first, last + self.interval, self.interval)
+
+    def buckets(self):
+        """
+        Return list of time bucket start times from first to last bucket
+        """
+        return [epoch is not None and datetime.utcfromtimestamp(epoch) or None for epoch in self.bucket_epochs()]
+
+    def groups(self):
+        """
+        Return sorted list of group key value tuples
+        """
+        return sorted(self.group_keys)
+
+    def totals(self):
+        """
+        Return dictionary of total counts by group
+        """
+        totals = {}
+        for (bucket, group), count in self.counts.items():
+            totals[group] = totals.get(group, 0) + count
+        return totals
+
+    def series(self, group):
+        """Time series for group
+
+        Return list of counts for each time bucket from buckets() for given
+        group key value tuple
+
+        """
+        if not isinstance(group, tuple):
+            group = (group, )
+        return [self.counts.get((epoch, group), 0) for epoch in self.bucket_epochs()]
+
+    def as_arrays(self):
+        """Counts as NumPy arrays
+
+        Return tuple (times, groups, counts) with datetime64 array of time
+        bucket start times, list of group key value tuples and int64 array of
+        counts with one row per group and one column per time bucket.
+
+        """
+        if numpy is None:
+            raise LogStatsError('NumPy is not available')
+
+        epochs = self.bucket_epochs()
+        groups = self.groups()
+        columns = dict((epoch, index) for index, epoch in enumerate(epochs))
+        rows = dict((group, index) for index, group in enumerate(groups))
+        counts = numpy.zeros((len(groups), len(epochs)), dtype=numpy.int64)
+        for (bucket, group), count in self.counts.items():
+            if bucket in columns:
+                counts[rows[group], columns[bucket]] += count
+        times = numpy.array(epochs, dtype='datetime64[s]')
+        return times, groups, counts
+
+
+def message_template(entry):
+    """Message template
+
+    Return message of entry with numbers, hex strings and IP addresses
+    replaced by MESSAGE_VARIABLE, as a simple key grouping similar messages
+
+    """
+    message = entry.message.split('\n', 1)[0]
+    for pattern in MESSAGE_VARIABLE_PATTERNS:
+        message = pattern.sub(MESSAGE_VARIABLE, message)
+    return message
+
+
+class CountMinSketch(object):
+    """Count-Min sketch
+
+    Fixed size frequency sketch. Estimates never undercount, and overcount by
+    more than epsilon times total count with probability at most delta.
+    Sketches with same dimensions can be merged.
+
+    """
+    def __init__(self, epsilon=DEFAULT_TOPK_EPSILON, delta=DEFAULT_TOPK_DELTA):
+        self.width = int(math.ceil(math.e / epsilon))
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.rows = [array('l', [0]) * self.width for row in xrange(self.depth)]
+        self.total = 0
+
+    def __repr__(self):
+        return 'count-min {0:d}x{1:d}'.format(self.depth, self.width)
+
+    def __columns__(self, key):
+        """Columns of key
+
+        Return column of key in each row. Row hashes are independent 32 bit
+        slices of MD5 digests of the key, which are equal in all processes.
+
+        """
+        if not isinstance(key, str):
+            key = repr(key)
+        columns = []
+        for index in xrange(0, self.depth, 4):
+            digest = hashlib.md5('{0:d}:'.format(index) + key).digest()
+            columns.extend(value % self.width for value in struct.unpack('<4I', digest))
+        return columns[:self.depth]
+
+    def add(self, key, count=1):
+        """
+        Add count for key and return new estimate for the key
+        """
+        estimate = None
+        for row, column in zip(self.rows, self.__columns__(key)):
+            row[column] += count
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+        self.total += count
+        return estimate
+
+    def estimate(self, key):
+        """
+        Return estimated count for key
+        """
+        return min(row[column] for row, column in zip(self.rows, self.__columns__(key)))
+
+    def merge(self, other):
+        """
+        Add counts from another sketch with same dimensions
+        """
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise LogStatsError('Can not merge count-min sketches with different dimensions')
+        for row, other_row in zip(self.rows, other.rows):
+            for column, count in enumerate(other_row):
+                if count:
+                    row[column] += count
+        self.total += other.total
+        return self
+
+
+class SpaceSaving(object):
+    """Space-Saving heavy hitter counters
+
+    Tracks at most capacity keys. When a new key is seen with all counters
+    in use, the key with the smallest count is replaced and the new key
+    inherits its count as error. Counts overestimate by at most total count
+    divided by capacity, and every key with more than that many occurrences
+    is tracked.
+
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+        self.__heap = []
+
+    def __repr__(self):
+        return 'space-saving {0:d}/{1:d} keys'.format(len(self.counts), self.capacity)
+
+    def __min_key__(self):
+        """
+        Return key with smallest count, discarding outdated heap items
+        """
+        heap = self.__heap
+        while True:
+            count, key = heap[0]
+            if self.counts.get(key) == count:
+                return key
+            heapq.heappop(heap)
+
+    def __push__(self, key, count):
+        heap = self.__heap
+        heapq.heappush(heap, (count, key))
+        if len(heap) > 4 * self.capacity:
+            self.__heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.__heap)
+
+    def add(self, key, count=1):
+        """
+        Add count for key and return new count of the key
+        """
+        self.total += count
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            evicted = self.__min_key__()
+            error = self.counts.pop(evicted)
+            del self.errors[evicted]
+            self.counts[key] = error + count
+            self.errors[key] = error
+        self.__push__(key, self.counts[key])
+        return self.counts[key]
+
+    def min_count(self):
+        """
+        Return count any untracked key may have
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return self.counts[self.__min_key__()]
+
+    def merge(self, other):
+        """Merge counters
+
+        Add counters from another Space-Saving summary. Keys missing from one
+        summary are counted with its min_count as error, and the capacity
+        keys with largest counts are kept.
+
+        """
+        self_min = self.min_count()
+        other_min = other.min_count()
+        counts = {}
+        errors = {}
+        for key in set(self.counts.keys()) | set(other.counts.keys()):
+            counts[key] = self.counts.get(key, self_min) + other.counts.get(key, other_min)
+            errors[key] = self.errors.get(key, self_min) + other.errors.get(key, other_min)
+
+        keys = heapq.nlargest(self.capacity, counts.keys(), key=lambda key: counts[key])
+        self.counts = dict((key, counts[key]) for key in keys)
+        self.errors = dict((key, errors[key]) for key in keys)
+        self.total += other.total
+        self.__heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.__heap)
+        return self
+
+    def top(self, k=None):
+        """
+        Return list of (key, count, error) tuples for tracked keys by count
+        """
+        keys = sorted(self.counts.keys(), key=lambda key: (-self.counts[key], key))
+        return [(key, self.counts[key], self.errors[key]) for key in keys[:k]]
+
+
+class TopKSummary(object):
+    """Top-K summary of log entries
+
+    Memory bounded summary of most frequent values of key in streamed
+    entries. Key is an entry attribute name like program or host, or a
+    callable returning the key for an entry, like message_template.
+
+    Counts are tracked with Space-Saving counters for 1 / epsilon keys, so
+    each reported count overestimates by at most epsilon times total count.
+    If delta is not None, a Count-Min sketch with same epsilon and failure
+    probability delta is used to tighten the reported counts.
+
+    Summaries with same key and parameters, for example computed from
+    different files in parallel, can be merged.
+
+    """
+    def __init__(self, key='program', epsilon=DEFAULT_TOPK_EPSILON, delta=DEFAULT_TOPK_DELTA):
+        self.key = key
+        self.epsilon = epsilon
+        self.delta = delta
+        self.counters = SpaceSaving(int(math.ceil(1.0 / epsilon)))
+        self.sketch = delta is not None and CountMinSketch(epsilon, delta) or None
+
+    def __repr__(self):
+        return 'top-k {0} {1:d} entries'.format(getattr(self.key, '__name__', self.key), self.total)
+
+    @property
+    def total(self):
+        return self.counters.total
+
+    def add(self, entry):
+        """
+        Count given entry
+        """
+        if callable(self.key):
+            key = self.key(entry)
+        else:
+            key = getattr(entry, self.key, None)
+        self.counters.add(key)
+        if self.sketch is not None:
+            self.sketch.add(key)
+
+    def update(self, entries):
+        """Update counts
+
+        Count given iterable of entries
+
+        """
+        for entry in entries:
+            self.add(entry)
+        return self
+
+    def merge(self, other):
+        """
+        Merge counts from another summary with same key and parameters
+        """
+        if (other.key, other.epsilon, other.delta) != (self.key, self.epsilon, self.delta):
+            raise LogStatsError('Can not merge top-k summaries with different key or parameters')
+        self.counters.merge(other.counters)
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    def top(self, k=10):
+        """Top keys
+
+        Return list of (key, count, lower bound) tuples for k most frequent
+        keys. Count is an upper bound of the true count, which is at least
+        lower bound.
+
+        """
+        results = []
+        for key, count, error in self.counters.top():
+            if self.sketch is not None:
+                count = min(count, self.sketch.estimate(key))
+            results.append((key, count, max(self.counters.counts[key] - error, 0)))
+        results.sort(key=lambda result: (-result[1], result[0]))
+        return results[:k]
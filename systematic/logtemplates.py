@@ -0,0 +1,388 @@
+"""
+Online message template mining for log entries
+"""
+
+import os
+import re
+import json
+
+from collections import OrderedDict
+
+from systematic.logstats import MESSAGE_VARIABLE_PATTERNS, MESSAGE_VARIABLE
+
+DEFAULT_TEMPLATE_DEPTH = 4
+DEFAULT_TEMPLATE_SIMILARITY = 0.4
+DEFAULT_MAX_CHILDREN = 100
+DEFAULT_MAX_TEMPLATES = 2**14
+DEFAULT_MAX_EXAMPLES = 3
+TEMPLATE_FILE_VERSION = 1
+
+# Message bytes are saved as latin-1 code points, so any bytes are restored as is
+TEMPLATE_FILE_ENCODING = 'latin-1'
+
+DIGITS = re.compile(r'\d')
+
+
+class LogTemplateError(Exception):
+    pass
+
+
+def message_tokens(message):
+    """Message tokens
+
+    Return list of tokens in first line of message, with numbers, hex strings
+    and IP addresses replaced by MESSAGE_VARIABLE
+
+    """
+    message = message.split('\n', 1)[0]
+    for pattern in MESSAGE_VARIABLE_PATTERNS:
+        message = pattern.sub(MESSAGE_VARIABLE, message)
+    return message.split()
+
+
+class LogTemplate(object):
+    """Message template
+
+    Template of similar messages, with variable tokens replaced by
+    MESSAGE_VARIABLE. Path is the key path of the template in the parse tree
+    of the TemplateMiner.
+
+    """
+    def __init__(self, template_id, tokens, path, count=0, examples=None):
+        self.id = template_id
+        self.tokens = tokens
+        self.path = path
+        self.count = count
+        self.examples = examples is not None and examples or []
+
+    def __repr__(self):
+        return '{0:d} {1}'.format(self.id, self.template)
+
+    @property
+    def template(self):
+        return ' '.join(self.tokens)
+
+    def similarity(self, tokens):
+        """Similarity
+
+        Return tuple (similarity, variables) for tokens of same length, where
+        similarity is fraction of tokens equal to constant template tokens
+        and variables is number of variable tokens in template
+
+        """
+        equal = 0
+        variables = 0
+        for template_token, token in zip(self.tokens, tokens):
+            if template_token == MESSAGE_VARIABLE:
+                variables += 1
+            elif template_token == token:
+                equal += 1
+        return float(equal) / max(len(tokens), 1), variables
+
+    def merge(self, tokens):
+        """
+        Replace template tokens not equal to given tokens with MESSAGE_VARIABLE
+        """
+        self.tokens = [
+            template_token == token and template_token or MESSAGE_VARIABLE
+            for template_token, token in zip(self.tokens, tokens)
+        ]
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'tokens': self.tokens,
+            'path': self.path,
+            'count': self.count,
+            'examples': self.examples,
+        }
+
+
+class TemplateMiner(object):
+    """Online message template miner
+
+    Drain style template miner. Messages are routed through a fixed depth
+    parse tree by token count and depth - 2 first tokens, and compared only
+    with templates in the reached leaf. A message joins the most similar
+    template if at least similarity of its tokens are equal to the template,
+    otherwise it starts a new template.
+
+    Memory is bounded by max_children tree nodes per node, max_templates
+    templates and max_examples example messages per template. When there are
+    more templates, least recently matched templates are dropped, and tree
+    nodes left without templates are removed.
+
+    Miner state can be saved to a file and loaded to continue mining
+    incrementally.
+
+    """
+    def __init__(self, depth=DEFAULT_TEMPLATE_DEPTH, similarity=DEFAULT_TEMPLATE_SIMILARITY,
+                 max_children=DEFAULT_MAX_CHILDREN, max_templates=DEFAULT_MAX_TEMPLATES,
+                 max_examples=DEFAULT_MAX_EXAMPLES):
+        if depth < 3:
+            raise LogTemplateError('Template tree depth must be at least 3')
+
+        self.depth = depth
+        self.similarity = similarity
+        self.max_children = max_children
+        self.max_templates = max_templates
+        self.max_examples = max_examples
+        self.clear()
+
+    def __repr__(self):
+        return '{0:d} templates'.format(len(self.templates))
+
+    def __len__(self):
+        return len(self.templates)
+
+    def clear(self):
+        """
+        Remove all templates
+        """
+        self.tree = {}
+        self.templates = OrderedDict()
+        self.next_id = 1
+
+    def __route__(self, tokens, create):
+        """Route tokens
+
+        Return tree key path for tokens, creating missing nodes if create is
+        True, or None if there is no matching node
+
+        """
+        path = [len(tokens)]
+        if create:
+            node = self.tree.setdefault(len(tokens), {})
+        else:
+            node = self.tree.get(len(tokens), {})
+        for token in tokens[:self.depth - 2]:
+            # Tokens with digits are likely variables, route them to the variable node
+            if DIGITS.search(token):
+                token = MESSAGE_VARIABLE
+
+            if token in node.get('children', {}):
+                key = token
+            elif token != MESSAGE_VARIABLE and create and len(node.get('children', {})) < self.max_children:
+                key = token
+            elif MESSAGE_VARIABLE in node.get('children', {}) or create:
+                key = MESSAGE_VARIABLE
+            else:
+                return None
+
+            path.append(key)
+            node = node.setdefault('children', {}).setdefault(key, {})
+        return path
+
+    def __leaf__(self, path, create=False):
+        """
+        Return template id list of leaf at path, or None if it does not exist
+        """
+        node = {'children': self.tree}
+        for key in path:
+            if create:
+                node = node.setdefault('children', {}).setdefault(key, {})
+            else:
+                node = node.get('children', {}).get(key, None)
+                if node is None:
+                    return None
+        if create:
+            return node.setdefault('templates', [])
+        return node.get('templates', None)
+
+    def __best_template__(self, leaf, tokens):
+        """
+        Return most similar template in leaf for tokens, or None
+        """
+        best = None
+        best_score = None
+        for template_id in leaf:
+            template = self.templates[template_id]
+            score = template.similarity(tokens)
+            if score[0] >= self.similarity and (best_score is None or score > best_score):
+                best = template
+                best_score = score
+        return best
+
+    def __remove_template__(self, template):
+        """Remove template
+
+        Remove template from templates and the tree, pruning tree nodes left
+        without templates
+
+        """
+        del self.templates[template.id]
+
+        nodes = [{'children': self.tree}]
+        for key in template.path:
+            node = nodes[-1].get('children', {}).get(key, None)
+            if node is None:
+                return
+            nodes.append(node)
+
+        leaf = nodes[-1].get('templates', [])
+        if template.id in leaf:
+            leaf.remove(template.id)
+
+        # Remove empty nodes from the leaf up
+        for parent, key in reversed(zip(nodes[:-1], template.path)):
+            node = parent['children'][key]
+            if node.get('templates') or node.get('children'):
+                break
+            del parent['children'][key]
+
+    def __add_template__(self, template):
+        """
+        Add template to templates and the tree
+        """
+        self.templates[template.id] = template
+        self.__leaf__(template.path, create=True).append(template.id)
+        while len(self.templates) > self.max_templates:
+            self.__remove_template__(self.templates[next(iter(self.templates))])
+
+    def add_message(self, message):
+        """Add message
+
+        Add message to most similar template or a new template. Returns the
+        template.
+
+        """
+        tokens = message_tokens(message)
+        path = self.__route__(tokens, create=True)
+        leaf = self.__leaf__(path, create=True)
+        template = self.__best_template__(leaf, tokens)
+
+        if template is None:
+            template = LogTemplate(self.next_id, tokens, path)
+            self.next_id += 1
+        else:
+            template.merge(tokens)
+            # Mark template recently used
+            del self.templates[template.id]
+            leaf.remove(template.id)
+
+        template.count += 1
+        if len(template.examples) < self.max_examples:
+            template.examples.append(message.split('\n', 1)[0])
+        self.__add_template__(template)
+        return template
+
+    def add(self, entry):
+        """
+        Add message of entry, returns the template
+        """
+        return self.add_message(entry.message)
+
+    def iter_update(self, entries):
+        """Iterate updates
+
+        Generator adding messages of given iterable of entries and yielding
+        (template, entry) tuples
+
+        """
+        for entry in entries:
+            yield self.add_message(entry.message), entry
+
+    def update(self, entries):
+        """Update templates
+
+        Add messages of given iterable of entries
+
+        """
+        for entry in entries:
+            self.add_message(entry.message)
+        return self
+
+    def match(self, message):
+        """Match message
+
+        Return template matching message without updating templates, or None
+
+        """
+        tokens = message_tokens(message)
+        path = self.__route__(tokens, create=False)
+        if path is None:
+            return None
+        leaf = self.__leaf__(path)
+        if leaf is None:
+            return None
+        return self.__best_template__(leaf, tokens)
+
+    def top(self, count=None):
+        """
+        Return list of templates sorted by count
+        """
+        return sorted(self.templates.values(), key=lambda template: (-template.count, template.id))[:count]
+
+    def as_dict(self):
+        return {
+            'version': TEMPLATE_FILE_VERSION,
+            'depth': self.depth,
+            'similarity': self.similarity,
+            'max_children': self.max_children,
+            'max_templates': self.max_templates,
+            'max_examples': self.max_examples,
+            'next_id': self.next_id,
+            'templates': [template.as_dict() for template in self.templates.values()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create miner from as_dict() data
+        """
+        if data.get('version') != TEMPLATE_FILE_VERSION:
+            raise LogTemplateError('Unsupported template data version: {0}'.format(data.get('version')))
+
+        try:
+            miner = cls(data['depth'], data['similarity'], data['max_children'], data['max_templates'], data['max_examples'])
+            for template in data['templates']:
+                miner.__add_template__(LogTemplate(
+                    template['id'],
+                    [token.encode(TEMPLATE_FILE_ENCODING) for token in template['tokens']],
+                    [isinstance(key, basestring) and key.encode(TEMPLATE_FILE_ENCODING) or key for key in template['path']],
+                    template['count'],
+                    [example.encode(TEMPLATE_FILE_ENCODING) for example in template['examples']],
+                ))
+            miner.next_id = data['next_id']
+        except (KeyError, TypeError, ValueError, AttributeError), emsg:
+            raise LogTemplateError('Invalid template data: {0}'.format(emsg))
+        return miner
+
+    def save(self, path):
+        """
+        Save miner state to file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        tmp_path = '{0}.tmp'.format(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_path, 'w') as fd:
+                json.dump(self.as_dict(), fd, encoding=TEMPLATE_FILE_ENCODING)
+            os.rename(tmp_path, path)
+            return
+        except (IOError, OSError), (ecode, emsg):
+            error = 'Error writing templates {0}: {1}'.format(path, emsg)
+        except (TypeError, ValueError), emsg:
+            error = 'Error encoding templates {0}: {1}'.format(path, emsg)
+
+        if os.path.isfile(tmp_path):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+        raise LogTemplateError(error)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load miner state saved with save()
+        """
+        try:
+            with open(path, 'r') as fd:
+                data = json.load(fd)
+        except (IOError, OSError), (ecode, emsg):
+            raise LogTemplateError('Error reading templates {0}: {1}'.format(path, emsg))
+        except ValueError, emsg:
+            raise LogTemplateError('Error parsing templates {0}: {1}'.format(path, emsg))
+        return cls.from_dict(data)
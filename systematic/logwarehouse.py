@@ -0,0 +1,333 @@
+"""
+Export of parsed log file entries to indexed sqlite database
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+
+from systematic.log import LogFile, LogFileCollection, LogFileError
+from systematic.sqlite import SQLiteDatabase, SQLiteError
+
+DEFAULT_WAREHOUSE_BATCH_SIZE = 10000
+DEFAULT_BULK_IMPORT_RATIO = 1.0
+FINGERPRINT_BLOCK_SIZE = 2**16
+
+WAREHOUSE_TABLES_SQL = (
+    """CREATE TABLE IF NOT EXISTS logfile (
+        id          INTEGER PRIMARY KEY,
+        path        TEXT NOT NULL,
+        fingerprint TEXT UNIQUE NOT NULL,
+        head        TEXT NOT NULL,
+        size        INTEGER NOT NULL,
+        entries     INTEGER NOT NULL,
+        imported    REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS entry (
+        id          INTEGER PRIMARY KEY,
+        logfile     INTEGER NOT NULL REFERENCES logfile(id) ON DELETE CASCADE,
+        time        TEXT,
+        host        TEXT,
+        program     TEXT,
+        pid         INTEGER,
+        message     TEXT
+    )""",
+    'CREATE INDEX IF NOT EXISTS entry_logfile ON entry(logfile)',
+)
+
+WAREHOUSE_INDEXES_SQL = (
+    'CREATE INDEX IF NOT EXISTS entry_time ON entry(time)',
+    'CREATE INDEX IF NOT EXISTS entry_host ON entry(host, time)',
+    'CREATE INDEX IF NOT EXISTS entry_program ON entry(program, time)',
+)
+
+WAREHOUSE_DROP_INDEXES_SQL = (
+    'DROP INDEX IF EXISTS entry_time',
+    'DROP INDEX IF EXISTS entry_host',
+    'DROP INDEX IF EXISTS entry_program',
+)
+
+WAREHOUSE_FTS_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS entry_fts USING fts5(message, content='entry', content_rowid='id')"
+
+
+class LogWarehouseError(Exception):
+    pass
+
+
+def db_text(value):
+    """
+    Return byte string decoded as UTF-8 for sqlite, replacing invalid bytes
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def head_digest(path, length):
+    """
+    Return digest of first length bytes of file
+    """
+    try:
+        with open(path, 'rb') as fd:
+            return hashlib.sha1(fd.read(length)).hexdigest()
+    except (IOError, OSError), (ecode, emsg):
+        raise LogWarehouseError('Error reading {0}: {1}'.format(path, emsg))
+
+
+def file_fingerprint(path, block_size=FINGERPRINT_BLOCK_SIZE):
+    """File fingerprint
+
+    Return tuple (fingerprint, head, size) for file. Fingerprint is a digest of
+    file size and first and last block of data, and head a digest of only the
+    first block. Fingerprints don't depend on file path, so rotated files are
+    recognized after rename.
+
+    """
+    try:
+        with open(path, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            size = fd.tell()
+            fd.seek(0)
+            head = fd.read(block_size)
+            fd.seek(max(size - block_size, 0))
+            tail = fd.read(block_size)
+    except (IOError, OSError), (ecode, emsg):
+        raise LogWarehouseError('Error reading {0}: {1}'.format(path, emsg))
+
+    head = hashlib.sha1(head).hexdigest()
+    fingerprint = hashlib.sha1('{0:d}:{1}:'.format(size, head) + tail).hexdigest()
+    return fingerprint, head, size
+
+
+class LogWarehouse(SQLiteDatabase):
+    """Sqlite warehouse of log entries
+
+    Sqlite database of parsed log entries for indexed queries over many log
+    files. Entries are inserted with executemany in batches of batch_size
+    rows, and each log file is imported in one transaction. Indexes on time,
+    host and program are created after the entries are loaded by
+    import_logfiles. Later imports of at least bulk_import_ratio times the size
+    of already imported files drop the indexes before the load and create them
+    again after it, smaller imports insert into the indexed table. Entries are
+    added to the full text index on messages, if fts is True, after each file
+    is loaded.
+
+    Files are identified by fingerprint, so already imported files are skipped
+    even if they were renamed by log rotation. A file which grew since import
+    replaces the earlier import of the file.
+
+    Text is stored decoded as UTF-8, with invalid bytes replaced.
+
+    """
+    batch_size = DEFAULT_WAREHOUSE_BATCH_SIZE
+    bulk_import_ratio = DEFAULT_BULK_IMPORT_RATIO
+
+    def __init__(self, db_path, fts=False):
+        try:
+            super(LogWarehouse, self).__init__(db_path, WAREHOUSE_TABLES_SQL)
+        except (sqlite3.Error, OSError), emsg:
+            raise LogWarehouseError('Error opening warehouse {0}: {1}'.format(db_path, emsg))
+        except SQLiteError, emsg:
+            raise LogWarehouseError(emsg)
+
+        self.fts = fts
+        if fts:
+            try:
+                self.cursor.execute(WAREHOUSE_FTS_SQL)
+            except sqlite3.OperationalError, emsg:
+                raise LogWarehouseError('Error creating full text index: {0}'.format(emsg))
+
+    def __repr__(self):
+        return self.db_path
+
+    def __iter_parsers__(self, logfiles):
+        """
+        Iterate LogFile parsers for LogFileCollection, LogFile or iterable of them or paths
+        """
+        if isinstance(logfiles, LogFileCollection):
+            logfiles = logfiles.logfiles
+        elif isinstance(logfiles, (LogFile, basestring)):
+            logfiles = [logfiles]
+
+        for logfile in logfiles:
+            if isinstance(logfile, basestring):
+                logfile = LogFile(logfile)
+            yield logfile
+
+    def __delete_logfile__(self, c, logfile_id):
+        """
+        Delete imported log file and its entries
+        """
+        if self.fts:
+            c.execute(
+                "INSERT INTO entry_fts (entry_fts, rowid, message) SELECT 'delete', id, message FROM entry WHERE logfile=?",
+                (logfile_id, )
+            )
+        c.execute('DELETE FROM logfile WHERE id=?', (logfile_id, ))
+
+    def is_imported(self, path):
+        """
+        Check if file with fingerprint of given file is already imported
+        """
+        fingerprint, head, size = file_fingerprint(path)
+        c = self.cursor
+        c.execute('SELECT id FROM logfile WHERE fingerprint=?', (fingerprint, ))
+        return c.fetchone() is not None
+
+    def import_logfile(self, logfile):
+        """Import log file
+
+        Import entries of LogFile, streamed if it's not loaded. Returns number
+        of imported entries, or None if the file was already imported.
+
+        """
+        fingerprint, head, size = file_fingerprint(logfile.path)
+        c = self.cursor
+        c.execute('SELECT id FROM logfile WHERE fingerprint=?', (fingerprint, ))
+        if c.fetchone() is not None:
+            return None
+
+        try:
+            # Earlier import of same file before it grew has same data in its head block
+            c.execute('SELECT id, head, size FROM logfile WHERE path=? AND size<?', (db_text(logfile.path), size))
+            for logfile_id, imported_head, imported_size in c.fetchall():
+                if imported_head == head_digest(logfile.path, min(imported_size, FINGERPRINT_BLOCK_SIZE)):
+                    self.__delete_logfile__(c, logfile_id)
+
+            c.execute(
+                'INSERT INTO logfile (path, fingerprint, head, size, entries, imported) VALUES (?, ?, ?, ?, 0, ?)',
+                (db_text(logfile.path), fingerprint, head, size, time.time())
+            )
+            logfile_id = c.lastrowid
+
+            count = 0
+            batch = []
+            for entry in logfile.iter_entries():
+                batch.append((
+                    logfile_id,
+                    entry.time is not None and entry.time.isoformat(' ') or None,
+                    db_text(entry.host),
+                    db_text(entry.program),
+                    entry.pid,
+                    db_text(entry.message),
+                ))
+                if len(batch) >= self.batch_size:
+                    c.executemany('INSERT INTO entry (logfile, time, host, program, pid, message) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                c.executemany('INSERT INTO entry (logfile, time, host, program, pid, message) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+
+            if self.fts:
+                c.execute('INSERT INTO entry_fts (rowid, message) SELECT id, message FROM entry WHERE logfile=?', (logfile_id, ))
+            c.execute('UPDATE logfile SET entries=? WHERE id=?', (count, logfile_id))
+            self.commit()
+
+        except (sqlite3.Error, LogFileError), emsg:
+            self.rollback()
+            raise LogWarehouseError('Error importing {0}: {1}'.format(logfile.path, emsg))
+
+        return count
+
+    def create_indexes(self):
+        """
+        Create entry indexes
+        """
+        c = self.cursor
+        try:
+            for q in WAREHOUSE_INDEXES_SQL:
+                c.execute(q)
+            self.commit()
+        except sqlite3.Error, emsg:
+            raise LogWarehouseError('Error creating indexes: {0}'.format(emsg))
+
+    def drop_indexes(self):
+        """
+        Drop entry indexes on time, host and program
+        """
+        c = self.cursor
+        try:
+            for q in WAREHOUSE_DROP_INDEXES_SQL:
+                c.execute(q)
+            self.commit()
+        except sqlite3.Error, emsg:
+            raise LogWarehouseError('Error dropping indexes: {0}'.format(emsg))
+
+    def is_bulk_import(self, logfiles):
+        """
+        Check if given LogFile objects are at least bulk_import_ratio times the size of imported files
+        """
+        size = 0
+        for logfile in logfiles:
+            if isinstance(logfile.path, basestring) and os.path.isfile(logfile.path):
+                size += os.path.getsize(logfile.path)
+
+        c = self.cursor
+        c.execute('SELECT sum(size) FROM logfile')
+        imported_size = c.fetchone()[0] or 0
+        return size >= imported_size * self.bulk_import_ratio
+
+    def import_logfiles(self, logfiles):
+        """Import log files
+
+        Import LogFileCollection, LogFile, or iterable of LogFile objects or
+        paths, skipping already imported files, and create indexes after the
+        load. Indexes are dropped before the load if it's a bulk import.
+        Returns dictionary of imported entry counts by path.
+
+        """
+        logfiles = list(self.__iter_parsers__(logfiles))
+        if self.is_bulk_import(logfiles):
+            self.drop_indexes()
+
+        imported = {}
+        try:
+            for logfile in logfiles:
+                count = self.import_logfile(logfile)
+                if count is not None:
+                    imported[logfile.path] = count
+        finally:
+            self.create_indexes()
+        return imported
+
+    def remove_logfile(self, path):
+        """
+        Remove imported entries of log file path
+        """
+        c = self.cursor
+        try:
+            c.execute('SELECT id FROM logfile WHERE path=?', (db_text(path), ))
+            for (logfile_id, ) in c.fetchall():
+                self.__delete_logfile__(c, logfile_id)
+            self.commit()
+        except sqlite3.Error, emsg:
+            self.rollback()
+            raise LogWarehouseError('Error removing {0}: {1}'.format(path, emsg))
+
+    def query(self, sql, args=()):
+        """
+        Return query results as list of dictionaries
+        """
+        c = self.cursor
+        try:
+            c.execute(sql, args)
+        except sqlite3.Error, emsg:
+            raise LogWarehouseError('Error executing SQL:\n{0}\n{1}'.format(sql, emsg))
+        return [self.as_dict(c, result) for result in c.fetchall()]
+
+    def search(self, match, limit=None):
+        """Full text search
+
+        Return entries matching fts5 match expression as list of dictionaries,
+        ordered by time
+
+        """
+        if not self.fts:
+            raise LogWarehouseError('Full text index is not enabled')
+
+        sql = 'SELECT entry.* FROM entry_fts JOIN entry ON entry.id=entry_fts.rowid WHERE entry_fts MATCH ? ORDER BY entry.time'
+        if limit is not None:
+            sql += ' LIMIT {0:d}'.format(limit)
+        return self.query(sql, (match, ))
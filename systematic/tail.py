@@ -5,18 +5,51 @@ Python implementation of 'tail' type file reader class
 import os
 import time
 
+from systematic.inotify import InotifyWatcher, InotifyError, inotify_available, \
+    IN_MODIFY, IN_ATTRIB, IN_CREATE, IN_MOVED_TO, IN_MOVE_SELF, IN_DELETE_SELF, IN_Q_OVERFLOW
+
 INTERVAL = 0.01
 
+# Seconds to wait for inotify events before checking for rotation anyway
+ROTATION_CHECK_INTERVAL = 60
+
+WATCH_FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+WATCH_DIRECTORY_MASK = IN_CREATE | IN_MOVED_TO
+
 class TailReaderError(Exception):
     pass
 
 
 class TailReader(object):
-    def __init__(self, path=None, fd=None):
+    """Tail reader
+
+    Reads lines appended to a file, like tail -F. When no data is available,
+    waits for inotify events on the file and its directory if inotify is
+    available and use_inotify is True, or polls the file every INTERVAL
+    seconds. With inotify the file is checked with stat only after rotation
+    events, or when no events were received in ROTATION_CHECK_INTERVAL
+    seconds.
+
+    When the file is rotated, lines written to the old file are read before
+    continuing with the new file.
+
+    Each reader uses its own inotify instance, unless an InotifyWatcher shared
+    by many readers is given as watcher. Inotify instances are limited per
+    user, and readers fall back to polling when no more can be created.
+
+    """
+    use_inotify = True
+
+    def __init__(self, path=None, fd=None, watcher=None):
         self.path = path
         self.stat = None
         self.fd = fd
         self.pos = 0
+        self.buffer = ''
+        self.rotated = False
+        self.checked = time.time()
+        self.watcher = watcher
+        self.shared_watcher = watcher is not None
 
     def __iter__(self):
         return self
@@ -39,6 +72,18 @@ class TailReader(object):
         self.fd = None
         self.stat = None
 
+    def stop(self):
+        """
+        Close the file and stop watching it. Shared watcher is not closed.
+        """
+        self.close()
+        if self.watcher is not None:
+            if self.shared_watcher:
+                self.watcher.remove_watch(os.path.abspath(self.path))
+            else:
+                self.watcher.close()
+            self.watcher = None
+
     def load(self):
         """Load file
 
@@ -62,6 +107,8 @@ class TailReader(object):
             self.stat = os.stat(self.path)
             self.fd.seek(0)
             self.pos = 0
+            self.buffer = ''
+            self.rotated = False
             self.year = time.localtime(self.stat.st_mtime).tm_year
 
         except IOError, (ecode, emsg):
@@ -69,6 +116,33 @@ class TailReader(object):
         except OSError, (ecode, emsg):
             raise TailReaderError('Error opening {0}: {1}'.format(self.path, emsg))
 
+        self.__watch_file__()
+
+    def __watch_file__(self):
+        """Watch file
+
+        Start watching the opened file and its directory with inotify, if
+        available
+
+        """
+        if not self.use_inotify or self.path is None or not inotify_available():
+            return
+
+        try:
+            if self.watcher is None:
+                self.watcher = InotifyWatcher()
+            path = os.path.abspath(self.path)
+            if os.path.dirname(path) not in self.watcher.paths:
+                self.watcher.add_watch(os.path.dirname(path), WATCH_DIRECTORY_MASK)
+            self.watcher.remove_watch(path)
+            self.watcher.add_watch(path, WATCH_FILE_MASK)
+        except InotifyError:
+            # Fall back to polling
+            if self.watcher is not None and not self.shared_watcher:
+                self.watcher.close()
+            self.watcher = None
+            self.use_inotify = False
+
     def seek_to_end(self):
         """Jump to end of file
 
@@ -80,6 +154,94 @@ class TailReader(object):
             self.load()
         self.fd.seek(os.stat(self.path).st_size)
 
+    def __read_line__(self):
+        """Read line
+
+        Return next complete line without line ending, or None if no complete
+        line is available. Partial last line is kept until it is completed.
+
+        """
+        try:
+            line = self.fd.readline()
+            if line == '':
+                return None
+            self.pos = self.fd.tell()
+
+        except IOError, (ecode, emsg):
+            raise TailReaderError('Error reading {0}: {1}'.format(self.path, emsg))
+        except OSError, (ecode, emsg):
+            raise TailReaderError('Error reading {0}: {1}'.format(self.path, emsg))
+
+        if line[-1:] != '\n':
+            self.buffer += line
+            return None
+
+        line = self.buffer + line
+        self.buffer = ''
+        return line[:-1]
+
+    def __check_rotation__(self):
+        """Check rotation
+
+        Check with stat if the file was rotated, removed or truncated
+
+        """
+        self.checked = time.time()
+        if self.path is None:
+            return
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Removed or renamed, new file is not created yet
+            if self.fd is not None:
+                self.rotated = True
+            return
+
+        if self.stat is not None and (st.st_dev, st.st_ino) != (self.stat.st_dev, self.stat.st_ino):
+            self.rotated = True
+        elif self.fd is not None and self.pos > 0 and self.pos > st.st_size:
+            self.load()
+
+    def __wait__(self):
+        """Wait for changes
+
+        Wait for inotify events for the file, or sleep for INTERVAL seconds
+        when polling, and check for rotation when needed
+
+        """
+        if self.watcher is None:
+            time.sleep(INTERVAL)
+            self.__check_rotation__()
+            return
+
+        # Shared watcher returns no events also when it read only events of other files
+        wait = max(ROTATION_CHECK_INTERVAL - (time.time() - self.checked), 0)
+        events = self.watcher.read_events(wait, (os.path.abspath(self.path), ))
+        check = not events and time.time() - self.checked >= ROTATION_CHECK_INTERVAL
+        modified = False
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                check = True
+            elif event.name:
+                # Directory events for a new file with the same name
+                if event.name == os.path.basename(self.path):
+                    check = True
+            elif event.mask & (IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF):
+                check = True
+            elif event.mask & IN_MODIFY:
+                modified = True
+
+        if check:
+            self.__check_rotation__()
+        elif modified and self.fd is not None:
+            # File smaller than read position was truncated
+            try:
+                if os.fstat(self.fd.fileno()).st_size < self.pos:
+                    self.load()
+            except OSError:
+                pass
+
     def readline(self):
         """Read a line from the file
 
@@ -91,40 +253,23 @@ class TailReader(object):
         """
 
         while True:
-            try:
-                if self.stat is not None and os.stat(self.path).st_ino != self.stat.st_ino:
-                    self.close()
-
-                if self.fd is not None:
-                    if self.pos > 0 and self.pos > os.stat(self.path).st_size:
-                        self.load()
-
-            except IOError, (ecode, emsg):
-                self.close()
-            except OSError, (ecode, emsg):
-                self.close()
-
             if self.fd is None:
+                if self.rotated and not os.path.isfile(self.path):
+                    self.__wait__()
+                    continue
                 self.load()
 
-            if self.fd is not None:
-                try:
-                    line = self.fd.readline()
-
-                    if line != '':
-                        return self.__format_line__(line[:-1])
-
-                except IOError, (ecode, emsg):
-                    raise TailReaderError('Error opening {0}: {1}'.format(self.path, emsg))
-                except OSError, (ecode, emsg):
-                    raise TailReaderError('Error opening {0}: {1}'.format(self.path, emsg))
+            line = self.__read_line__()
+            if line is not None:
+                return self.__format_line__(line)
 
-                try:
-                    self.pos = self.fd.tell()
-
-                except IOError, (ecode, emsg):
-                    raise TailReaderError('Error reading {0}: {1}'.format(self.path, emsg))
-                except OSError, (ecode, emsg):
-                    raise TailReaderError('Error reading {0}: {1}'.format(self.path, emsg))
+            if self.rotated:
+                # Lines written before rotation were read, continue with the new file
+                line = self.buffer
+                self.close()
+                self.buffer = ''
+                if line:
+                    return self.__format_line__(line)
+                continue
 
-            time.sleep(INTERVAL)
+            self.__wait__()
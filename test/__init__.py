@@ -6,4 +6,5 @@ import os
 
 from test_dates import *
 from test_filesystems import *
+from test_log import *
 from test_sqlite import *
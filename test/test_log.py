@@ -0,0 +1,1126 @@
+"""
+Unit tests for syslog file parsers
+"""
+
+import os
+import re
+import sys
+import bz2
+import gzip
+import itertools
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from datetime import datetime, timedelta
+
+from systematic.logformats.nagios import IcingaLog
+from systematic.logcache import LogParseCache
+from systematic.logindex import LogTimeIndex, LogIndexError
+from systematic.logrules import LogRuleSet, LiteralMatcher, required_literal
+from systematic.logstats import LogAggregation, LogStatsError, OTHER_GROUP, numpy, \
+    SpaceSaving, CountMinSketch, TopKSummary, message_template
+from systematic.logtemplates import TemplateMiner, LogTemplateError
+from systematic.logwarehouse import LogWarehouse, LogWarehouseError
+from systematic.tail import TailReader
+from systematic.inotify import InotifyWatcher, inotify_available
+from systematic.log import detect_compression, literal_prefix, LogfileTailReader, find_command, DecompressorPipe, LogEntry, LogFile, LogFileError, SyslogTimeParser, SourceFormats, \
+    CompactLogEntry, CompactLogFile, ColumnarLogFile, LogFileCollection, CompactLogFileCollection, compile_source_formats, entry_memory_usage, \
+    SOURCE_FORMATS, COMPACT_LOG_ENTRY_SIZE, DEFAULT_INDEX_FIELDS, LogLineReader, LiveLogFileCollection
+
+TEST_LOG_LINES = (
+    'Oct  7 14:05:01 myhost CRON[1234]: (root) CMD (run-parts /etc/cron.hourly)',
+    'Oct  7 14:05:01 myhost sshd[4321]: Accepted publickey for hile from 10.0.0.1 port 50000 ssh2',
+    'Oct  7 14:05:02 otherhost kernel: device eth0 entered promiscuous mode',
+    '  continuation of the previous kernel message',
+    'Oct 17 14:06:00 myhost sshd[4321]: Connection closed by 10.0.0.1',
+)
+
+
+class CustomLogFile(LogFile):
+    """
+    Loader without streaming argument
+    """
+    def __init__(self, path, source_formats=SOURCE_FORMATS):
+        super(CustomLogFile, self).__init__(path, source_formats)
+
+
+class CustomLogFileCollection(LogFileCollection):
+    loader = CustomLogFile
+
+
+class OpenCountingLogFile(LogFile):
+    """
+    Loader counting how many times each file is opened, with indexes next to the files
+    """
+    index_directory = None
+    opened = {}
+
+    def __open__(self):
+        self.opened[self.path] = self.opened.get(self.path, 0) + 1
+        return super(OpenCountingLogFile, self).__open__()
+
+
+class OpenCountingLogFileCollection(LogFileCollection):
+    loader = OpenCountingLogFile
+
+
+class LogTestCase(unittest.TestCase):
+    """
+    Base class for tests with temporary log files
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_logfile(self, name='syslog', lines=TEST_LOG_LINES, mode='w'):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, mode) as fd:
+            fd.write(''.join('{0}\n'.format(line) for line in lines))
+        return path
+
+    def timed_lines(self, start, count, shuffle=False):
+        lines = []
+        for i in range(start, start + count):
+            # Swap every tenth pair of lines to simulate slightly out of order logs
+            j = shuffle and i % 10 == 0 and i + 1 or shuffle and i % 10 == 1 and i - 1 or i
+            lines.append('Oct  7 {0:02d}:{1:02d}:{2:02d} myhost prog[{3:d}]: message {3:d}'.format(j // 3600, j // 60 % 60, j % 60, i))
+            if i % 7 == 0:
+                lines.append('  continuation {0:d}'.format(i))
+        return lines
+
+
+class test_log(LogTestCase):
+
+    def test_timestamp_parser(self):
+        parser = SyslogTimeParser(cache_size=2)
+        for line in TEST_LOG_LINES[:3] + TEST_LOG_LINES[4:]:
+            mon, day, time, remainder = line.split(None, 3)
+            expected = datetime.strptime('2014 {0} {1} {2}'.format(mon, day, time), '%Y %b %d %H:%M:%S')
+            self.assertEquals(parser.parse_line(line, 2014), (expected, remainder))
+
+        self.assertEquals(parser.parse_line('Oct 7 14:05:01 host prog: message', 2014)[0], datetime(2014, 10, 7, 14, 5, 1))
+
+        first = parser.parse_line(TEST_LOG_LINES[0], 2014)[0]
+        self.assertIs(parser.parse_line(TEST_LOG_LINES[1], 2014)[0], first)
+
+        # Least recently used timestamp is evicted first
+        parser = SyslogTimeParser(cache_size=2)
+        a = parser.parse(2014, 'Oct', '7', '14:05:01')
+        b = parser.parse(2014, 'Oct', '7', '14:05:02')
+        self.assertIs(parser.parse(2014, 'Oct', '7', '14:05:01'), a)
+        parser.parse(2014, 'Oct', '7', '14:05:03')
+        self.assertIs(parser.parse(2014, 'Oct', '7', '14:05:01'), a)
+        self.assertIsNot(parser.parse(2014, 'Oct', '7', '14:05:02'), b)
+
+        with self.assertRaises(LogFileError):
+            parser.parse_line('Oct 77 14:05:01 host prog: message', 2014)
+        with self.assertRaises(LogFileError):
+            parser.parse_line('Oct 7 14:05:01', 2014)
+
+    def test_logfile_entries(self):
+        logfile = LogFile(self.write_logfile())
+        logfile.reload()
+        self.assertEquals(len(logfile), 4)
+        self.assertEquals(logfile[0].host, 'myhost')
+        self.assertEquals(logfile[0].program, 'CRON')
+        self.assertEquals(logfile[0].pid, '1234')
+        self.assertEquals(logfile[2].program, 'kernel')
+        self.assertEquals(logfile[2].message, 'device eth0 entered promiscuous mode\n  continuation of the previous kernel message')
+        self.assertEquals(logfile[3].time.day, 17)
+        self.assertEquals(len(logfile.filter_program('sshd')), 2)
+        self.assertEquals(len(logfile.filter_host('otherhost')), 1)
+
+    def test_source_formats(self):
+        formats = SourceFormats(SOURCE_FORMATS)
+        sources = (
+            '<13> myhost sshd[123]',
+            '<13> myhost sshd',
+            '<3.4> myhost sshd[123]',
+            '<3.4> myhost sshd',
+            'myhost sshd[123]',
+            'myhost sshd',
+            '<broken',
+            '',
+        )
+        for source in sources:
+            expected = None
+            for fmt in SOURCE_FORMATS:
+                m = fmt.match(source)
+                if m:
+                    expected = m.groupdict()
+                    break
+            self.assertEquals(formats.match(source), expected)
+
+        # Custom formats may end with unnamed groups
+        formats = SourceFormats([r'^(?P<host>\S+) (\w+)\[(?P<pid>\d+)\]$', r'^(?P<host>\S+) (\w+)$'])
+        self.assertEquals(formats.match('h prog'), {'host': 'h'})
+        self.assertEquals(formats.match('h prog[12]'), {'host': 'h', 'pid': '12'})
+
+        self.assertIs(compile_source_formats(SOURCE_FORMATS), compile_source_formats(list(SOURCE_FORMATS)))
+        self.assertIsInstance(LogFile('/dev/null', source_formats=[r'^(?P<host>\S+)$']).source_formats, SourceFormats)
+
+    def test_compact_entries(self):
+        logfile = LogFile(self.write_logfile())
+        logfile.reload()
+        compact = CompactLogFile(self.write_logfile())
+        compact.reload()
+
+        self.assertEquals([repr(x) for x in logfile], [repr(x) for x in compact])
+        for entry, compact_entry in zip(logfile, compact):
+            self.assertEquals(entry.source, compact_entry.source)
+            self.assertIsNone(compact_entry.line)
+            self.assertLess(entry_memory_usage(compact_entry), entry_memory_usage(entry) / 2)
+            if sys.maxsize > 2**32:
+                self.assertLessEqual(sys.getsizeof(compact_entry), COMPACT_LOG_ENTRY_SIZE)
+
+        self.assertIs(compact[0].host, compact[1].host)
+
+        # Sources which can't be rebuilt from host, program and pid are kept
+        lines = ('Oct  7 14:05:01 <3.4> myhost sshd: versioned', 'Oct  7 14:05:01 <broken: unmatched')
+        path = self.write_logfile('sources', lines)
+        self.assertEquals([x.source for x in CompactLogFile(path)], ['<3.4> myhost sshd', '<broken'])
+
+        compact[0].update_message_fields({'user': 'root'})
+        self.assertEquals(compact[0].message_fields, {'user': 'root'})
+        with self.assertRaises(AttributeError):
+            compact[0].extra = True
+
+    def test_columnar_logfile(self):
+        logfile = LogFile(self.write_logfile())
+        logfile.reload()
+        columnar = ColumnarLogFile(self.write_logfile())
+        columnar.reload()
+
+        self.assertEquals(len(columnar), len(logfile))
+        self.assertEquals([repr(x) for x in columnar[:]], [repr(x) for x in logfile])
+        self.assertEquals(repr(columnar[-1]), repr(logfile[-1]))
+        self.assertEquals(columnar[0].source, logfile[0].source)
+        for name, value in (('filter_host', 'myhost'), ('filter_program', 'sshd'), ('filter_message', '^device'), ('filter_host', 'nohost')):
+            self.assertEquals(
+                [repr(x) for x in getattr(columnar, name)(value)],
+                [repr(x) for x in getattr(logfile, name)(value)]
+            )
+        self.assertEquals(columnar.match_message('^Accepted \S+ for (?P<user>\S+)'), [{'user': 'hile'}])
+        self.assertEquals([repr(x) for x in columnar], [repr(x) for x in logfile])
+
+    def test_streaming_filters(self):
+        path = self.write_logfile()
+        logfile = LogFile(path)
+        streaming = LogFile(path, streaming=True)
+
+        self.assertEquals([repr(x) for x in streaming.iter_entries()], [repr(x) for x in LogFile(path).iter_entries()])
+        self.assertEquals([repr(x) for x in streaming.filter_program('sshd')], [repr(x) for x in logfile.filter_program('sshd')])
+        self.assertEquals(len(streaming), 0)
+        self.assertEquals([repr(x) for x in logfile.iter_entries()], [repr(x) for x in logfile])
+        self.assertEquals(list(streaming.iter_match_message('^Accepted \S+ for (?P<user>\S+)')), [{'user': 'hile'}])
+        self.assertEquals([x.host for x in streaming.iter_host('otherhost')], ['otherhost'])
+
+        collection = LogFileCollection([path, self.write_logfile('syslog.1')], streaming=True)
+        self.assertEquals(len(collection.filter_message('^Connection closed')), 2)
+        self.assertEquals(len(list(collection.iter_program('CRON'))), 2)
+        self.assertEquals(sum(len(x) for x in collection.logfiles), 0)
+
+        # Loaders without streaming argument
+        collection = CustomLogFileCollection([path], streaming=True)
+        self.assertTrue(collection.logfiles[0].streaming)
+        self.assertEquals(len(collection.filter_program('sshd')), 2)
+        self.assertEquals(len(collection.parallel_filter('filter_program', ('sshd', ), processes=1)), 2)
+
+    def test_merged_iterator(self):
+        first = self.write_logfile('auth.log', (
+            'Oct  7 14:05:01 myhost sshd[1]: first',
+            'Oct  7 14:05:03 myhost sshd[1]: third',
+            'Oct  7 14:05:05 myhost sshd[1]: fifth',
+        ))
+        second = self.write_logfile('daemon.log', (
+            'Oct  7 14:05:02 myhost ntpd[2]: second',
+            'Oct  7 14:05:04 myhost ntpd[2]: fourth',
+            '  continued',
+        ))
+        collection = LogFileCollection([first, second])
+        messages = [x.message for x in collection.iter_merged()]
+        self.assertEquals(messages, ['first', 'second', 'third', 'fourth\n  continued', 'fifth'])
+
+        year = collection.logfiles[0].iter_entries().next().time.year
+        start = datetime(year, 10, 7, 14, 5, 2)
+        end = datetime(year, 10, 7, 14, 5, 5)
+        self.assertEquals([x.message for x in collection.iter_merged(start, end)], messages[1:4])
+        self.assertEquals(list(collection.iter_merged(start=datetime(year + 1, 1, 1))), [])
+
+    def test_parallel_collection(self):
+        paths = [self.write_logfile('syslog.{0:d}'.format(i)) for i in range(3)]
+        for i, path in enumerate(paths):
+            os.utime(path, (1000000000 + i, 1000000000 + i))
+
+        expected = LogFileCollection(paths)
+        for parser in expected.logfiles:
+            parser.reload()
+
+        for loader in (LogFileCollection, CompactLogFileCollection):
+            collection = loader(paths)
+            collection.parallel_load(processes=2)
+            self.assertEquals(
+                [[repr(x) for x in parser] for parser in collection.logfiles],
+                [[repr(x) for x in parser] for parser in expected.logfiles]
+            )
+
+        collection = LogFileCollection(paths)
+        self.assertEquals(
+            [repr(x) for x in collection.parallel_filter('filter_program', ('sshd', ), processes=2)],
+            [repr(x) for x in expected.filter_program('sshd')]
+        )
+        merged = collection.parallel_filter('filter_program', ('sshd', ), processes=2, merge=True)
+        self.assertEquals([x.time for x in merged], sorted(x.time for x in merged))
+        self.assertIs(merged[0].logfile, collection.logfiles[0])
+        self.assertEquals(len(collection.parallel_filter('match_message', ('^Connection', ))), 3)
+
+        icinga = self.write_logfile('icinga.log', (
+            '[1400000000] SERVICE ALERT: myhost;ping;OK;HARD;1;PING OK',
+            '[1400000001] Auto-save of retention data completed successfully.',
+        ))
+        class IcingaLogCollection(LogFileCollection):
+            loader = IcingaLog
+        collection = IcingaLogCollection([icinga])
+        collection.parallel_load(processes=1)
+        self.assertEquals(collection.logfiles[0][0].category, 'SERVICE ALERT')
+
+    def test_parallel_chunked_load(self):
+        lines = []
+        for i in range(200):
+            lines.append('Oct  7 14:{0:02d}:{1:02d} myhost prog[{2:d}]: message {2:d}'.format(i // 60, i % 60, i))
+            if i % 3 == 0:
+                lines.extend(['\tcontinuation {0:d}'.format(i), '  second continuation'])
+        path = self.write_logfile(lines=lines)
+
+        expected = LogFile(path)
+        expected.reload()
+        for chunk_size in (7, 100, 2**20):
+            logfile = LogFile(path)
+            logfile.parallel_load(processes=2, chunk_size=chunk_size)
+            self.assertEquals([repr(x) for x in logfile], [repr(x) for x in expected])
+
+    def test_time_index(self):
+        path = self.write_logfile(lines=self.timed_lines(0, 1000, shuffle=True))
+        logfile = LogFile(path)
+        logfile.index_directory = os.path.join(self.tmpdir, 'index')
+        logfile.index_interval = 256
+        year = logfile.iter_entries().next().time.year
+
+        entries = list(LogFile(path).iter_entries())
+        for start, end in ((100, 200), (0, 10), (990, 2000), (None, 50), (500, None), (5000, 6000)):
+            start = start is not None and datetime(year, 10, 7) + timedelta(seconds=start) or None
+            end = end is not None and datetime(year, 10, 7) + timedelta(seconds=end) or None
+            expected = [repr(x) for x in entries if (start is None or x.time >= start) and (end is None or x.time < end)]
+            self.assertEquals([repr(x) for x in logfile.iter_time_range(start, end)], expected)
+
+        time_index = logfile.get_time_index()
+        self.assertGreater(len(time_index.offsets), 10)
+        self.assertGreater(time_index.seek_range(datetime(year, 10, 7, 0, 10))[0], 0)
+
+        saved = LogTimeIndex(path, logfile.index_directory, 256)
+        self.assertTrue(saved.load())
+        self.assertTrue(saved.is_current())
+
+        self.write_logfile(lines=self.timed_lines(1000, 100), mode='a')
+        indexed_size = time_index.indexed_size
+        start = datetime(year, 10, 7, 0, 16, 50)
+        self.assertEquals([x.message for x in logfile.iter_time_range(start)][-1].split('\n')[0], 'message 1099')
+        self.assertGreater(logfile.get_time_index().indexed_size, indexed_size)
+        self.assertEquals(logfile.get_time_index().offsets[:len(saved.offsets)], saved.offsets)
+
+        collection = LogFileCollection([path, self.write_logfile('other', self.timed_lines(5000, 10))])
+        for parser in collection.logfiles:
+            parser.index_directory = None
+        self.assertEquals(len(list(collection.iter_time_range(datetime(year, 10, 7, 1, 23, 20)))), 10)
+        self.assertTrue(os.path.isfile('{0}.timeindex'.format(os.path.realpath(path))))
+
+        # File truncated in place and rewritten past the indexed size is indexed again
+        indexed_size = logfile.get_time_index().indexed_size
+        with open(path, 'r+') as fd:
+            fd.truncate(0)
+            fd.write(''.join('{0}\n'.format(line.replace('Oct  7', 'Oct  8')) for line in self.timed_lines(0, 3000)))
+        self.assertGreater(os.stat(path).st_size, indexed_size)
+        start = datetime(year, 10, 8, 0, 10)
+        self.assertEquals(len(list(logfile.iter_time_range(start, start + timedelta(minutes=1)))), 60)
+
+    def test_seek_time(self):
+        path = self.write_logfile(lines=self.timed_lines(0, 3000, shuffle=True))
+        logfile = LogFile(path)
+        entries = list(logfile.iter_entries())
+        base = datetime(entries[0].time.year, 10, 7)
+
+        offsets = {}
+        offset = 0
+        with open(path) as fd:
+            for line in fd:
+                if line[:1] != ' ':
+                    offsets[line.split(': ', 1)[1].strip()] = offset
+                offset += len(line)
+
+        for seconds in (0, 1, 10, 11, 1234, 2999):
+            value = base + timedelta(seconds=seconds)
+            first = [x for x in entries if x.time >= value][0]
+            self.assertEquals(logfile.seek_time(value), offsets[first.message.split('\n')[0]])
+
+        self.assertEquals(logfile.seek_time(base + timedelta(hours=2)), os.stat(path).st_size)
+
+        for start, end in ((100, 200), (2900, None), (None, 5), (10, 11)):
+            start = start is not None and base + timedelta(seconds=start) or None
+            end = end is not None and base + timedelta(seconds=end) or None
+            expected = [repr(x) for x in entries if (start is None or x.time >= start) and (end is None or x.time < end)]
+            self.assertEquals([repr(x) for x in logfile.iter_time_range(start, end, use_index=False)], expected)
+
+    def test_gzip_index(self):
+        lines = self.timed_lines(0, 20000)
+        path = os.path.join(self.tmpdir, 'syslog.1.gz')
+        fd = gzip.open(path, 'wb')
+        fd.write(''.join('{0}\n'.format(line) for line in lines))
+        fd.close()
+        data = ''.join('{0}\n'.format(line) for line in lines)
+
+        logfile = LogFile(path)
+        logfile.index_directory = None
+        logfile.index_interval = 2**12
+        logfile.gzip_checkpoint_span = 2**15
+        gzip_index = logfile.get_gzip_index()
+        self.assertGreater(len(gzip_index.points), 5)
+        self.assertEquals(gzip_index.uncompressed_size, len(data))
+        for offset in (0, 1, 100000, len(data) - 50):
+            reader = gzip_index.open(offset)
+            self.assertEquals(reader.read(100), data[offset:offset + 100])
+            if offset + 100 < len(data):
+                self.assertEquals(reader.readline(), data[offset + 100:].split('\n', 1)[0] + '\n')
+            else:
+                self.assertEquals(reader.readline(), '')
+            reader.close()
+
+        entries = list(LogFile(path).iter_entries())
+        start = datetime(entries[0].time.year, 10, 7) + timedelta(seconds=15000)
+        end = start + timedelta(seconds=100)
+        expected = [repr(x) for x in entries if x.time >= start and x.time < end]
+        self.assertEquals([repr(x) for x in logfile.iter_time_range(start, end)], expected)
+        self.assertTrue(LogFile(path).get_gzip_index().is_current())
+
+        # Only the first member of multi member files is indexed
+        fd = gzip.open(path, 'ab')
+        fd.write(''.join('{0}\n'.format(line) for line in self.timed_lines(20000, 2000)))
+        fd.close()
+        logfile = LogFile(path)
+        logfile.index_directory = None
+        logfile.index_interval = 2**12
+        logfile.gzip_checkpoint_span = 2**15
+        gzip_index = logfile.get_gzip_index()
+        self.assertFalse(gzip_index.covers(0))
+        with self.assertRaises(LogIndexError):
+            gzip_index.open(100000)
+
+        entries = list(LogFile(path).iter_entries())
+        for seconds in (15000, 20500):
+            start = datetime(entries[0].time.year, 10, 7) + timedelta(seconds=seconds)
+            end = start + timedelta(seconds=100)
+            expected = [repr(x) for x in entries if x.time >= start and x.time < end]
+            self.assertEquals(len(expected), 100)
+            self.assertEquals([repr(x) for x in logfile.iter_time_range(start, end)], expected)
+
+    def test_compressed_formats(self):
+        path = self.write_logfile()
+        data = open(path).read()
+        expected = [repr(x) for x in LogFile(path).iter_entries()]
+        self.assertIsNone(detect_compression(path))
+
+        fd = gzip.open('{0}.gz'.format(path), 'wb')
+        fd.write(data)
+        fd.close()
+        fd = bz2.BZ2File('{0}.bz2'.format(path), 'wb')
+        fd.write(data)
+        fd.close()
+        paths = {'gzip': '{0}.gz'.format(path), 'bzip2': '{0}.bz2'.format(path)}
+        for compression, command in (('xz', 'xz'), ('zstd', 'zstd')):
+            if find_command(command) is not None:
+                subprocess.check_call([command, '-q', '-k', path])
+                paths[compression] = '{0}.{1}'.format(path, compression == 'zstd' and 'zst' or compression)
+
+        for compression, compressed_path in paths.items():
+            self.assertEquals(detect_compression(compressed_path), compression)
+            for external in (False, True):
+                logfile = LogFile(compressed_path)
+                logfile.external_decompressors = external
+                self.assertEquals([repr(x) for x in logfile.iter_entries()], expected)
+                entries = list(logfile.iter_entries())
+                self.assertEquals(
+                    [repr(x) for x in logfile.iter_time_range(entries[1].time, entries[2].time, use_index=False)],
+                    expected[:2]
+                )
+
+            collection = LogFileCollection([compressed_path])
+            collection.external_decompressors = True
+            self.assertTrue(collection.logfiles[0].external_decompressors)
+            self.assertEquals(len(collection.filter_program('sshd')), 2)
+
+        logfile = LogFile(paths['gzip'])
+        logfile.external_decompressors = True
+        fd, mtime = logfile.__open__()
+        self.assertIsInstance(fd, DecompressorPipe)
+        fd.close()
+
+    def test_block_reader(self):
+        lines = self.timed_lines(0, 500)
+        # Long stack trace would exceed the recursion limit with per-line recursion
+        lines[10:10] = ['  trace line {0:d}'.format(i) for i in range(sys.getrecursionlimit() * 2)]
+        path = self.write_logfile(lines=lines)
+        expected = [repr(x) for x in LogFile(path).iter_entries()]
+        self.assertEquals(len(expected), 500)
+
+        for loader in (LogFile, ColumnarLogFile):
+            logfile = loader(path)
+            logfile.read_block_size = 97
+            logfile.reload()
+            self.assertEquals([repr(x) for x in logfile], expected)
+            self.assertGreater(max(len(x.message.split('\n')) for x in logfile), sys.getrecursionlimit() * 2)
+
+        logfile = LogFile(path)
+        logfile.read_block_size = 1000
+        logfile.register_iterator('odd')
+        self.assertEquals(repr(logfile.next()), expected[0])
+        self.assertEquals(repr(logfile.next_iterator_match('odd', lambda x: x.pid is not None and int(x.pid) % 2 == 1)), expected[1])
+        self.assertEquals(repr(logfile.next()), expected[1])
+        self.assertEquals([repr(x) for x in list(logfile)], expected[2:])
+        self.assertEquals(len(logfile), 500)
+        self.assertEquals(repr(logfile.next_iterator_match('odd', lambda x: int(x.pid) % 2 == 1)), expected[3])
+
+        # readline() only returns entries not loaded yet
+        logfile = LogFile(path)
+        logfile.reload()
+        self.assertIsNone(logfile.readline())
+
+        # Open files are read without waiting for a full block
+        r, w = os.pipe()
+        reader = os.fdopen(r, 'r')
+        try:
+            os.write(w, '{0}\n'.format(TEST_LOG_LINES[0]))
+            logfile = LogFile(reader)
+            logfile.fd, logfile.mtime = reader, datetime.now()
+            self.assertEquals(logfile.readline().program, 'CRON')
+            os.write(w, '{0}\n'.format(TEST_LOG_LINES[1]))
+            self.assertEquals(logfile.next().program, 'CRON')
+            self.assertEquals(logfile.next().program, 'sshd')
+        finally:
+            os.close(w)
+            reader.close()
+
+    def test_memory_mapped_filters(self):
+        for pattern, prefix in (('^Accepted \S+', 'Accepted '), ('Connection', 'Connection'), ('(?i)device', ''), ('a|b', ''), ('ab*', 'a')):
+            self.assertEquals(literal_prefix(re.compile(pattern)), prefix)
+
+        lines = list(TEST_LOG_LINES) + [
+            'Oct  7 14:07:00 myhost sshd[4321]: myhost Connection reset',
+            '  Connection continued',
+            'Oct  7 14:08:00 myhost sshd[4321]: Connection without newline',
+        ]
+        path = self.write_logfile(lines=lines)
+        with open(path, 'a') as fd:
+            fd.truncate(os.path.getsize(path) - 1)
+
+        for pattern in ('^Connection', 'myhost', 'continuation', 'device eth0', '(?P<text>[a-z]+) (?P<word>\S+)'):
+            mapped = LogFile(path, streaming=True)
+            unmapped = LogFile(path, streaming=True)
+            unmapped.memory_map = False
+            self.assertEquals([repr(x) for x in mapped.filter_message(pattern)], [repr(x) for x in unmapped.filter_message(pattern)])
+            self.assertEquals(mapped.match_message(pattern), unmapped.match_message(pattern))
+        self.assertEquals(len(LogFile(path, streaming=True).filter_message('Connection')), 2)
+        self.assertEquals(len(LogFile(self.write_logfile('empty', ()), streaming=True).filter_message('Connection')), 0)
+
+    def test_parse_cache(self):
+        path = self.write_logfile()
+        os.utime(path, (1000000000, 1000000000))
+        cache = LogParseCache(os.path.join(self.tmpdir, 'cache'))
+        expected = [repr(x) for x in LogFile(path).iter_entries()]
+
+        for loader in (LogFile, CompactLogFile, ColumnarLogFile):
+            logfile = loader(path)
+            logfile.parse_cache = cache
+            logfile.reload()
+            self.assertEquals(len(cache.cache_files()), 1)
+            cached = loader(path)
+            cached.parse_cache = cache
+            cached.reload()
+            self.assertEquals([repr(x) for x in cached], [repr(x) for x in logfile])
+            self.assertEquals([x.__getstate__() for x in cached], [x.__getstate__() for x in logfile])
+            if loader is LogFile:
+                self.assertEquals([repr(x) for x in cached], expected)
+                self.assertIs(cached[0].logfile, cached)
+            cache.clear()
+
+        # Modified files and files newer than min_age are not loaded from cache
+        logfile = LogFile(path)
+        logfile.parse_cache = cache
+        logfile.reload()
+        self.write_logfile(lines=TEST_LOG_LINES[:2])
+        os.utime(path, (1000000000, 1000000000))
+        logfile.reload()
+        self.assertEquals(len(logfile), 2)
+        self.assertEquals(len(cache.cache_files()), 2)
+        self.assertIsNone(cache.cache_key(self.write_logfile('new.log'), LogEntry, SOURCE_FORMATS))
+
+        for max_size, cache_files in ((0, 0), (2**20, 1)):
+            collection = LogFileCollection([path])
+            collection.parse_cache = LogParseCache(os.path.join(self.tmpdir, 'cache{0}'.format(max_size)), max_size=max_size)
+            collection.parallel_load(processes=2)
+            self.assertEquals(len(collection.logfiles[0]), 2)
+            self.assertEquals(len(collection.parse_cache.cache_files()), cache_files)
+
+    def test_refresh(self):
+        path = self.write_logfile(lines=self.timed_lines(0, 100))
+        expected = self.timed_lines(0, 200)
+
+        for loader in (LogFile, ColumnarLogFile):
+            self.write_logfile(lines=self.timed_lines(0, 100))
+            logfile = loader(path)
+            logfile.register_iterator('monitor')
+            self.assertEquals(logfile.refresh(), 100)
+            for i in range(100):
+                logfile.next_iterator_match('monitor')
+
+            # Partial last line is parsed again when the line is completed
+            data = ''.join('{0}\n'.format(line) for line in expected[len(self.timed_lines(0, 100)):])
+            with open(path, 'a') as fd:
+                fd.write(data[:-20])
+            self.assertEquals(logfile.refresh(), 100)
+            with open(path, 'a') as fd:
+                fd.write(data[-20:])
+            self.assertEquals(logfile.refresh(), 0)
+            self.assertEquals(logfile.refresh(), 0)
+            self.assertEquals([repr(x) for x in logfile[:]], [repr(x) for x in LogFile(path).iter_entries()])
+            self.assertEquals(logfile.next_iterator_match('monitor').message, 'message 100')
+
+            # Truncated and rotated files are reloaded
+            self.write_logfile(lines=self.timed_lines(0, 10))
+            self.assertEquals(logfile.refresh(), 10)
+            self.assertEquals(len(logfile), 10)
+            os.unlink(path)
+            self.write_logfile(lines=self.timed_lines(0, 20))
+            self.assertEquals(logfile.refresh(), 20)
+            self.assertEquals(len(logfile), 20)
+
+            # Truncated in place and grown past the consumed offset
+            self.write_logfile(lines=self.timed_lines(1000, 30))
+            self.assertEquals(logfile.refresh(), 30)
+            self.assertEquals([repr(x) for x in logfile[:]], [repr(x) for x in LogFile(path).iter_entries()])
+
+        logfile = LogFile(path)
+        logfile.parallel_load(processes=2, chunk_size=256)
+        with open(path, 'a') as fd:
+            fd.write(''.join('{0}\n'.format(line) for line in TEST_LOG_LINES))
+        self.assertEquals(logfile.refresh(), 4)
+        self.assertEquals(len(logfile), 34)
+
+    def test_field_index(self):
+        lines = []
+        for i in range(300):
+            lines.append('Oct  7 14:{0:02d}:{1:02d} host{2:d} prog{3:d}[{4:d}]: message {4:d}'.format(i // 60, i % 60, i % 3, i % 5, i % 7))
+        path = self.write_logfile(lines=lines)
+
+        for loader in (LogFile, CompactLogFile, ColumnarLogFile):
+            plain = loader(path)
+            logfile = loader(path)
+            logfile.index_fields = DEFAULT_INDEX_FIELDS
+            # Only part of the file is loaded when filtering
+            logfile.read_block_size = 512
+            logfile.register_iterator('partial')
+            for i in range(10):
+                logfile.next_iterator_match('partial')
+            self.assertLess(len(logfile), 300)
+            self.assertEquals(sorted(logfile.field_index['host'].keys()), ['host0', 'host1', 'host2'])
+
+            self.assertEquals([repr(x) for x in logfile.filter_host('host1')], [repr(x) for x in plain.filter_host('host1')])
+            self.assertEquals([repr(x) for x in logfile.filter_program('prog3')], [repr(x) for x in plain.filter_program('prog3')])
+            self.assertEquals(len(logfile.filter_fields(host='host1', program='prog3')), 20)
+            self.assertEquals(len(logfile.filter_fields(host='host1', pid='2')), 14)
+            self.assertEquals(len(logfile.filter_fields(host='host1', message='message 2')), 14)
+            self.assertEquals(len(logfile.filter_fields(host='nohost', program='prog3')), 0)
+            self.assertEquals([repr(x) for x in logfile.filter_fields(pid='6')], [repr(x) for x in plain.filter_fields(pid='6')])
+
+            with open(path, 'a') as fd:
+                fd.write('Oct  7 15:00:00 host1 prog3[2]: message 2\n')
+            logfile.refresh()
+            self.assertEquals(len(logfile.filter_fields(host='host1', program='prog3')), 21)
+            self.write_logfile(lines=lines)
+
+        collection = LogFileCollection([path, self.write_logfile('syslog.1', lines)])
+        collection.index_fields = DEFAULT_INDEX_FIELDS
+        self.assertEquals(len(collection.filter_fields(host='host2', program='prog0')), 40)
+        self.assertEquals(len(collection.filter_host('host0')), 200)
+
+    def test_rule_matching(self):
+        for pattern, literal in (('^Accepted (publickey|password) for (?P<user>\S+)', 'Accepted '), ('(?i)error', ''),
+                                 ('x+ (device)+ eth\d', 'device'), ('a|b', ''), ('(?:failed )?login', 'login')):
+            self.assertEquals(required_literal(re.compile(pattern)), literal)
+
+        literals = ['he', 'she', 'his', 'hers', 'e', 'rs h']
+        matcher = LiteralMatcher(literals)
+        for text in ('ushers his', 'she', 'xyz', 'hhhe', ''):
+            self.assertEquals(matcher.search(text), set(i for i, literal in enumerate(literals) if literal in text))
+
+        rules = {
+            'accepted': '^Accepted \S+ for (?P<user>\S+) from (?P<address>\S+)',
+            'closed': 'Connection closed by (?P<address>\S+)',
+            'device': 'device (?P<device>\w+)',
+            'anything': '(?i).*',
+        }
+        path = self.write_logfile()
+        logfile = LogFile(path)
+        matches = logfile.match_rules(rules)
+        for name, regexp in rules.items():
+            self.assertEquals([groups for entry, groups in matches[name]], logfile.match_message(regexp))
+        self.assertEquals(matches['accepted'][0][1], {'user': 'hile', 'address': '10.0.0.1'})
+        self.assertEquals(len(matches['anything']), 4)
+
+        ruleset = LogRuleSet(rules, search=True)
+        streamed = LogFile(path, streaming=True).match_rules(ruleset)
+        self.assertEquals([entry.program for entry, groups in streamed['device']], ['kernel'])
+        self.assertEquals(len(list(LogFile(path).iter_match_rules(ruleset))), 7)
+
+        collection = LogFileCollection([path, self.write_logfile('syslog.1')])
+        self.assertEquals(len(collection.match_rules(rules)['closed']), 2)
+        self.assertEquals(len(list(collection.iter_match_rules(ruleset))), 14)
+
+        tail = LogfileTailReader(path)
+        matches = list(itertools.islice(tail.iter_match_rules(ruleset), 7))
+        self.assertEquals([name for name, entry, groups in matches if name != 'anything'], ['accepted', 'device', 'closed'])
+        self.assertEquals(matches[-1][1].host, 'myhost')
+        tail.close()
+
+    def test_aggregation(self):
+        path = self.write_logfile()
+        # Year of entries is taken from file mtime
+        mtime = time.mktime(datetime(2014, 12, 1).timetuple())
+        os.utime(path, (mtime, mtime))
+        aggregation = LogFile(path, streaming=True).aggregate(interval=60, keys=('host', 'program'))
+        self.assertEquals(aggregation.total, 4)
+        self.assertEquals(aggregation.buckets()[0], datetime(2014, 10, 7, 14, 5))
+        self.assertEquals(len(aggregation.buckets()), 14402)
+        self.assertEquals(aggregation.totals()[('myhost', 'sshd')], 2)
+        self.assertEquals(aggregation.series(('myhost', 'sshd'))[:2], [1, 0])
+        self.assertEquals(aggregation.series(('myhost', 'sshd'))[-1], 1)
+        aggregation.max_buckets = 14401
+        self.assertRaises(LogStatsError, aggregation.buckets)
+
+        logfile = LogFile(self.write_logfile('timed', self.timed_lines(0, 600)))
+        aggregation = logfile.aggregate(interval=3600, keys='user', message_regexp=r'message (?P<user>\d)\b')
+        self.assertEquals(aggregation.total, 10)
+        self.assertEquals(aggregation.totals(), dict(((str(i), ), 1) for i in range(10)))
+
+        aggregation = logfile.aggregate(interval=None, keys='pid', max_groups=100)
+        self.assertEquals(len(aggregation.groups()), 101)
+        self.assertEquals(aggregation.totals()[(OTHER_GROUP, )], 500)
+        self.assertEquals(aggregation.series((OTHER_GROUP, )), [500])
+
+        second = self.write_logfile('syslog.1')
+        os.utime(second, (mtime, mtime))
+        collection = LogFileCollection([path, second])
+        merged = LogAggregation(keys=('program', )).merge(LogFile(path).aggregate(keys=('program', )))
+        merged.merge(LogFile(path).aggregate(keys=('program', )))
+        self.assertEquals(collection.aggregate(keys=('program', )).counts, merged.counts)
+        self.assertRaises(LogStatsError, merged.merge, LogAggregation(keys=('host', )))
+
+        if numpy is not None:
+            times, groups, counts = merged.as_arrays()
+            self.assertEquals(counts.shape, (len(groups), len(times)))
+            self.assertEquals(counts.sum(), 8)
+
+    def test_heavy_hitters(self):
+        counts = dict(('key{0:d}'.format(i), 1000 // (i + 1)) for i in range(200))
+        stream = [key for key, count in sorted(counts.items()) for n in range(count)]
+        random.Random(1).shuffle(stream)
+        total = len(stream)
+
+        counters = SpaceSaving(50)
+        sketch = CountMinSketch(0.01, 0.01)
+        for key in stream:
+            counters.add(key)
+            sketch.add(key)
+        self.assertEquals(len(counters.counts), 50)
+        for key, count, error in counters.top():
+            self.assertTrue(count - error <= counts[key] <= count <= counts[key] + total // 50)
+            self.assertTrue(counts[key] <= sketch.estimate(key))
+        self.assertEquals([key for key, count, error in counters.top(5)], ['key0', 'key1', 'key2', 'key3', 'key4'])
+
+        # Keys in the same column of one row rarely share columns of other rows
+        sketch = CountMinSketch(0.01, 0.001)
+        sketch.width = 2**10
+        buckets = {}
+        for i in range(5000):
+            columns = sketch.__columns__('key{0:05d}'.format(i))
+            buckets.setdefault(columns[0], []).append(columns)
+        self.assertEquals(len(columns), sketch.depth)
+        pairs = [pair for bucket in buckets.values() for pair in itertools.combinations(bucket, 2)]
+        self.assertGreater(len(pairs), 1000)
+        self.assertLess(len([a for a, b in pairs if a[1:] == b[1:]]), 10)
+
+        # Merged summaries keep the error bound of the combined stream
+        first, second = SpaceSaving(50), SpaceSaving(50)
+        for index, key in enumerate(stream):
+            (index % 2 and first or second).add(key)
+        first.merge(second)
+        self.assertEquals(first.total, total)
+        for key, count, error in first.top():
+            self.assertTrue(count - error <= counts[key] <= count <= counts[key] + 2 * total // 50)
+
+        lines = ['Oct  7 14:05:{0:02d} myhost prog{1:d}[{2:d}]: connection from 10.0.0.{2:d} port {3:d}'.format(i % 60, i % 3 and 1 or 2, i, i * 7)
+            for i in range(300)]
+        path = self.write_logfile(lines=lines)
+        summary = LogFile(path).heavy_hitters('program', epsilon=0.1)
+        self.assertEquals(summary.top(2), [('prog1', 200, 200), ('prog2', 100, 100)])
+        summary = LogFile(path).heavy_hitters(message_template)
+        self.assertEquals(summary.top(1), [('connection from <*> port <*>', 300, 300)])
+
+        collection = LogFileCollection([path, self.write_logfile('syslog.1', lines)])
+        parallel = collection.heavy_hitters('program', epsilon=0.1, processes=2)
+        self.assertEquals(parallel.top(), collection.heavy_hitters('program', epsilon=0.1).top())
+        self.assertEquals(parallel.top(1), [('prog1', 400, 400)])
+        self.assertRaises(LogStatsError, parallel.merge, TopKSummary('host', epsilon=0.1))
+
+    def test_template_mining(self):
+        lines = []
+        for i in range(120):
+            lines.append('Oct  7 14:05:{0:02d} myhost sshd[{1:d}]: Accepted publickey for user{2:d} from 10.0.0.{2:d} port {3:d} ssh2'.format(
+                i % 60, 1000 + i, i % 4, 50000 + i))
+            lines.append('Oct  7 14:05:{0:02d} myhost sshd[{1:d}]: Connection closed by 10.0.0.{2:d}'.format(i % 60, 1000 + i, i % 7))
+            if i % 3 == 0:
+                lines.append('Oct  7 14:05:{0:02d} myhost kernel: device eth{1:d} entered promiscuous mode'.format(i % 60, i % 2))
+        path = self.write_logfile(lines=lines)
+
+        miner = LogFile(path).mine_templates()
+        top = miner.top()
+        self.assertEquals([(template.template, template.count) for template in top], [
+            ('Accepted publickey for <*> from <*> port <*> ssh2', 120),
+            ('Connection closed by <*>', 120),
+            ('device <*> entered promiscuous mode', 40),
+        ])
+        self.assertEquals(len(top[0].examples), 3)
+        self.assertEquals(miner.match('Connection closed by 192.168.1.1').id, top[1].id)
+        self.assertEquals(miner.match('Something else entirely'), None)
+
+        # Saved state continues incrementally
+        state = os.path.join(self.tmpdir, 'templates.json')
+        miner.save(state)
+        loaded = TemplateMiner.load(state)
+        self.assertEquals([(t.id, t.template, t.count) for t in loaded.top()], [(t.id, t.template, t.count) for t in top])
+        collection = LogFileCollection([path, self.write_logfile('syslog.1', lines)])
+        collection.mine_templates(loaded)
+        self.assertEquals([(t.id, t.count) for t in loaded.top()], [(t.id, 3 * t.count) for t in top])
+
+        # Template count is bounded, least recently used templates are dropped
+        bounded = TemplateMiner(max_templates=2)
+        for template, entry in bounded.iter_update(LogFile(path)):
+            pass
+        self.assertEquals(len(bounded), 2)
+        self.assertEquals(bounded.top()[-1].template, 'Connection closed by <*>')
+
+        # Tree nodes of dropped templates are removed
+        bounded = TemplateMiner(max_templates=1)
+        for i in range(100):
+            bounded.add_message('unique{0} message with {1:d} tokens'.format(chr(65 + i % 26) * (i + 1), i))
+        self.assertEquals(len(bounded), 1)
+        self.assertEquals(bounded.tree.keys(), [5])
+        self.assertEquals(len(bounded.tree[5]['children']), 1)
+
+        # Non-ASCII and invalid UTF-8 message bytes are restored as is
+        miner = TemplateMiner()
+        for message in ('User J\xc3\xbcrgen logged in', 'User J\xfcrgen logged in', 'User Jurgen logged in'):
+            miner.add_message(message)
+        miner.save(state)
+        self.assertFalse(os.path.exists('{0}.tmp'.format(state)))
+        loaded = TemplateMiner.load(state)
+        self.assertEquals([(t.template, t.examples) for t in loaded.top()], [(t.template, t.examples) for t in miner.top()])
+        self.assertEquals(loaded.match('User J\xfcrgen logged in').id, miner.match('User J\xfcrgen logged in').id)
+
+        # Unserializable state is not written
+        miner.top()[0].examples.append(object())
+        self.assertRaises(LogTemplateError, miner.save, state)
+        self.assertFalse(os.path.exists('{0}.tmp'.format(state)))
+
+        with open(state, 'w') as fd:
+            fd.write('{}')
+        self.assertRaises(LogTemplateError, TemplateMiner.load, state)
+
+    def test_warehouse(self):
+        path = self.write_logfile()
+        rotated = self.write_logfile('syslog.1', ['Oct  6 10:00:{0:02d} otherhost CRON[{0:d}]: job {0:d}'.format(i) for i in range(50)])
+        db_path = os.path.join(self.tmpdir, 'warehouse', 'logs.sqlite')
+
+        warehouse = LogWarehouse(db_path, fts=True)
+        warehouse.batch_size = 7
+        imported = warehouse.import_logfiles(LogFileCollection([path, rotated]))
+        self.assertEquals(imported, {path: 4, rotated: 50})
+        self.assertTrue(warehouse.is_imported(path))
+
+        rows = warehouse.query('SELECT host, program, message FROM entry WHERE program=? ORDER BY time', ('sshd', ))
+        self.assertEquals([row['message'] for row in rows], [
+            'Accepted publickey for hile from 10.0.0.1 port 50000 ssh2',
+            'Connection closed by 10.0.0.1',
+        ])
+        self.assertEquals(warehouse.query('SELECT count(*) AS count FROM entry WHERE host=?', ('otherhost', )), [{'count': 51}])
+        indexes = [row['name'] for row in warehouse.query("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='entry' ORDER BY name")]
+        self.assertEquals(indexes, ['entry_host', 'entry_logfile', 'entry_program', 'entry_time'])
+        self.assertEquals([row['message'] for row in warehouse.search('promiscuous')],
+            ['device eth0 entered promiscuous mode\n  continuation of the previous kernel message'])
+
+        # Renamed files are skipped, grown files replace the earlier import
+        os.rename(rotated, rotated + '.renamed')
+        self.assertEquals(warehouse.import_logfiles([rotated + '.renamed']), {})
+        with open(path, 'a') as fd:
+            fd.write('Oct 17 14:07:00 myhost sshd[4321]: Connection closed by 10.0.0.2\n')
+        self.assertFalse(warehouse.is_bulk_import([LogFile(path)]))
+        self.assertTrue(warehouse.is_bulk_import([LogFile(path), LogFile(rotated + '.renamed')]))
+        self.assertEquals(warehouse.import_logfiles(path), {path: 5})
+        self.assertEquals(len(warehouse.query("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='entry'")), 4)
+        self.assertEquals(warehouse.query('SELECT count(*) AS count FROM entry'), [{'count': 55}])
+        self.assertEquals(len(warehouse.search('closed')), 2)
+
+        warehouse.remove_logfile(path)
+        self.assertEquals(warehouse.query('SELECT count(*) AS count FROM entry'), [{'count': 50}])
+        self.assertEquals(warehouse.search('closed'), [])
+
+        # Non-ASCII messages are stored as UTF-8, invalid bytes replaced
+        path = self.write_logfile('syslog.utf8', [
+            'Oct  7 14:05:01 myhost sshd[1]: Invalid user J\xc3\xbcrgen',
+            'Oct  7 14:05:02 myhost sshd[2]: Invalid user J\xfcrgen',
+        ])
+        self.assertEquals(warehouse.import_logfiles(path), {path: 2})
+        self.assertEquals([row['message'] for row in warehouse.search('invalid')], [u'Invalid user J\xfcrgen', u'Invalid user J\ufffdrgen'])
+        self.assertEquals([row['pid'] for row in warehouse.search(u'J\xfcrgen')], [1])
+        self.assertRaises(LogWarehouseError, LogWarehouse(db_path).search, 'closed')
+
+    def test_open_file_limit(self):
+        paths = []
+        for index in range(40):
+            lines = self.timed_lines(index, 30)
+            lines[5:5] = ['  trace line {0:d}'.format(i) for i in range(3)]
+            name = 'syslog.{0:d}'.format(index)
+            if index % 4 == 0:
+                path = os.path.join(self.tmpdir, name + '.gz')
+                with gzip.open(path, 'wb') as fd:
+                    fd.write(''.join('{0}\n'.format(line) for line in lines))
+                paths.append(path)
+            else:
+                paths.append(self.write_logfile(name, lines))
+
+        expected = [repr(entry) for path in paths for entry in LogFile(path).iter_entries()]
+        merged = sorted(expected, key=lambda x: x.split(' ', 3)[:3])
+
+        # Closed reader continues from the same offset
+        reader = LogLineReader(LogFile(paths[0]), block_size=50)
+        lines = []
+        while not reader.eof:
+            lines.extend(reader.read_lines())
+            reader.close()
+        self.assertEquals(lines, list(LogLineReader(LogFile(paths[0]))))
+
+        # Compressed files are not closed by the limit, they would be decompressed again
+        compressed = [path for path in paths if path.endswith('.gz')]
+        OpenCountingLogFile.opened.clear()
+        collection = OpenCountingLogFileCollection(paths)
+        collection.max_open_files = 5
+        collection.merge_read_block_size = 100
+        entries = []
+        for entry in collection.iter_merged():
+            self.assertTrue(collection.open_files <= 5 + len(compressed))
+            entries.append(entry)
+        self.assertEquals(collection.open_files, 0)
+        self.assertEquals(len(entries), len(expected))
+        self.assertEquals(sorted(repr(entry) for entry in entries), sorted(merged))
+        self.assertEquals([entry.time for entry in entries], sorted(entry.time for entry in entries))
+        self.assertEquals([OpenCountingLogFile.opened[path] for path in compressed], [1] * len(compressed))
+        self.assertGreater(max(OpenCountingLogFile.opened.values()), 1)
+        self.assertFalse([path for path in compressed if os.path.exists('{0}.gzindex'.format(path))])
+
+        # Gzip files with a current saved index are closed like uncompressed files
+        for path in compressed:
+            OpenCountingLogFile(path).get_gzip_index()
+        collection = OpenCountingLogFileCollection(paths)
+        collection.max_open_files = 5
+        collection.merge_read_block_size = 100
+        entries = []
+        for entry in collection.iter_merged():
+            self.assertTrue(collection.open_files <= 5)
+            entries.append(repr(entry))
+        self.assertEquals(sorted(entries), sorted(merged))
+
+        # Exhausted files are closed while iterating the collection
+        collection = LogFileCollection(paths)
+        entries = []
+        for entry in collection:
+            self.assertTrue(collection.open_files <= 1)
+            entries.append(repr(entry))
+        self.assertEquals(sorted(entries), sorted(expected))
+        self.assertFalse([logfile for logfile in collection.logfiles if logfile.is_open])
+
+        # Closed LogFile continues reading from the same offset
+        logfile = LogFile(paths[4])
+        logfile.read_block_size = 64
+        first = logfile.next()
+        logfile.close()
+        self.assertFalse(logfile.is_open)
+        self.assertEquals([repr(entry) for entry in [first] + list(logfile)], [repr(entry) for entry in LogFile(paths[4]).iter_entries()])
+
+    def test_live_collection(self):
+        for use_inotify in (True, False):
+            for host in ('host1', 'host2'):
+                os.makedirs(os.path.join(self.tmpdir, use_inotify and 'inotify' or 'poll', host))
+            pattern = os.path.join(self.tmpdir, use_inotify and 'inotify' or 'poll', '*', 'syslog*')
+            first = pattern.replace('*', 'host1', 1).replace('*', '')
+            second = pattern.replace('*', 'host2', 1).replace('*', '')
+
+            def write(path, start, count, mode='a'):
+                with open(path, mode) as fd:
+                    fd.write(''.join('Oct  7 14:05:{0:02d} host prog[{0:d}]: message {0:d}\n'.format(i) for i in range(start, start + count)))
+
+            def messages(entries):
+                return [entry.message for entry in entries]
+
+            write(first, 0, 3)
+            with gzip.open(second + '.1.gz', 'wb') as fd:
+                fd.write('Oct  7 13:00:00 host prog[1]: rotated message\n')
+
+            collection = LiveLogFileCollection(pattern)
+            collection.use_inotify = use_inotify
+            collection.poll_interval = 0.02
+            self.assertEquals(len(collection.logfiles), 2)
+            self.assertEquals(sorted(messages(collection.follow(timeout=0.1))), ['message 0', 'message 1', 'message 2', 'rotated message'])
+
+            # Appended data, rotation by rename, new file, and compressed rotated file
+            write(first, 3, 2)
+            with open(first, 'a') as fd:
+                fd.write('Oct  7 14:05:05 host prog[5]: partial')
+            os.rename(first, first + '.1')
+            with open(first + '.1', 'a') as fd:
+                fd.write(' line\n  continuation\n')
+            write(first, 10, 2, 'w')
+            write(second, 20, 1, 'w')
+            with gzip.open(first + '.2.gz', 'wb') as fd:
+                fd.write('Oct  7 13:00:00 host prog[1]: old message\n')
+
+            entries = list(collection.follow(timeout=0.2))
+            self.assertEquals(sorted(messages(entries)), [
+                'message 10', 'message 11', 'message 20', 'message 3', 'message 4', 'partial line\n  continuation',
+            ])
+            self.assertEquals(sorted(parser.path for parser in collection.logfiles), [first, first + '.1', second])
+
+            # Truncated file is read from start, removed file is not followed
+            write(second, 5, 1, 'w')
+            os.unlink(first + '.1')
+            self.assertEquals(messages(collection.follow(timeout=0.2)), ['message 5'])
+            self.assertEquals(sorted(parser.path for parser in collection.logfiles), [first, second])
+
+            collection = LiveLogFileCollection(pattern, seek_to_end=True)
+            collection.use_inotify = use_inotify
+            write(first, 40, 1)
+            self.assertEquals(messages(collection.follow(timeout=0.1)), ['message 40'])
+
+            # Truncated file closed by open file limit is read from start, with year of file mtime
+            write(second + '.2', 50, 3, 'w')
+            collection = LiveLogFileCollection(pattern)
+            collection.use_inotify = use_inotify
+            collection.poll_interval = 0.02
+            collection.max_open_files = 1
+            self.assertEquals(len(list(collection.follow(timeout=0.1))), 9)
+            write(first, 30, 1, 'w')
+            mtime = time.mktime(datetime(2014, 10, 8).timetuple())
+            os.utime(first, (mtime, mtime))
+            entries = list(collection.follow(timeout=0.2))
+            self.assertEquals(messages(entries), ['message 30'])
+            self.assertEquals(entries[0].time.year, 2014)
+
+    def test_tail_reader(self):
+        for use_inotify in (True, False):
+            path = os.path.join(self.tmpdir, use_inotify and 'inotify.log' or 'poll.log')
+            with open(path, 'w') as fd:
+                fd.write('line 1\nline 2\n')
+            tail = TailReader(path)
+            tail.use_inotify = use_inotify
+            self.assertEquals([tail.readline(), tail.readline()], ['line 1', 'line 2'])
+            self.assertEquals(tail.watcher is not None, use_inotify)
+
+            # Lines written before rotation are read before the new file
+            with open(path, 'a') as fd:
+                fd.write('line 3\npartial')
+            os.rename(path, path + '.1')
+            with open(path + '.1', 'a') as fd:
+                fd.write(' line\n')
+            with open(path, 'w') as fd:
+                fd.write('new line 1\nnew line 2\n')
+            self.assertEquals([tail.readline() for i in range(4)], ['line 3', 'partial line', 'new line 1', 'new line 2'])
+
+            # Truncated file is read from start
+            with open(path, 'w') as fd:
+                fd.write('short\n')
+            self.assertEquals(tail.readline(), 'short')
+
+            # Truncation is detected when woken up, before the file grows past read position
+            with open(path, 'w') as fd:
+                fd.write('a\n')
+            tail.__wait__()
+            with open(path, 'a') as fd:
+                fd.write('long line after truncation\n')
+            self.assertEquals(tail.readline(), 'a')
+            tail.stop()
+
+        # Readers sharing one inotify watcher get events of their own files
+        if inotify_available():
+            watcher = InotifyWatcher()
+            paths = [os.path.join(self.tmpdir, 'shared{0:d}.log'.format(i)) for i in range(3)]
+            tails = []
+            for path in paths:
+                with open(path, 'w') as fd:
+                    fd.write('{0} line 1\n'.format(os.path.basename(path)))
+                tails.append(TailReader(path, watcher=watcher))
+            self.assertEquals([tail.readline() for tail in tails], ['shared0.log line 1', 'shared1.log line 1', 'shared2.log line 1'])
+            for path in reversed(paths):
+                with open(path, 'a') as fd:
+                    fd.write('{0} line 2\n'.format(os.path.basename(path)))
+            os.rename(paths[1], paths[1] + '.1')
+            with open(paths[1], 'w') as fd:
+                fd.write('new line\n')
+            for i in range(100):
+                with open(paths[2], 'a') as fd:
+                    fd.write('extra {0:d}\n'.format(i))
+                os.utime(paths[2], None)
+            tails[0].__wait__()
+            self.assertEquals(sorted(watcher.pending), paths[1:])
+            self.assertEquals(len(watcher.pending[paths[2]]), 1)
+            self.assertEquals([tail.readline() for tail in tails], ['shared0.log line 2', 'shared1.log line 2', 'shared2.log line 2'])
+            self.assertEquals(tails[1].readline(), 'new line')
+            self.assertEquals([tails[2].readline() for i in range(100)], ['extra {0:d}'.format(i) for i in range(100)])
+
+            # Waking up for events of other files does not check rotation with stat
+            checked = tails[1].checked
+            with open(paths[0], 'a') as fd:
+                fd.write('other\n')
+            tails[1].__wait__()
+            self.assertEquals(tails[1].checked, checked)
+            self.assertIn(paths[0], watcher.pending)
+            self.assertEquals([tail.watcher for tail in tails], [watcher] * 3)
+            tails[0].stop()
+            self.assertIsNotNone(watcher.fileno())
+            self.assertNotIn(paths[0], watcher.paths)
+            with open(paths[2], 'w') as fd:
+                fd.write('short\n')
+            self.assertEquals(tails[2].readline(), 'short')
+            watcher.close()
+
+        with open(path, 'a') as fd:
+            fd.write('{0}\n'.format(TEST_LOG_LINES[0]))
+        tail = LogfileTailReader(path)
+        tail.seek_to_end()
+        with open(path, 'a') as fd:
+            fd.write('{0}\n'.format(TEST_LOG_LINES[1]))
+        self.assertEquals(tail.readline().program, 'sshd')
+        tail.stop()